@@ -13,12 +13,40 @@
 #
 # python audit_001.py > audit_output.json
 #
+# Add --bulk to fetch the data for all bags in a few large sorted
+# queries instead of several small queries per file, or --workers 8
+# to audit bags in eight processes.
+#
+# To stream the report with one JSON record per line (one per file,
+# plus a summary line per bag), or as CSV with one row per file:
+#
+# python audit_001.py --output ndjson > audit_output.ndjson
+# python audit_001.py --output csv > audit_output.csv
+#
+# To compute the actions for all files in a single set-based SQL pass,
+# and to prove that pass decides exactly what check_keys decides:
+#
+# python audit_001.py --engine sql
+# python audit_001.py --cross-check
+#
 import argparse
+import csv
+import multiprocessing
 import sqlite3
 import sys
 import json
+import time
+
+from compact_text import register_functions
+from metrics import Metrics, add_metrics_arguments, metrics_from_args
 
-class ObjectStat:
+READ_DB_PATH = 'db/aptrust.db'
+WRITE_DB_PATH = 'db/audit001_summary.db'
+
+# Output types that are written one record at a time.
+STREAMING_OUTPUTS = ['ndjson', 'csv']
+
+class ObjectStat(object):
     """
     ObjectStat collects information about a bag (intellectual object)
     that appears to have failed ingest. Note *appears*. None of these
@@ -26,14 +54,22 @@ class ObjectStat:
     files were stored twice in S3 and/or Glacier, while some were
     stored in S3 but not in Glacier.
     """
+    __slots__ = ['bag_name', 'error_message', 'identifier', 'files',
+                 'total_size', 'total_files', 'files_not_ingested',
+                 'ingested_size', 'bytes_not_ingested', 'totally_ok',
+                 'ok_but_needs_deletions', 'no_url', 'url_needs_change',
+                 's3_deletion_files', 's3_deletion_keys',
+                 'glacier_deletion_files', 'glacier_deletion_keys',
+                 'keys_missing_from_s3', 'keys_missing_from_glacier']
+
     def __init__(self, bag_name, error_message):
         self.bag_name = bag_name
         self.error_message = error_message
         self.identifier = None
         self.files = []
+        self._reset_summary()
 
     def add_file(self, filestat):
-        filestat.check_keys()
         self.files.append(filestat)
 
     def _summarize(self):
@@ -42,6 +78,11 @@ class ObjectStat:
         this object. Which files were stored twice? Which are missing
         the Glacier backup? Which should have the storage URL changed?
         """
+        self._reset_summary()
+        for f in self.files:
+            self._tally(f)
+
+    def _reset_summary(self):
         self.total_size = 0
         self.total_files = 0
         self.files_not_ingested = 0
@@ -58,31 +99,35 @@ class ObjectStat:
         self.glacier_deletion_keys = 0
         self.keys_missing_from_s3 = 0
         self.keys_missing_from_glacier = 0
-        for f in self.files:
-            f.check_keys()
-            self.total_size += f.size
-            self.total_files += 1
-            self.ingested_size += f.size
-            self.keys_missing_from_s3 += len(f.s3_missing_keys)
-            self.keys_missing_from_glacier += len(f.glacier_missing_keys)
-            if f.fedora_url is None:
-                self.no_url += 1
-                self.ingested_size -= f.size
-                self.bytes_not_ingested += f.size
-                self.files_not_ingested += 1
-            elif f.fedora_url == f.fedora_url_should_be:
-                if not f.s3_keys_to_delete and not f.glacier_keys_to_delete:
-                    self.totally_ok += 1
-                else:
-                    self.ok_but_needs_deletions += 1
+
+    def _tally(self, f):
+        """
+        Adds a single file to the summary counts.
+        """
+        f.check_keys()
+        self.total_size += f.size
+        self.total_files += 1
+        self.ingested_size += f.size
+        self.keys_missing_from_s3 += len(f.s3_missing_keys)
+        self.keys_missing_from_glacier += len(f.glacier_missing_keys)
+        if f.fedora_url is None:
+            self.no_url += 1
+            self.ingested_size -= f.size
+            self.bytes_not_ingested += f.size
+            self.files_not_ingested += 1
+        elif f.fedora_url == f.fedora_url_should_be:
+            if not f.s3_keys_to_delete and not f.glacier_keys_to_delete:
+                self.totally_ok += 1
             else:
-                self.url_needs_change += 1
-            if f.s3_keys_to_delete:
-                self.s3_deletion_files += 1
-                self.s3_deletion_keys += len(f.s3_keys_to_delete)
-            if f.glacier_keys_to_delete:
-                self.glacier_deletion_files += 1
-                self.glacier_deletion_keys += len(f.glacier_keys_to_delete)
+                self.ok_but_needs_deletions += 1
+        else:
+            self.url_needs_change += 1
+        if f.s3_keys_to_delete:
+            self.s3_deletion_files += 1
+            self.s3_deletion_keys += len(f.s3_keys_to_delete)
+        if f.glacier_keys_to_delete:
+            self.glacier_deletion_files += 1
+            self.glacier_deletion_keys += len(f.glacier_keys_to_delete)
 
     def to_hash(self):
         """
@@ -99,37 +144,61 @@ class ObjectStat:
             'identifier': self.identifier,
             'error_message': self.error_message,
             'files': list(map(lambda f:f.to_hash(), self.files)),
-            'summary': {
-                'total_size': self.total_size,
-                'total_files': self.total_files,
-                'files_not_ingested': self.files_not_ingested,
-                'ingested_size': self.ingested_size,
-                'bytes_not_ingested': self.bytes_not_ingested,
-                'totally_ok': self.totally_ok,
-                'ok_but_needs_deletions': self.ok_but_needs_deletions,
-                'no_url': self.no_url,
-                'url_needs_change': self.url_needs_change,
-                's3_deletion_files': self.s3_deletion_files,
-                's3_deletion_keys': self.s3_deletion_keys,
-                'glacier_deletion_files': self.glacier_deletion_files,
-                'glacier_deletion_keys': self.glacier_deletion_keys,
-                'keys_missing_from_s3': self.keys_missing_from_s3,
-                'keys_missing_from_glacier': self.keys_missing_from_glacier
-            }
+            'summary': self.summary_hash()
+        }
+
+    def summary_hash(self):
+        """
+        Returns the summary counts. Call _summarize or _tally first.
+        """
+        return {
+            'total_size': self.total_size,
+            'total_files': self.total_files,
+            'files_not_ingested': self.files_not_ingested,
+            'ingested_size': self.ingested_size,
+            'bytes_not_ingested': self.bytes_not_ingested,
+            'totally_ok': self.totally_ok,
+            'ok_but_needs_deletions': self.ok_but_needs_deletions,
+            'no_url': self.no_url,
+            'url_needs_change': self.url_needs_change,
+            's3_deletion_files': self.s3_deletion_files,
+            's3_deletion_keys': self.s3_deletion_keys,
+            'glacier_deletion_files': self.glacier_deletion_files,
+            'glacier_deletion_keys': self.glacier_deletion_keys,
+            'keys_missing_from_s3': self.keys_missing_from_s3,
+            'keys_missing_from_glacier': self.keys_missing_from_glacier
         }
 
 
-class FileStat:
+# Bits for FileStat.aws_keys, which maps each key to the places
+# it's stored.
+IN_S3 = 1
+IN_GLACIER = 2
+IN_BOTH = IN_S3 | IN_GLACIER
+
+
+class FileStat(object):
     """
     Contains information about a file that was unpacked from a tarred bag,
     including 1) what the ingest services know about the file, 2) what Fedora
     knows about the file and 3) what S3 and Glacier know about the file.
+
+    There's one of these for every file in the audit, so it uses slots,
+    and it stores the locations of each key as a bitmask of IN_S3 and
+    IN_GLACIER. The results of check_keys are cached until the Fedora
+    URL or the keys change.
     """
+    __slots__ = ['path', 'size', 'identifier', '_fedora_url',
+                 'fedora_url_should_be', 'aws_keys', 'key_to_keep',
+                 's3_keys_to_delete', 'glacier_keys_to_delete',
+                 's3_missing_keys', 'glacier_missing_keys',
+                 'error_message', '_dirty']
+
     def __init__(self, path, size):
         self.path = path
         self.size = size
         self.identifier = None
-        self.fedora_url = None
+        self._fedora_url = None
         self.fedora_url_should_be = None
         self.aws_keys = {}
         self.key_to_keep = None
@@ -137,6 +206,17 @@ class FileStat:
         self.glacier_keys_to_delete = []
         self.s3_missing_keys = []
         self.glacier_missing_keys = []
+        self.error_message = None
+        self._dirty = True
+
+    @property
+    def fedora_url(self):
+        return self._fedora_url
+
+    @fedora_url.setter
+    def fedora_url(self, url):
+        self._fedora_url = url
+        self._dirty = True
 
     def add_s3_key(self, key):
         """
@@ -144,10 +224,8 @@ class FileStat:
         as the S3 key (file name) of the file in our S3 preservation
         storage bucket.
         """
-        locations = self.aws_keys.get(key, [])
-        if len(locations) == 0:
-            self.aws_keys[key] = locations
-        self.aws_keys[key].append('s3')
+        self.aws_keys[key] = self.aws_keys.get(key, 0) | IN_S3
+        self._dirty = True
 
     def add_glacier_key(self, key):
         """
@@ -155,10 +233,20 @@ class FileStat:
         as the key (file name) of this object in our Oregon Glacier
         storage.
         """
-        locations = self.aws_keys.get(key, [])
-        if len(locations) == 0:
-            self.aws_keys[key] = locations
-        self.aws_keys[key].append('glacier')
+        self.aws_keys[key] = self.aws_keys.get(key, 0) | IN_GLACIER
+        self._dirty = True
+
+    def locations(self, key):
+        """
+        Returns a list of the places the key is stored: 's3',
+        'glacier', or both.
+        """
+        locations = []
+        if self.aws_keys.get(key, 0) & IN_S3:
+            locations.append('s3')
+        if self.aws_keys.get(key, 0) & IN_GLACIER:
+            locations.append('glacier')
+        return locations
 
     def url_suffix(self):
         """
@@ -181,7 +269,7 @@ class FileStat:
             'fedora_url': self.fedora_url,
             'fedora_url_should_be': self.fedora_url_should_be,
             'identifier': self.identifier,
-            'aws_keys': self.aws_keys,
+            'aws_keys': dict((key, self.locations(key)) for key in self.aws_keys),
             'key_to_keep': self.key_to_keep,
             's3_keys_to_delete': self.s3_keys_to_delete,
             'glacier_keys_to_delete': self.glacier_keys_to_delete,
@@ -197,17 +285,31 @@ class FileStat:
         URL should be, 3) which files never made it to Glacier, and
         4) which files should be deleted from S3/Glacier because they are
         duplicates from a subsequent ingest attempt.
+
+        The results are recalculated only if the URL or keys have changed
+        since the last call. Keys are checked in sorted order, so when
+        more than one key qualifies as the key to keep, the last one in
+        sort order wins.
         """
-        if self.fedora_url is None:
+        if not self._dirty:
             return
+        self._dirty = False
         self.key_to_keep = None
+        self.fedora_url_should_be = None
         self.error_message = None
+        self.s3_keys_to_delete = []
+        self.glacier_keys_to_delete = []
+        self.s3_missing_keys = []
+        self.glacier_missing_keys = []
+        if self.fedora_url is None:
+            return
         fedora_key = self.url_suffix()
+        keys = sorted(self.aws_keys)
         # If the key in the Fedora URL is stored in both S3 and Glacier,
         # keep that key and delete all others. For this file, storage
         # was successful.
-        for key, locations in self.aws_keys.iteritems():
-            if key in self.fedora_url and 's3' in locations and 'glacier' in locations:
+        for key in keys:
+            if key in self.fedora_url and self.aws_keys[key] == IN_BOTH:
                 self.key_to_keep = key
                 self.fedora_url_should_be = self.fedora_url
         # We have many cases where the storage URL includes a key that
@@ -216,8 +318,8 @@ class FileStat:
         # items, switch the URL to the new key. We'll get rid of the old
         # URL and the item in S3 it points to.
         if self.key_to_keep is None:
-            for key, locations in self.aws_keys.iteritems():
-                if key not in self.fedora_url and 's3' in locations and 'glacier' in locations:
+            for key in keys:
+                if key not in self.fedora_url and self.aws_keys[key] == IN_BOTH:
                     self.key_to_keep = key
                     self.fedora_url_should_be = self.fedora_url.replace(fedora_key, key)
 
@@ -227,35 +329,108 @@ class FileStat:
 
         # Now, if we have an authoritative key, we want to delete the other
         # items from S3/Glacier.
-        for key, locations in self.aws_keys.iteritems():
+        for key in keys:
+            locations = self.aws_keys[key]
             if key not in self.fedora_url_should_be:
-                if 's3' in locations:
+                if locations & IN_S3:
                     self.s3_keys_to_delete.append(key)
-                if 'glacier' in locations:
+                if locations & IN_GLACIER:
                     self.glacier_keys_to_delete.append(key)
             else: # key matches URL
-                if 's3' not in locations:
+                if not locations & IN_S3:
                     self.s3_missing_keys.append(key)
-                if 'glacier' not in locations:
+                if not locations & IN_GLACIER:
                     self.glacier_missing_keys.append(key)
 
-def report_on_all_files(read_conn, write_conn, output_type):
+def report_on_all_files(read_conn, writer, output_type, workers=1,
+                        metrics=None):
     """
     Run a full report on all files belonging to all of the
-    "failed" ingest bags.
+    "failed" ingest bags. If workers is greater than one, bags are
+    audited in that many worker processes, and this process writes
+    the results in the same order as a single-process run.
     """
+    if metrics is None:
+        metrics = Metrics('audit_001')
     c = read_conn.cursor()
-    query = "select key from audit_001_objects"
-    index = 1
-    c.execute(query)
-    for row in c.fetchall():
-        bag_name = row[0]
-        sys.stderr.write("{0:4d}  {1}\n".format(index, bag_name))
-        build_summary(read_conn, write_conn, bag_name, output_type)
-        index += 1
+    c.execute(BAG_NAMES_QUERY)
+    bag_names = [row[0] for row in c.fetchall()]
     c.close()
+    metrics.set_totals(total=len(bag_names))
+    if workers == 1 and output_type in STREAMING_OUTPUTS:
+        for bag_name in bag_names:
+            # Files are read and written as they stream by,
+            # so there's no separate write stage here.
+            with metrics.stage('audit'):
+                obj_stat = new_object_stat(read_conn, bag_name)
+                writer.write_records(
+                    iter_records(obj_stat, iter_file_stats(read_conn, bag_name)))
+            metrics.progress()
+        return
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, _init_worker, (READ_DB_PATH,))
+        obj_stats = pool.imap(_build_object_stat_in_worker, bag_names,
+                              chunksize=8)
+    else:
+        obj_stats = (build_object_stat(read_conn, name) for name in bag_names)
+    write_obj_stats(obj_stats, writer, output_type, metrics)
+    if workers > 1:
+        pool.close()
+        pool.join()
+
+# Each worker process gets its own read-only connection to aptrust.db.
+_worker_conn = None
+
+def _init_worker(db_path):
+    global _worker_conn
+    _worker_conn = sqlite3.connect(db_path)
+    _worker_conn.row_factory = sqlite3.Row
+    register_functions(_worker_conn)
+    _worker_conn.execute("PRAGMA query_only = 1")
+
+def _build_object_stat_in_worker(bag_name):
+    """
+    Runs in a worker process. The ObjectStat is pickled and sent back
+    to the parent, which does all of the writing.
+    """
+    return build_object_stat(_worker_conn, bag_name)
+
+def write_obj_stats(obj_stats, writer, output_type, metrics):
+    """
+    Writes each ObjectStat from obj_stats, which can be a generator.
+    Time spent waiting for the next ObjectStat counts as audit time.
+    """
+    started = time.time()
+    for obj_stat in obj_stats:
+        metrics.add_time('audit', time.time() - started)
+        with metrics.stage('write'):
+            output_summary(writer, obj_stat, output_type)
+        metrics.progress()
+        started = time.time()
+
+def report_on_all_files_bulk(read_conn, writer, output_type, metrics=None):
+    """
+    Same as report_on_all_files, but fetches data for all bags in a
+    handful of sorted queries instead of issuing several queries for
+    every file. See iter_object_stats_bulk.
+    """
+    if metrics is None:
+        metrics = Metrics('audit_001')
+    started = time.time()
+    for obj_stat, filestats in iter_bags_bulk(read_conn):
+        if output_type in STREAMING_OUTPUTS:
+            writer.write_records(iter_records(obj_stat, filestats))
+            metrics.add_time('audit', time.time() - started)
+        else:
+            for filestat in filestats:
+                obj_stat.add_file(filestat)
+            metrics.add_time('audit', time.time() - started)
+            with metrics.stage('write'):
+                output_summary(writer, obj_stat, output_type)
+        metrics.progress()
+        started = time.time()
 
-def build_summary(read_conn, write_conn, bag_name, output_type):
+def build_summary(read_conn, writer, bag_name, output_type):
     """
     Builds a summary of the state of an object and its files, including
     any issues. If output_type is 'json', this prints a JSON summary to
@@ -265,181 +440,651 @@ def build_summary(read_conn, write_conn, bag_name, output_type):
     and what S3 knows about. If output_type is anything other than JSON,
     this saves the data to the audit001_summary.db database.
     """
-    filestat = None
+    obj_stat = build_object_stat(read_conn, bag_name)
+    output_summary(writer, obj_stat, output_type)
+
+def output_summary(writer, obj_stat, output_type):
+    """
+    Prints the ObjectStat as JSON, writes it as NDJSON or CSV records
+    through a ReportWriter, or queues its actions on a SummaryWriter.
+    """
+    if output_type == 'json':
+        print(json.dumps(obj_stat.to_hash(), sort_keys=True, indent=2))
+    elif output_type in STREAMING_OUTPUTS:
+        writer.write_records(iter_records(obj_stat, obj_stat.files))
+    else:
+        save_to_db(writer, obj_stat)
+
+def iter_records(obj_stat, filestats):
+    """
+    Yields one record (a dict) for each file in filestats, followed by
+    one summary record for the bag. Param filestats can be a generator.
+    Files are tallied as they go by and are not kept, so memory use
+    doesn't depend on the size of the bag.
+    """
+    obj_stat._reset_summary()
+    for filestat in filestats:
+        obj_stat._tally(filestat)
+        record = filestat.to_hash()
+        record['record_type'] = 'file'
+        record['bag_name'] = obj_stat.bag_name
+        yield record
+    yield {
+        'record_type': 'bag',
+        'bag_name': obj_stat.bag_name,
+        'identifier': obj_stat.identifier,
+        'error_message': obj_stat.error_message,
+        'summary': obj_stat.summary_hash()
+    }
+
+
+class ReportWriter(object):
+    """
+    Writes records from iter_records to a file, either as NDJSON (one
+    JSON object per line) or as CSV. CSV output has one row per file
+    and leaves out the bag summary records.
+    """
+    CSV_FIELDS = ['bag_name', 'path', 'identifier', 'fedora_url',
+                  'fedora_url_should_be', 'key_to_keep', 's3_keys',
+                  'glacier_keys', 's3_keys_to_delete',
+                  'glacier_keys_to_delete', 's3_missing_keys',
+                  'glacier_missing_keys', 'error_message']
+
+    def __init__(self, out, output_type):
+        self.out = out
+        self.output_type = output_type
+        self.csv_writer = None
+        if output_type == 'csv':
+            self.csv_writer = csv.writer(out)
+            self.csv_writer.writerow(self.CSV_FIELDS)
+
+    def write_records(self, records):
+        for record in records:
+            if self.output_type == 'ndjson':
+                self.out.write(json.dumps(record, sort_keys=True,
+                                          separators=(',', ':')))
+                self.out.write("\n")
+            elif record['record_type'] == 'file':
+                self.csv_writer.writerow(self._csv_row(record))
+
+    def _csv_row(self, record):
+        record = dict(record)
+        aws_keys = record.pop('aws_keys')
+        record['s3_keys'] = [k for k, l in aws_keys.items() if 's3' in l]
+        record['glacier_keys'] = [k for k, l in aws_keys.items()
+                                  if 'glacier' in l]
+        row = []
+        for field in self.CSV_FIELDS:
+            value = record.get(field)
+            if isinstance(value, list):
+                value = ' '.join(sorted(value))
+            if value is None:
+                value = ''
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            row.append(value)
+        return row
+
+    def flush(self):
+        self.out.flush()
+
+def build_object_stat(read_conn, bag_name):
+    """
+    Returns an ObjectStat describing the state of the specified bag
+    and all of its files.
+    """
+    obj_stat = new_object_stat(read_conn, bag_name)
+    for filestat in iter_file_stats(read_conn, bag_name):
+        obj_stat.add_file(filestat)
+    return obj_stat
+
+# Queries for the default, per-bag mode. These run once per bag,
+# or once per file, so each must be an indexed lookup.
+# check_query_plans.py checks that they are.
+# Bags are audited, and get their ids, in the order they were added
+# to audit_001_objects. SQL_ENGINE_BAGS_QUERY uses the same order.
+BAG_NAMES_QUERY = "select key from audit_001_objects order by rowid"
+
+OBJECT_QUERY = """select o.error_message, object_identifier from
+audit_001_objects o where o.key = ?"""
+
+UNPACKED_FILES_QUERY = """select iuf.file_path, s3.size from ingest_unpacked_files iuf
+inner join ingest_tar_results itr on itr.id = iuf.ingest_tar_result_id
+inner join ingest_s3_files s3 on s3.ingest_record_id = itr.ingest_record_id
+where s3.key = ? and iuf.file_path like 'data/%'"""
+
+BAG_KEY_QUERY = "select bag_key from audit_001_objects where key = ? limit 1"
+
+FEDORA_URL_QUERY = """select f.fedora_file_uri, f.gf_identifier from audit_001_files f
+inner join ingest_s3_files s3 on s3.ingest_record_id = f.ingest_record_id
+where s3.key = ? and f.gf_file_path = ?"""
+
+AWS_KEYS_QUERY = """select k.name, m2.value from s3_keys k
+inner join s3_meta m2 on m2.key_id = k.id
+where k.bucket=?
+and k.deleted_at is null
+and k.bag_key = ?
+and m2.name='bagpath' and m2.value = ?"""
+
+def new_object_stat(read_conn, bag_name):
+    """
+    Returns an ObjectStat for the specified bag, without any files.
+    """
     values = (bag_name,)
     c = read_conn.cursor()
-
-    query = """select o.error_message, object_identifier from
-    audit_001_objects o where o.key = ?"""
-    c.execute(query, values)
+    c.execute(OBJECT_QUERY, values)
     row = c.fetchone()
+    c.close()
     error_message = row[0]
 
     obj_stat = ObjectStat(bag_name, error_message)
     obj_stat.identifier = row[1]
+    return obj_stat
 
-    # Get a list of files that were unpacked from the tar bag.
-    query = """select iuf.file_path, s3.size from ingest_unpacked_files iuf
-    inner join ingest_tar_results itr on itr.id = iuf.ingest_tar_result_id
-    inner join ingest_s3_files s3 on s3.ingest_record_id = itr.ingest_record_id
-    where s3.key = ? and iuf.file_path like 'data/%'"""
-    c.execute(query, values)
-    rows = c.fetchall()
-    for row in rows:
-        filestat = FileStat(row[0], row[1])
-        obj_stat.add_file(filestat)
+def iter_file_stats(read_conn, bag_name):
+    """
+    Yields a FileStat for each file that was unpacked from the tar bag,
+    including what Fedora, S3 and Glacier know about the file.
+    """
+    values = (bag_name,)
+    files = read_conn.cursor()
+    c = read_conn.cursor()
 
+    # Get a list of files that were unpacked from the tar bag.
+    files.execute(UNPACKED_FILES_QUERY, values)
 
-    bag_name_without_tar = bag_name.rstrip('.tar')
+    c.execute(BAG_KEY_QUERY, values)
+    bag_key = c.fetchone()[0]
 
     # For each file...
-    for filestat in obj_stat.files:
+    for row in files:
+        filestat = FileStat(row[0], row[1])
+
         # ... get the URL stored in Fedora
-        query = query = """select f.fedora_file_uri, f.gf_identifier from audit_001_files f
-        inner join ingest_s3_files s3 on s3.ingest_record_id = f.ingest_record_id
-        where s3.key = ? and f.gf_file_path = ?"""
         values = (bag_name, filestat.path)
-        c.execute(query, values)
+        c.execute(FEDORA_URL_QUERY, values)
         row = c.fetchone()
         filestat.fedora_url = row[0]
         filestat.identifier = row[1]
 
         # ... get the keys stored in S3
-        query = """select k.name, m2.value from s3_keys k
-        inner join s3_meta m on m.key_id = k.id
-        inner join s3_meta m2 on m2.key_id = k.id
-        where k.bucket='aptrust.preservation.storage'
-        and m.name='bag' and m.value = ?
-        and m2.name='bagpath' and m2.value = ?"""
-        values = (bag_name_without_tar, filestat.path)
-        c.execute(query, values)
-        rows = c.fetchall()
-        for row in rows:
-            filestat.add_s3_key(row[0])
+        values = ('aptrust.preservation.storage', bag_key, filestat.path)
+        c.execute(AWS_KEYS_QUERY, values)
+        for key_row in c.fetchall():
+            filestat.add_s3_key(key_row[0])
 
         # ... get the keys stored in Glacier
-        query = """select k.name, m2.value from s3_keys k
-        inner join s3_meta m on m.key_id = k.id
-        inner join s3_meta m2 on m2.key_id = k.id
-        where k.bucket='aptrust.preservation.oregon'
-        and m.name='bag' and m.value = ?
-        and m2.name='bagpath' and m2.value = ?"""
-        values = (bag_name_without_tar, filestat.path)
-        c.execute(query, values)
-        rows = c.fetchall()
-        for row in rows:
-            filestat.add_glacier_key(row[0])
+        values = ('aptrust.preservation.oregon', bag_key, filestat.path)
+        c.execute(AWS_KEYS_QUERY, values)
+        for key_row in c.fetchall():
+            filestat.add_glacier_key(key_row[0])
+
+        yield filestat
 
     c.close()
+    files.close()
 
-    if output_type == 'json':
-        print(json.dumps(obj_stat.to_hash(), sort_keys=True, indent=2))
-    else:
-        save_to_db(write_conn, obj_stat)
 
+# Queries for bulk mode. Each returns rows for all of the bags in
+# audit_001_objects, sorted so that iter_object_stats_bulk can
+# merge-join them. The first columns of each query are its sort key.
+# Bags are matched on bag_key (institution/bag_name, without .tar),
+# which every source table has.
+BULK_OBJECTS_QUERY = """select o.bag_key as bag, o.key,
+o.error_message, o.object_identifier
+from audit_001_objects o
+where o.rowid = (select min(o2.rowid) from audit_001_objects o2
+                 where o2.key = o.key)
+order by 1, 2"""
+
+BULK_FILES_QUERY = """select ir.bag_key as bag, s3.key,
+iuf.file_path, s3.size
+from ingest_unpacked_files iuf
+inner join ingest_tar_results itr on itr.id = iuf.ingest_tar_result_id
+inner join ingest_s3_files s3 on s3.ingest_record_id = itr.ingest_record_id
+inner join ingest_records ir on ir.id = s3.ingest_record_id
+where s3.key in (select key from audit_001_objects)
+and iuf.file_path like 'data/%'
+order by 1, 2, 3"""
+
+BULK_URLS_QUERY = """select ir.bag_key as bag, s3.key,
+f.gf_file_path, f.fedora_file_uri, f.gf_identifier
+from audit_001_files f
+inner join ingest_s3_files s3 on s3.ingest_record_id = f.ingest_record_id
+inner join ingest_records ir on ir.id = f.ingest_record_id
+where s3.key in (select key from audit_001_objects)
+order by 1, 2, 3, f.rowid"""
+
+BULK_AWS_KEYS_QUERY = """select k.bag_key as bag, m2.value as bagpath, k.name
+from s3_keys k
+inner join s3_meta m2 on m2.key_id = k.id
+where k.bucket=?
+and k.deleted_at is null
+and k.bag_key in (select bag_key from audit_001_objects)
+and m2.name='bagpath'
+order by 1, 2, 3"""
+
+
+class SortedStream(object):
+    """
+    Wraps a cursor whose rows are sorted by their first key_length
+    columns, so it can be merge-joined against another sorted stream.
+    Only one row is held at a time, apart from the rows for the most
+    recently requested key.
+    """
+    def __init__(self, cursor, key_length):
+        self.rows = iter(cursor)
+        self.key_length = key_length
+        self.row = next(self.rows, None)
+        self.last_key = None
+        self.last_rows = []
+
+    def _row_key(self, row):
+        return tuple(row[i] for i in range(self.key_length))
+
+    def rows_for(self, key):
+        """
+        Returns all rows whose sort key equals key. Calls must be made
+        in ascending key order, though the same key may be requested
+        more than once in a row. Rows with keys smaller than the
+        requested key are skipped.
+        """
+        if key == self.last_key:
+            return self.last_rows
+        rows = []
+        while self.row is not None:
+            row_key = self._row_key(self.row)
+            if row_key > key:
+                break
+            if row_key == key:
+                rows.append(self.row)
+            self.row = next(self.rows, None)
+        self.last_key = key
+        self.last_rows = rows
+        return rows
+
+    def iter_rows(self, key):
+        """
+        Like rows_for, but yields the rows one at a time instead of
+        collecting them, and doesn't remember them.
+        """
+        while self.row is not None:
+            row_key = self._row_key(self.row)
+            if row_key > key:
+                break
+            row = self.row
+            self.row = next(self.rows, None)
+            if row_key == key:
+                yield row
+
+
+def iter_object_stats_bulk(read_conn):
+    """
+    Yields an ObjectStat, with all of its files, for each bag in
+    audit_001_objects. See iter_bags_bulk.
+    """
+    for obj_stat, filestats in iter_bags_bulk(read_conn):
+        for filestat in filestats:
+            obj_stat.add_file(filestat)
+        yield obj_stat
+
+def iter_bags_bulk(read_conn):
+    """
+    Yields an (ObjectStat, filestats) tuple for each bag in
+    audit_001_objects, where filestats is a generator of the bag's
+    FileStats. Instead of several queries per file, this runs one query
+    each for the bags, unpacked files, Fedora URLs, S3 keys and Glacier
+    keys, all sorted by bag name and file path, and assembles the
+    FileStats with a merge-join. Each filestats generator must be used
+    up before moving on to the next bag.
+
+    Unlike report_on_all_files, this yields each bag only once, even if
+    it appears in audit_001_objects more than once, and each bag's files
+    come back sorted by path.
+    """
+    cursors = []
+    def stream(query, key_length, values=()):
+        c = read_conn.cursor()
+        c.execute(query, values)
+        cursors.append(c)
+        return SortedStream(c, key_length)
+
+    files = stream(BULK_FILES_QUERY, 2)
+    urls = stream(BULK_URLS_QUERY, 3)
+    s3_keys = stream(BULK_AWS_KEYS_QUERY, 2, ('aptrust.preservation.storage',))
+    glacier_keys = stream(BULK_AWS_KEYS_QUERY, 2, ('aptrust.preservation.oregon',))
+
+    def iter_bag_files(bag, bag_name):
+        for file_row in files.iter_rows((bag, bag_name)):
+            filestat = FileStat(file_row[2], file_row[3])
+            url_rows = urls.rows_for((bag, bag_name, filestat.path))
+            if url_rows:
+                filestat.fedora_url = url_rows[0][3]
+                filestat.identifier = url_rows[0][4]
+            for key_row in s3_keys.rows_for((bag, filestat.path)):
+                filestat.add_s3_key(key_row[2])
+            for key_row in glacier_keys.rows_for((bag, filestat.path)):
+                filestat.add_glacier_key(key_row[2])
+            yield filestat
+
+    c = read_conn.cursor()
+    c.execute(BULK_OBJECTS_QUERY)
+    cursors.append(c)
+    for row in c:
+        obj_stat = ObjectStat(row[1], row[2])
+        obj_stat.identifier = row[3]
+        yield obj_stat, iter_bag_files(row[0], row[1])
+    for cursor in cursors:
+        cursor.close()
 
-def save_to_db(write_conn, obj_stat):
-    bag_id = save_bag(write_conn, obj_stat.bag_name, obj_stat.identifier)
+def save_to_db(writer, obj_stat):
+    """
+    Queues the actions needed to fix this bag and its files. Param
+    writer is a SummaryWriter, which writes them in batches.
+    """
+    bag_id = writer.bag_id(obj_stat.bag_name, obj_stat.identifier)
     for filestat in obj_stat.files:
         filestat.check_keys()
         for uuid in filestat.s3_keys_to_delete:
-            save_key(write_conn,
-                     bag_id,
-                     'delete',
-                     's3',
-                     filestat.path,
-                     filestat.identifier,
-                     uuid)
+            writer.add_key(bag_id,
+                           'delete',
+                           's3',
+                           filestat.path,
+                           filestat.identifier,
+                           uuid)
         for uuid in filestat.glacier_keys_to_delete:
-            save_key(write_conn,
-                     bag_id,
-                     'delete',
-                     'glacier',
-                     filestat.path,
-                     filestat.identifier,
-                     uuid)
+            writer.add_key(bag_id,
+                           'delete',
+                           'glacier',
+                           filestat.path,
+                           filestat.identifier,
+                           uuid)
         for uuid in filestat.s3_missing_keys:
-            save_key(write_conn,
-                     bag_id,
-                     'add',
-                     's3',
-                     filestat.path,
-                     filestat.identifier,
-                     uuid)
+            writer.add_key(bag_id,
+                           'add',
+                           's3',
+                           filestat.path,
+                           filestat.identifier,
+                           uuid)
         for uuid in filestat.glacier_missing_keys:
-            save_key(write_conn,
-                     bag_id,
-                     'add',
-                     'glacier',
-                     filestat.path,
-                     filestat.identifier,
-                     uuid)
+            writer.add_key(bag_id,
+                           'add',
+                           'glacier',
+                           filestat.path,
+                           filestat.identifier,
+                           uuid)
         if filestat.fedora_url != filestat.fedora_url_should_be:
-            save_url(write_conn,
-                     bag_id,
-                     filestat.path,
-                     filestat.identifier,
-                     filestat.fedora_url,
-                     filestat.fedora_url_should_be)
-
-def save_bag(write_conn, bag_name, bag_identifier):
-    bag_id = None
-    query = "select id from bags where name=?"
-    values = (bag_name,)
-    cursor = write_conn.cursor()
-    cursor.execute(query, values)
-    result = cursor.fetchone()
-    if result and result[0]:
-        bag_id = result[0]
-    if bag_id == None:
-        statement = "insert into bags(name, identifier) values (?, ?)"
-        values = (bag_name, bag_identifier,)
-        cursor.execute(statement, values)
-        write_conn.commit()
-        bag_id = cursor.lastrowid
-    cursor.close()
-    return bag_id
-
-def save_key(write_conn, bag_id, action, storage, file_path, identifier, key):
-    key_id = None
-    query = """select id from aws_files where bag_id=? and action=?
-    and storage=? and file_path=? and key=?"""
-    values = (bag_id, action, storage, file_path, key)
-    cursor = write_conn.cursor()
-    cursor.execute(query, values)
-    result = cursor.fetchone()
-    if result and result[0]:
-        key_id = result[0]
-    if key_id == None:
-        statement = """insert into aws_files(bag_id, action,
+            writer.add_url(bag_id,
+                           filestat.path,
+                           filestat.identifier,
+                           filestat.fedora_url,
+                           filestat.fedora_url_should_be)
+    writer.bag_done()
+
+
+class SummaryWriter(object):
+    """
+    Writes audit actions to audit001_summary.db. Actions are buffered
+    and written with executemany, one transaction per batch of bags.
+    Inserts rely on the unique indexes on aws_files and urls to skip
+    actions that are already recorded, so we don't have to select
+    before every insert.
+    """
+    def __init__(self, write_conn, batch_size=100):
+        self.write_conn = write_conn
+        self.batch_size = batch_size
+        self.bag_ids = {}
+        self.keys = []
+        self.urls = []
+        self.bags_in_batch = 0
+
+    def bag_id(self, bag_name, bag_identifier):
+        """
+        Returns the id of the bag, inserting it if necessary. Ids are
+        cached, so each bag is looked up at most once.
+        """
+        bag_id = self.bag_ids.get(bag_name)
+        if bag_id is not None:
+            return bag_id
+        cursor = self.write_conn.cursor()
+        cursor.execute("select id from bags where name=?", (bag_name,))
+        result = cursor.fetchone()
+        if result and result[0]:
+            bag_id = result[0]
+        else:
+            statement = "insert into bags(name, identifier) values (?, ?)"
+            cursor.execute(statement, (bag_name, bag_identifier,))
+            bag_id = cursor.lastrowid
+        cursor.close()
+        self.bag_ids[bag_name] = bag_id
+        return bag_id
+
+    def add_key(self, bag_id, action, storage, file_path, identifier, key):
+        self.keys.append((bag_id, action, None, storage, file_path,
+                          identifier, key))
+
+    def add_url(self, bag_id, file_path, identifier, old_url, new_url):
+        self.urls.append((bag_id, file_path, identifier, old_url, new_url))
+
+    def bag_done(self):
+        """
+        Call this after queueing all of a bag's actions. Writes the
+        batch when it's full.
+        """
+        self.bags_in_batch += 1
+        if self.bags_in_batch >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes all buffered actions and commits.
+        """
+        statement = """insert or ignore into aws_files(bag_id, action,
         action_completed_at, storage, file_path, identifier, key)
         values (?,?,?,?,?,?,?)"""
-        values = (bag_id, action, None, storage, file_path, identifier, key)
-        cursor.execute(statement, values)
-        write_conn.commit()
-        bag_id = cursor.lastrowid
-    cursor.close()
-    return key_id
-
-
-def save_url(write_conn, bag_id, file_path, identifier, old_url, new_url):
-    url_id = None
-    query = "select id from urls where bag_id=? and file_path=?"
-    values = (bag_id, file_path,)
-    cursor = write_conn.cursor()
-    cursor.execute(query, values)
-    result = cursor.fetchone()
-    if result and result[0]:
-        url_id = result[0]
-    if url_id == None:
-        statement = """insert into urls(bag_id, file_path, identifier,
-        old_url, new_url) values (?,?,?,?,?)"""
-        values = (bag_id, file_path, identifier, old_url, new_url)
-        cursor.execute(statement, values)
-        write_conn.commit()
-        url_id = cursor.lastrowid
-    cursor.close()
-    return url_id
+        self.write_conn.executemany(statement, self.keys)
+        statement = """insert or ignore into urls(bag_id, file_path,
+        identifier, old_url, new_url) values (?,?,?,?,?)"""
+        self.write_conn.executemany(statement, self.urls)
+        self.write_conn.commit()
+        self.keys = []
+        self.urls = []
+        self.bags_in_batch = 0
+
+
+# The SQL engine makes the same decisions as FileStat.check_keys, but
+# for every file at once, using temp tables in the read connection.
+# Each statement builds on the ones before it.
+SQL_ENGINE_STATEMENTS = [
+    """drop table if exists temp.audit_001_sql_files""",
+
+    # One row per unpacked file, with the first Fedora URL we have for
+    # it. Files without a URL need no action, so we leave them out.
+    """create temp table audit_001_sql_files as
+    select u.bag_name, u.file_path, f.fedora_url, f.fedora_uuid, f.identifier
+    from (select distinct s3.key as bag_name, iuf.file_path
+          from ingest_unpacked_files iuf
+          inner join ingest_tar_results itr on itr.id = iuf.ingest_tar_result_id
+          inner join ingest_s3_files s3 on s3.ingest_record_id = itr.ingest_record_id
+          where s3.key in (select key from audit_001_objects)
+          and iuf.file_path like 'data/%') u
+    inner join (select s3.key as bag_name, f.gf_file_path as file_path,
+                f.fedora_file_uri as fedora_url, f.fedora_file_uuid as fedora_uuid,
+                f.gf_identifier as identifier,
+                row_number() over (partition by s3.key, f.gf_file_path
+                                   order by f.rowid) as n
+                from audit_001_files f
+                inner join ingest_s3_files s3
+                on s3.ingest_record_id = f.ingest_record_id
+                where s3.key in (select key from audit_001_objects)) f
+    on f.bag_name = u.bag_name and f.file_path = u.file_path and f.n = 1
+    where f.fedora_url is not null""",
+
+    """drop table if exists temp.audit_001_sql_key_locations""",
+
+    # One row per file and key, saying whether the key is in S3,
+    # Glacier or both.
+    """create temp table audit_001_sql_key_locations as
+    select o.key as bag_name, m2.value as file_path, k.name as key,
+    max(k.bucket = 'aptrust.preservation.storage') as in_s3,
+    max(k.bucket = 'aptrust.preservation.oregon') as in_glacier
+    from (select distinct key, bag_key from audit_001_objects) o
+    inner join s3_keys k on k.bag_key = o.bag_key
+    inner join s3_meta m2 on m2.key_id = k.id and m2.name = 'bagpath'
+    where k.bucket in ('aptrust.preservation.storage',
+                       'aptrust.preservation.oregon')
+    and k.deleted_at is null
+    group by o.key, m2.value, k.name""",
+
+    """create index temp.ix_audit_001_sql_key_locations
+    on audit_001_sql_key_locations(bag_name, file_path)""",
+
+    """drop table if exists temp.audit_001_sql_decisions""",
+
+    # What the URL should be. Like check_keys, prefer the key in the
+    # Fedora URL if it's in both S3 and Glacier. Otherwise, point the
+    # URL at the last key (in sort order) that's in both. Otherwise,
+    # leave the URL alone.
+    """create temp table audit_001_sql_decisions as
+    select bag_name, file_path, identifier, fedora_url,
+    case when keep_in_url is not null then fedora_url
+         when keep_other is not null then
+              replace(fedora_url, fedora_uuid, keep_other)
+         else fedora_url end as fedora_url_should_be
+    from (select f.bag_name, f.file_path, f.identifier, f.fedora_url,
+          f.fedora_uuid,
+          max(case when l.in_s3 and l.in_glacier
+                   and instr(f.fedora_url, l.key) > 0 then l.key end) as keep_in_url,
+          max(case when l.in_s3 and l.in_glacier
+                   and instr(f.fedora_url, l.key) = 0 then l.key end) as keep_other
+          from audit_001_sql_files f
+          left join audit_001_sql_key_locations l
+          on l.bag_name = f.bag_name and l.file_path = f.file_path
+          group by f.bag_name, f.file_path)""",
+]
+
+# Rows for aws_files: one per key to delete from or add to S3 or Glacier.
+SQL_ENGINE_KEY_ACTIONS_QUERY = """select d.bag_name as bag_name,
+case when instr(d.fedora_url_should_be, l.key) = 0
+     then 'delete' else 'add' end as action,
+s.storage as storage, d.file_path as file_path,
+d.identifier as identifier, l.key as key
+from audit_001_sql_decisions d
+inner join audit_001_sql_key_locations l
+on l.bag_name = d.bag_name and l.file_path = d.file_path
+inner join (select 's3' as storage union all select 'glacier') s
+where case when instr(d.fedora_url_should_be, l.key) = 0
+           then (s.storage = 's3' and l.in_s3)
+                or (s.storage = 'glacier' and l.in_glacier)
+           else (s.storage = 's3' and not l.in_s3)
+                or (s.storage = 'glacier' and not l.in_glacier) end"""
+
+# Rows for urls: one per file whose Fedora URL should change.
+SQL_ENGINE_URL_ACTIONS_QUERY = """select bag_name, file_path, identifier,
+fedora_url, fedora_url_should_be
+from audit_001_sql_decisions
+where fedora_url != fedora_url_should_be"""
+
+# Rows for bags, in the same order report_on_all_files would insert
+# them: the order of BAG_NAMES_QUERY, without repeats.
+SQL_ENGINE_BAGS_QUERY = """select o.key, o.object_identifier
+from audit_001_objects o
+where o.rowid = (select min(o2.rowid) from audit_001_objects o2
+                 where o2.key = o.key)
+order by o.rowid"""
+
+
+def build_sql_decisions(read_conn):
+    """
+    Runs the SQL engine's statements, leaving its results in temp
+    tables on read_conn.
+    """
+    for statement in SQL_ENGINE_STATEMENTS:
+        read_conn.execute(statement)
+
+def save_actions_sql(read_conn, write_db_path):
+    """
+    Computes the audit actions for all bags in SQL and writes them
+    straight into the bags, aws_files and urls tables of the summary
+    database, which must already exist. See create_db.
+    """
+    build_sql_decisions(read_conn)
+    read_conn.execute("attach database ? as summary", (write_db_path,))
+    read_conn.execute("""insert or ignore into summary.bags(name, identifier)
+    """ + SQL_ENGINE_BAGS_QUERY)
+    read_conn.execute("""insert or ignore into summary.aws_files(bag_id,
+    action, action_completed_at, storage, file_path, identifier, key)
+    select b.id, a.action, null, a.storage, a.file_path, a.identifier, a.key
+    from (""" + SQL_ENGINE_KEY_ACTIONS_QUERY + """) a
+    inner join summary.bags b on b.name = a.bag_name
+    order by b.id, a.file_path, a.action, a.storage, a.key""")
+    read_conn.execute("""insert or ignore into summary.urls(bag_id,
+    file_path, identifier, old_url, new_url)
+    select b.id, u.file_path, u.identifier, u.fedora_url, u.fedora_url_should_be
+    from (""" + SQL_ENGINE_URL_ACTIONS_QUERY + """) u
+    inner join summary.bags b on b.name = u.bag_name
+    order by b.id, u.file_path""")
+    read_conn.commit()
+    read_conn.execute("detach database summary")
+
+
+class ActionCollector(object):
+    """
+    Stands in for SummaryWriter, but collects actions in sets instead of
+    writing them, so cross_check can compare them with the SQL engine's.
+    """
+    def __init__(self):
+        self.bags = set()
+        self.keys = set()
+        self.urls = set()
+
+    def bag_id(self, bag_name, bag_identifier):
+        self.bags.add((bag_name, bag_identifier))
+        return bag_name
+
+    def add_key(self, bag_id, action, storage, file_path, identifier, key):
+        self.keys.add((bag_id, action, storage, file_path, identifier, key))
+
+    def add_url(self, bag_id, file_path, identifier, old_url, new_url):
+        self.urls.add((bag_id, file_path, identifier, old_url, new_url))
+
+    def bag_done(self):
+        pass
+
+    def flush(self):
+        pass
+
+def cross_check(read_conn):
+    """
+    Computes the audit actions with both FileStat.check_keys and the SQL
+    engine, and prints any differences to stderr. Returns True if the
+    two produce exactly the same bags, aws_files and urls rows.
+    """
+    python = ActionCollector()
+    for obj_stat in iter_object_stats_bulk(read_conn):
+        save_to_db(python, obj_stat)
+    build_sql_decisions(read_conn)
+    comparisons = [
+        ('bags', python.bags, SQL_ENGINE_BAGS_QUERY),
+        ('aws_files', python.keys, SQL_ENGINE_KEY_ACTIONS_QUERY),
+        ('urls', python.urls, SQL_ENGINE_URL_ACTIONS_QUERY),
+    ]
+    identical = True
+    for table, python_rows, query in comparisons:
+        sql_rows = set(tuple(row) for row in read_conn.execute(query))
+        only_python = sorted(python_rows - sql_rows)
+        only_sql = sorted(sql_rows - python_rows)
+        sys.stderr.write("{0}: {1} rows from Python, {2} rows from SQL, "
+                         "{3} only from Python, {4} only from SQL\n".format(
+                             table, len(python_rows), len(sql_rows),
+                             len(only_python), len(only_sql)))
+        for row in only_python[:20]:
+            sys.stderr.write("    Python only: {0}\n".format(row))
+        for row in only_sql[:20]:
+            sys.stderr.write("    SQL only:    {0}\n".format(row))
+        if only_python or only_sql:
+            identical = False
+    return identical
 
 
 def create_db(write_conn):
@@ -513,6 +1158,10 @@ def create_db(write_conn):
     file_path varchar(255) not null,
     identifier varchar(255) not null,
     key varchar(80) not null,
+    lease_owner varchar(80) null,
+    lease_expires_at datetime null,
+    attempts integer not null default 0,
+    last_error varchar(255) null,
     FOREIGN KEY(bag_id)
     REFERENCES bags(id));"""
     write_conn.execute(statement)
@@ -538,31 +1187,100 @@ def create_db(write_conn):
     write_conn.execute(statement)
     write_conn.commit()
 
+    print("Creating unique index ix_aws_files_unique on aws_files")
+    statement = """create unique index ix_aws_files_unique
+    on aws_files(bag_id, action, storage, file_path, key)"""
+    write_conn.execute(statement)
+    write_conn.commit()
+
+    # cleanup_001.py claims pending rows by action and lease expiry.
+    print("Creating index ix_aws_files_queue on aws_files")
+    statement = """create index ix_aws_files_queue
+    on aws_files(action, action_completed_at, lease_expires_at)"""
+    write_conn.execute(statement)
+    write_conn.commit()
+
     c.close()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Run audit on ingest errors')
     parser.add_argument('--output', default='sql',
-                        help="Output 'json' or 'sql'")
+                        help="Output 'json', 'ndjson', 'csv' or 'sql'")
+    parser.add_argument('--bulk', action='store_true',
+                        help="Fetch data for all bags in a few sorted "
+                        "queries instead of several queries per file")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of processes to audit bags in")
+    parser.add_argument('--engine', default='python',
+                        help="Decide actions with 'python' (FileStat.check_keys) "
+                        "or 'sql' (set-based queries over all files at once)")
+    parser.add_argument('--cross-check', action='store_true',
+                        help="Run both engines, report any differences, and "
+                        "exit with status 1 if they don't match")
     parser.add_argument("bag_name", nargs='?')
+    add_metrics_arguments(parser)
     args = parser.parse_args()
 
-    if args.output != 'sql' and args.output != 'json':
-        print("Option --output must be either 'json' or 'sql'")
+    if args.output not in ['sql', 'json'] + STREAMING_OUTPUTS:
+        print("Option --output must be 'json', 'ndjson', 'csv' or 'sql'")
         sys.exit(0)
     if args.output == 'sql' and args.bag_name:
         print("I don't do sql for just one bag. Try omitting the bag name.")
         sys.exit(0)
+    if args.bulk and args.bag_name:
+        print("Option --bulk is for reporting on all bags. Try omitting the bag name.")
+        sys.exit(0)
+    if args.workers > 1 and args.bag_name:
+        print("Option --workers is for reporting on all bags. Try omitting the bag name.")
+        sys.exit(0)
+    if args.workers > 1 and args.bulk:
+        print("Options --workers and --bulk can't be used together.")
+        sys.exit(0)
+    if args.engine not in ['python', 'sql']:
+        print("Option --engine must be either 'python' or 'sql'")
+        sys.exit(0)
+    if args.engine == 'sql' and (args.output != 'sql' or args.bag_name or
+                                 args.bulk or args.workers > 1):
+        print("Option --engine sql only writes sql output for all bags.")
+        sys.exit(0)
 
-    read_conn = sqlite3.connect('db/aptrust.db')
+    metrics = metrics_from_args('audit_001', args)
+    read_conn = sqlite3.connect(READ_DB_PATH)
     read_conn.row_factory = sqlite3.Row
-    write_conn = sqlite3.connect('db/audit001_summary.db')
+    register_functions(read_conn)
+    if args.cross_check:
+        with metrics.stage('cross_check'):
+            identical = cross_check(read_conn)
+        read_conn.close()
+        metrics.finish()
+        sys.exit(0 if identical else 1)
+    write_conn = sqlite3.connect(WRITE_DB_PATH)
+    # JSON is printed as each bag is done, so it needs no writer.
+    writer = None
+    if args.output in STREAMING_OUTPUTS:
+        writer = ReportWriter(sys.stdout, args.output)
+    elif args.output == 'sql':
+        writer = SummaryWriter(write_conn)
     if args.bag_name:
-        build_summary(read_conn, write_conn, args.bag_name, args.output)
+        with metrics.stage('audit'):
+            build_summary(read_conn, writer, args.bag_name, args.output)
+        metrics.progress()
     else:
         if args.output == 'sql':
-            create_db(write_conn)
-        report_on_all_files(read_conn, write_conn, args.output)
+            with metrics.stage('create_db'):
+                create_db(write_conn)
+        if args.engine == 'sql':
+            with metrics.stage('sql_engine'):
+                save_actions_sql(read_conn, WRITE_DB_PATH)
+        elif args.bulk:
+            report_on_all_files_bulk(read_conn, writer, args.output, metrics)
+        else:
+            report_on_all_files(read_conn, writer, args.output,
+                                args.workers, metrics)
+    if writer is not None:
+        with metrics.stage('flush'):
+            writer.flush()
     read_conn.close()
     write_conn.close()
+    metrics.finish()
@@ -0,0 +1,136 @@
+-- audit_001_rollups.sql
+--
+-- Per-institution counts for the audit report. Run this after
+-- build_audit_001_tables.sql.
+--
+-- audit_001_institution_summary counts the failed bags, their files,
+-- and their problem files for each institution. institution_file_counts
+-- counts every active object and file, and their bytes.
+--
+-- Usage:
+--
+-- sqlite3 db/aptrust.db < audit_001_rollups.sql
+--
+-- or, to run both scripts on DuckDB's engine:
+--
+-- python3 duckdb_audit.py build_audit_001_tables.sql audit_001_rollups.sql
+--
+
+drop table if exists audit_001_institution_summary;
+drop table if exists institution_file_counts;
+
+
+create table audit_001_institution_summary (
+  institution_id int,
+  institution_identifier varchar(80),
+  failed_bags int not null default 0,
+  files int not null default 0,
+  files_missing_s3 int not null default 0,
+  files_missing_glacier int not null default 0,
+  files_missing_fedora int not null default 0,
+  problem_files int not null default 0,
+  duplicate_s3 int not null default 0,
+  duplicate_glacier int not null default 0,
+  missing_s3 int not null default 0,
+  missing_glacier int not null default 0
+);
+
+-- audit_001_objects can have more than one row per ingest record,
+-- so files are counted against the distinct records. Each bag, file
+-- and problem file is one row of x, and the rows are added up by
+-- institution in a single pass.
+insert into audit_001_institution_summary (
+  institution_id,
+  institution_identifier,
+  failed_bags,
+  files,
+  files_missing_s3,
+  files_missing_glacier,
+  files_missing_fedora,
+  problem_files,
+  duplicate_s3,
+  duplicate_glacier,
+  missing_s3,
+  missing_glacier)
+select i.id,
+       i.identifier,
+       count(distinct x.ingest_record_id),
+       sum(x.files),
+       sum(x.files_missing_s3),
+       sum(x.files_missing_glacier),
+       sum(x.files_missing_fedora),
+       sum(x.problem_files),
+       sum(x.duplicate_s3),
+       sum(x.duplicate_glacier),
+       sum(x.missing_s3),
+       sum(x.missing_glacier)
+from (
+  select distinct institution_id, ingest_record_id,
+         0 as files, 0 as files_missing_s3, 0 as files_missing_glacier,
+         0 as files_missing_fedora, 0 as problem_files, 0 as duplicate_s3,
+         0 as duplicate_glacier, 0 as missing_s3, 0 as missing_glacier
+  from audit_001_objects
+  union all
+  select r.institution_id, r.ingest_record_id,
+         1,
+         case when f.s3_key is null then 1 else 0 end,
+         case when f.glacier_key is null then 1 else 0 end,
+         case when f.fedora_file_id is null then 1 else 0 end,
+         0, 0, 0, 0, 0
+  from (select distinct ingest_record_id, institution_id
+        from audit_001_objects) r
+  cross join audit_001_files f
+  where f.ingest_record_id = r.ingest_record_id
+  union all
+  select r.institution_id, r.ingest_record_id,
+         0, 0, 0, 0,
+         1,
+         case when p.duplicate_s3 = 1 then 1 else 0 end,
+         case when p.duplicate_glacier = 1 then 1 else 0 end,
+         case when p.missing_s3 = 1 then 1 else 0 end,
+         case when p.missing_glacier = 1 then 1 else 0 end
+  from (select distinct ingest_record_id, institution_id
+        from audit_001_objects) r
+  cross join audit_001_problem_files p
+  where p.ingest_record_id = r.ingest_record_id) x
+cross join institutions i
+where i.id = x.institution_id
+group by i.id, i.identifier;
+
+
+create table institution_file_counts (
+  institution_id int,
+  institution_identifier varchar(80),
+  objects int not null default 0,
+  files int not null default 0,
+  bytes bigint not null default 0
+);
+
+-- Every institution gets a row, even with no active objects.
+-- plan: allow scan objects files
+insert into institution_file_counts (
+  institution_id,
+  institution_identifier,
+  objects,
+  files,
+  bytes)
+select i.id,
+       i.identifier,
+       sum(x.objects),
+       sum(x.files),
+       coalesce(sum(x.bytes), 0)
+from (
+  select id as institution_id, 0 as objects, 0 as files, 0 as bytes
+  from institutions
+  union all
+  select institution_id, 1, 0, 0
+  from objects
+  where state = 'A'
+  union all
+  select o.institution_id, 0, 1, f.size
+  from files f
+  inner join objects o on o.id = f.object_id
+  where f.state = 'A' and o.state = 'A') x
+cross join institutions i
+where i.id = x.institution_id
+group by i.id, i.identifier;
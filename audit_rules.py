@@ -0,0 +1,234 @@
+#! /usr/bin/env python
+# audit_rules.py
+"""
+A single-pass audit engine. Instead of writing a new SQL build script
+and a new Python walker for every audit, register rules here (or in
+another module that imports this one) and run them all in one scan
+of the file_reconciliation table (see reconcile_files.py), which has
+one row per generic file recorded in the ingest logs, with what Fedora,
+S3 and Glacier know about that file. That table is refreshed before
+each run, so only files whose source records changed are recalculated.
+
+A rule is a function that takes a row of file_reconciliation and returns
+None if the file passes, or a string describing the problem. Every
+problem is written to the findings table, tagged with the rule name
+and the audit run it came from.
+
+    @rule('md5_mismatch')
+    def md5_mismatch(row):
+        if row['fedora_md5'] and row['fedora_md5'] != row['md5']:
+            return "Fedora md5 {0} != ingest md5 {1}".format(...)
+
+Usage:
+
+python audit_rules.py                      # run all rules
+python audit_rules.py --rules not_in_glacier,md5_mismatch
+python audit_rules.py --rebuild            # rebuild file_reconciliation first
+python audit_rules.py --list               # list registered rules
+"""
+import argparse
+import sqlite3
+import sys
+from datetime import datetime
+
+import reconcile_files
+from compact_text import register_functions
+from metrics import add_metrics_arguments, metrics_from_args
+from reconcile_files import S3_BUCKET, GLACIER_BUCKET
+
+# Findings are written in batches of this many rows.
+BATCH_SIZE = 5000
+
+# Registered rules, in registration order: (name, function)
+RULES = []
+
+def rule(name):
+    """
+    Decorator that registers a rule function under the given name.
+    """
+    def register(function):
+        RULES.append((name, function))
+        return function
+    return register
+
+
+#------------------------------------------------------------------------
+# Rules
+#------------------------------------------------------------------------
+
+@rule('not_in_fedora')
+def not_in_fedora(row):
+    if not row['in_fedora']:
+        return "No Fedora record for {0}".format(row['identifier'])
+
+@rule('not_in_s3')
+def not_in_s3(row):
+    if not row['in_s3']:
+        return "UUID {0} is not in {1}".format(row['uuid'], S3_BUCKET)
+
+@rule('not_in_glacier')
+def not_in_glacier(row):
+    if not row['in_glacier']:
+        return "UUID {0} is not in {1}".format(row['uuid'], GLACIER_BUCKET)
+
+@rule('storage_url_mismatch')
+def storage_url_mismatch(row):
+    if row['storage_uuid'] is not None and row['storage_uuid'] != row['uuid']:
+        return "Storage URL {0} does not end with UUID {1}".format(
+            row['storage_url'], row['uuid'])
+
+@rule('fedora_uri_mismatch')
+def fedora_uri_mismatch(row):
+    if row['fedora_uuid'] is not None and row['fedora_uuid'] != row['uuid']:
+        return "Fedora URI {0} does not end with UUID {1}".format(
+            row['fedora_uri'], row['uuid'])
+
+@rule('md5_mismatch')
+def md5_mismatch(row):
+    if row['fedora_md5'] is not None and row['fedora_md5'] != row['md5']:
+        return "Fedora md5 {0} does not match ingest md5 {1}".format(
+            row['fedora_md5'], row['md5'])
+
+@rule('sha256_mismatch')
+def sha256_mismatch(row):
+    if (row['fedora_sha256'] is not None and
+            row['fedora_sha256'] != row['sha256']):
+        return "Fedora sha256 {0} does not match ingest sha256 {1}".format(
+            row['fedora_sha256'], row['sha256'])
+
+@rule('size_mismatch')
+def size_mismatch(row):
+    problems = []
+    for source in ['fedora', 's3', 'glacier']:
+        size = row[source + '_size']
+        if size is not None and size != row['size']:
+            problems.append("{0} size {1}".format(source, size))
+    if problems:
+        return "Ingest size {0} does not match {1}".format(
+            row['size'], ", ".join(problems))
+
+
+#------------------------------------------------------------------------
+# Engine
+#------------------------------------------------------------------------
+
+def run_rules(conn, rules, metrics=None):
+    """
+    Streams every row of file_reconciliation once, runs each of the rules
+    against it, and writes the problems to the findings table. Progress
+    goes to metrics, if given. Returns the id of the audit run.
+    """
+    create_findings_tables(conn)
+    rule_names = ",".join([name for name, function in rules])
+    c = conn.cursor()
+    c.execute("insert into audit_runs(started_at, rules) values (?,?)",
+              (datetime.utcnow(), rule_names))
+    run_id = c.lastrowid
+    conn.commit()
+
+    statement = """insert into findings(run_id, rule, generic_file_id,
+    identifier, detail) values (?,?,?,?,?)"""
+    rows_scanned = 0
+    findings = []
+    finding_count = 0
+    if metrics:
+        metrics.set_totals(total=conn.execute(
+            "select count(*) from file_reconciliation").fetchone()[0])
+    c.execute("select * from file_reconciliation")
+    for row in c:
+        rows_scanned += 1
+        for name, function in rules:
+            detail = function(row)
+            if detail:
+                findings.append((run_id, name, row['generic_file_id'],
+                                 row['identifier'], detail))
+        if len(findings) >= BATCH_SIZE:
+            conn.executemany(statement, findings)
+            finding_count += len(findings)
+            findings = []
+        if metrics:
+            metrics.progress()
+    conn.executemany(statement, findings)
+    finding_count += len(findings)
+    c.close()
+
+    conn.execute("""update audit_runs set finished_at=?, rows_scanned=?,
+    finding_count=? where id=?""", (datetime.utcnow(), rows_scanned,
+                                   finding_count, run_id))
+    conn.commit()
+    print("Scanned {0} files. Recorded {1} findings as run {2}".format(
+        rows_scanned, finding_count, run_id))
+    return run_id
+
+def create_findings_tables(conn):
+    conn.execute("""create table if not exists audit_runs(
+    id integer primary key autoincrement,
+    started_at datetime,
+    finished_at datetime,
+    rules text,
+    rows_scanned int,
+    finding_count int)""")
+    conn.execute("""create table if not exists findings(
+    id integer primary key autoincrement,
+    run_id int not null,
+    rule varchar(80) not null,
+    generic_file_id int,
+    identifier varchar(255),
+    detail text,
+    FOREIGN KEY(run_id) REFERENCES audit_runs(id))""")
+    conn.execute("""create index if not exists ix_findings_run_id_rule
+    on findings(run_id, rule)""")
+    conn.execute("""create index if not exists ix_findings_identifier
+    on findings(identifier)""")
+    conn.commit()
+
+def select_rules(names):
+    """
+    Returns the registered rules with the given names, or all rules
+    if names is None.
+    """
+    if names is None:
+        return list(RULES)
+    registered = dict(RULES)
+    selected = []
+    for name in names.split(','):
+        if name not in registered:
+            raise RuntimeError("No rule named {0}".format(name))
+        selected.append((name, registered[name]))
+    return selected
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Run audit rules against every file in one scan')
+    parser.add_argument('--rules',
+                        help="Comma-separated names of rules to run. "
+                        "Runs all rules if omitted.")
+    parser.add_argument('--rebuild', action='store_true',
+                        help="Rebuild file_reconciliation from scratch "
+                        "instead of refreshing only changed files")
+    parser.add_argument('--list', action='store_true',
+                        help="List the registered rules and exit")
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    if args.list:
+        for name, function in RULES:
+            print(name)
+        sys.exit(0)
+    try:
+        rules = select_rules(args.rules)
+    except RuntimeError as err:
+        print(err)
+        sys.exit(1)
+
+    metrics = metrics_from_args('audit_rules', args)
+    conn = sqlite3.connect('db/aptrust.db')
+    conn.row_factory = sqlite3.Row
+    register_functions(conn)
+    with metrics.stage('refresh'):
+        reconcile_files.refresh(conn, args.rebuild)
+    with metrics.stage('rules'):
+        run_rules(conn, rules, metrics)
+    conn.close()
+    metrics.finish()
@@ -0,0 +1,190 @@
+#! /usr/bin/env python
+# audit_shards.py
+"""
+Runs the first audit over the per-institution shards that
+shard_by_institution.py writes to db/shards, one shard per process,
+and puts the results of all the shards together in
+db/audit001_summary.db, just as audit_001.py would for aptrust.db.
+
+In each shard, this runs build_audit_001_tables.sql and then the
+audit, which writes the shard's actions to its own summary database,
+db/shards/<institution>.audit001_summary.db. When all the shards are
+done, their bags, aws_files and urls are copied into
+db/audit001_summary.db, sorted by institution, with new bag ids.
+
+With --institution, only the named institutions' shards are opened,
+and db/audit001_summary.db holds only their actions.
+
+Usage:
+
+python audit_shards.py
+python audit_shards.py --workers 4 --engine sql
+python audit_shards.py --institution test.edu
+"""
+import argparse
+import glob
+import multiprocessing
+import os
+import sqlite3
+import sys
+import time
+
+import audit_001
+from compact_text import register_functions
+from metrics import Metrics, add_metrics_arguments, metrics_from_args
+from shard_by_institution import SHARD_DIR, shard_path
+
+SUMMARY_SUFFIX = '.audit001_summary.db'
+
+BUILD_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'build_audit_001_tables.sql')
+
+
+def summary_path(identifier, shard_dir=SHARD_DIR):
+    """
+    Returns the path of the summary database for an institution's shard.
+    """
+    return os.path.join(shard_dir, identifier.lower() + SUMMARY_SUFFIX)
+
+def shard_institutions(shard_dir=SHARD_DIR):
+    """
+    Returns the identifiers of the institutions that have a shard in
+    shard_dir, sorted.
+    """
+    identifiers = []
+    for path in glob.glob(os.path.join(shard_dir, '*.db')):
+        name = os.path.basename(path)
+        if not name.endswith(SUMMARY_SUFFIX):
+            identifiers.append(name[:-len('.db')])
+    return sorted(identifiers)
+
+def audit_shard(task):
+    """
+    Builds the audit tables in one shard and audits it. Runs in a
+    worker process. Returns the institution identifier, the number of
+    bags audited and the seconds it took.
+    """
+    identifier, shard_dir, engine, bulk = task
+    start = time.time()
+    read_conn = sqlite3.connect(shard_path(identifier, shard_dir))
+    read_conn.row_factory = sqlite3.Row
+    register_functions(read_conn)
+    with open(BUILD_SCRIPT) as f:
+        read_conn.executescript(f.read())
+    write_path = summary_path(identifier, shard_dir)
+    write_conn = sqlite3.connect(write_path)
+    audit_001.create_db(write_conn)
+    if engine == 'sql':
+        audit_001.save_actions_sql(read_conn, write_path)
+    else:
+        writer = audit_001.SummaryWriter(write_conn)
+        metrics = Metrics('audit_001 ' + identifier)
+        if bulk:
+            audit_001.report_on_all_files_bulk(read_conn, writer, 'sql',
+                                               metrics)
+        else:
+            audit_001.report_on_all_files(read_conn, writer, 'sql', 1,
+                                          metrics)
+        writer.flush()
+    bags = write_conn.execute("select count(*) from bags").fetchone()[0]
+    read_conn.close()
+    write_conn.close()
+    return identifier, bags, time.time() - start
+
+def union_summaries(write_conn, identifiers, shard_dir=SHARD_DIR):
+    """
+    Copies the bags, aws_files and urls of each shard's summary
+    database into write_conn, which must have the tables create_db
+    makes. Bags get new ids, and the actions follow them. Two
+    institutions can upload tars with the same name. As in
+    audit_001.SummaryWriter.bag_id, the first bag with a name keeps it,
+    and the actions of later ones join it by name.
+    """
+    for identifier in identifiers:
+        write_conn.execute("attach database ? as shard",
+                           (summary_path(identifier, shard_dir),))
+        write_conn.execute("""insert or ignore into bags(name, identifier)
+        select name, identifier from shard.bags order by id""")
+        write_conn.execute("""insert or ignore into aws_files(bag_id, action,
+        action_completed_at, storage, file_path, identifier, key)
+        select b.id, a.action, a.action_completed_at, a.storage,
+        a.file_path, a.identifier, a.key
+        from shard.aws_files a
+        inner join shard.bags sb on sb.id = a.bag_id
+        inner join main.bags b on b.name = sb.name
+        order by a.id""")
+        write_conn.execute("""insert or ignore into urls(bag_id, file_path,
+        identifier, old_url, new_url)
+        select b.id, u.file_path, u.identifier, u.old_url, u.new_url
+        from shard.urls u
+        inner join shard.bags sb on sb.id = u.bag_id
+        inner join main.bags b on b.name = sb.name
+        order by u.id""")
+        write_conn.commit()
+        write_conn.execute("detach database shard")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Run audit_001 over the per-institution shards '
+        'in parallel')
+    parser.add_argument('--institution', action='append',
+                        help="Identifier of an institution to audit, e.g. "
+                        "test.edu. Repeat for more than one. Defaults to "
+                        "every shard.")
+    parser.add_argument('--workers', type=int,
+                        help="Number of shards to audit at once. Defaults "
+                        "to the number of cores.")
+    parser.add_argument('--engine', default='python',
+                        help="Decide actions with 'python' or 'sql'. "
+                        "See audit_001.py.")
+    parser.add_argument('--bulk', action='store_true',
+                        help="Fetch each shard's data in a few sorted "
+                        "queries. See audit_001.py.")
+    parser.add_argument('--shard-dir', default=SHARD_DIR,
+                        help="Directory the shards are in")
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    if args.engine not in ['python', 'sql']:
+        print("Option --engine must be either 'python' or 'sql'")
+        sys.exit(0)
+    if args.engine == 'sql' and args.bulk:
+        print("Option --bulk is for the python engine.")
+        sys.exit(0)
+    identifiers = shard_institutions(args.shard_dir)
+    if args.institution:
+        wanted = sorted(set(i.lower() for i in args.institution))
+        missing = [i for i in wanted if i not in identifiers]
+        if missing:
+            print("No shard for {0} in {1}. Run shard_by_institution.py "
+                  "first.".format(", ".join(missing), args.shard_dir))
+            sys.exit(1)
+        identifiers = wanted
+    if not identifiers:
+        print("No shards in {0}. Run shard_by_institution.py first.".format(
+            args.shard_dir))
+        sys.exit(1)
+
+    metrics = metrics_from_args('audit_shards', args, total=len(identifiers))
+    workers = min(args.workers or multiprocessing.cpu_count(),
+                  len(identifiers))
+    tasks = [(identifier, args.shard_dir, args.engine, args.bulk)
+             for identifier in identifiers]
+    pool = multiprocessing.Pool(workers)
+    with metrics.stage('audit'):
+        for identifier, bags, seconds in pool.imap_unordered(audit_shard,
+                                                             tasks):
+            print("Audited {0} bags from {1} in {2:.2f}s".format(
+                bags, identifier, seconds))
+            metrics.progress()
+    pool.close()
+    pool.join()
+
+    write_conn = sqlite3.connect(audit_001.WRITE_DB_PATH)
+    with metrics.stage('create_db'):
+        audit_001.create_db(write_conn)
+    with metrics.stage('union'):
+        union_summaries(write_conn, identifiers, args.shard_dir)
+    write_conn.close()
+    metrics.finish()
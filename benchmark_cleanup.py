@@ -0,0 +1,235 @@
+#! /usr/bin/env python
+# benchmark_cleanup.py
+"""
+Runs cleanup_001's copies and deletes against the local S3 stand-in in
+fake_s3.py at several concurrency levels, and checks the results: every
+'add' key must end up in the Glacier bucket, every 'delete' key must be
+gone from the S3 bucket, and every row must be marked as completed.
+
+Use --error-rate to make a fraction of S3 requests fail with 503
+SlowDown, to see the retries at work. Copies use the content type and
+metadata from a crawl of the fake S3 bucket, like cleanup_001 does with
+db/aptrust.db. Use --crawl-coverage to leave some keys out of the crawl,
+so their copies fall back to a HEAD request.
+
+Use --workers to run several cleanup_001 instances against the same
+queue at once, each with its own database connection and worker pool.
+They are threads in this process, because the fake S3 lives in its
+memory, not separate processes. SQLite takes its locks per connection,
+so their claims still contend for "begin immediate" the way separate
+processes would, but the GIL serializes them in between. With no
+injected errors, every copy and every delete must happen exactly once.
+
+Usage:
+
+python benchmark_cleanup.py --keys 5000 --latency 20 --concurrency 1,8,32
+python benchmark_cleanup.py --keys 2000 --error-rate 0.05 --rate 500
+python benchmark_cleanup.py --keys 5000 --concurrency 8 --workers 4
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import audit_001
+import cleanup_001
+import fake_s3
+import s3_buckets_to_sql
+from metrics import Metrics
+
+
+def connect(work_dir):
+    """
+    Opens the summary db in work_dir with the crawl db attached, the
+    way cleanup_001 does.
+    """
+    conn = sqlite3.connect(os.path.join(work_dir, 'audit001_summary.db'),
+                           timeout=60)
+    conn.execute("attach ? as aptrust",
+                 (os.path.join(work_dir, 'aptrust.db'),))
+    return conn
+
+def build_fixture(work_dir, num_keys, latency, error_rate, crawl_coverage):
+    """
+    Returns a fake S3 connection with num_keys keys in the S3 bucket and
+    an empty Glacier bucket, and a summary db with an aws_files row for
+    each key: half to copy to Glacier and half to delete from S3. The
+    summary db has a crawl of the S3 bucket attached as 'aptrust',
+    with crawl_coverage of the keys in it.
+    """
+    s3 = fake_s3.FakeS3Connection(seed=1)
+    va_bucket = fake_s3.build_synthetic_bucket(
+        s3, cleanup_001.VA_BUCKET_NAME, num_keys, seed=1)
+    s3.create_bucket(cleanup_001.OR_BUCKET_NAME)
+    crawl_db_path = os.path.join(work_dir, 'aptrust.db')
+    conn = sqlite3.connect(os.path.join(work_dir, 'audit001_summary.db'))
+    crawl_conn = sqlite3.connect(crawl_db_path)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        audit_001.create_db(conn)
+        s3_buckets_to_sql.list_bucket(cleanup_001.VA_BUCKET_NAME, crawl_conn,
+                                      s3=s3, metrics=Metrics(
+                                          'list_bucket', stream=sys.stdout))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    keep = int(num_keys * crawl_coverage)
+    crawl_conn.execute("delete from s3_meta where key_id > ?", (keep,))
+    crawl_conn.execute("delete from s3_keys where id > ?", (keep,))
+    # merge_dbs.sql gives s3_meta.key_id integer affinity in aptrust.db.
+    # Without it, joins on key_id can't use ix_s3_meta_key_id.
+    crawl_conn.executescript("""
+    alter table s3_meta rename to s3_meta_crawled;
+    create table s3_meta(key_id integer, name varchar(255),
+      value varchar(255));
+    insert into s3_meta select * from s3_meta_crawled;
+    drop table s3_meta_crawled;
+    create index ix_s3_meta_key_id on s3_meta(key_id);""")
+    crawl_conn.commit()
+    crawl_conn.close()
+    # Now that the crawl is done, slow down and break S3 as requested.
+    s3.latency = latency
+    s3.error_rate = error_rate
+    s3.reset_request_counts()
+    rows = []
+    for i, name in enumerate(sorted(va_bucket.keys)):
+        action, storage = ('add', 'glacier') if i % 2 == 0 else ('delete', 's3')
+        rows.append((1, action, storage, "data/file_{0}".format(i),
+                     "test.edu/bag/data/file_{0}".format(i), name))
+    conn.executemany("""insert into aws_files(bag_id, action, storage,
+    file_path, identifier, key) values (?,?,?,?,?,?)""", rows)
+    conn.commit()
+    conn.close()
+    return s3
+
+def run(s3, work_dir, workers, concurrency, rate, retries,
+        retry_base_delay):
+    """
+    Runs workers cleanup_001 instances at once, each in its own thread
+    with its own connection, against the queue in work_dir. Returns the number of actions that failed, the elapsed
+    seconds and the number of retries.
+    """
+    va_bucket = s3.get_bucket(cleanup_001.VA_BUCKET_NAME, validate=False)
+    or_bucket = s3.get_bucket(cleanup_001.OR_BUCKET_NAME, validate=False)
+    metrics = Metrics('cleanup_001', stream=open(os.devnull, 'w'))
+    failures = []
+    def cleanup(worker_id):
+        conn = connect(work_dir)
+        queue = cleanup_001.WorkQueue(conn, worker_id)
+        pool = cleanup_001.ActionPool(concurrency, rate, retries, metrics,
+                                      retry_base_delay)
+        failed = cleanup_001.copy_missing_files_to_glacier(
+            queue, va_bucket, or_bucket, pool)
+        failed += cleanup_001.delete_duplicate_files(queue, va_bucket, pool)
+        failures.append(failed)
+        conn.close()
+    stderr = sys.stderr
+    sys.stderr = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        threads = [threading.Thread(target=cleanup,
+                                    args=("benchmark:{0}".format(i),))
+                   for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+    finally:
+        sys.stderr.close()
+        sys.stderr = stderr
+    if len(failures) < workers:
+        raise RuntimeError("A cleanup_001 instance crashed")
+    return sum(failures), elapsed, metrics.counters.get('retries', 0)
+
+def verify(s3, conn, error_rate):
+    """
+    Returns a list of problems with the results of a run.
+    """
+    va_keys = s3.buckets[cleanup_001.VA_BUCKET_NAME].keys
+    or_keys = s3.buckets[cleanup_001.OR_BUCKET_NAME].keys
+    problems = []
+    if error_rate == 0:
+        # Nothing failed, so nothing should have been done twice.
+        adds = conn.execute("""select count(*) from aws_files
+        where action = 'add'""").fetchone()[0]
+        deletes = conn.execute("""select count(*) from aws_files
+        where action = 'delete'""").fetchone()[0]
+        if s3.request_count('COPY') != adds:
+            problems.append("{0} copies for {1} 'add' rows".format(
+                s3.request_count('COPY'), adds))
+        if s3.deleted_key_count() != deletes:
+            problems.append("{0} keys deleted for {1} 'delete' rows".format(
+                s3.deleted_key_count(), deletes))
+    for pk, action, key, completed_at in conn.execute(
+            "select id, action, key, action_completed_at from aws_files"):
+        if completed_at is None:
+            problems.append("Row {0} was not marked completed".format(pk))
+        elif action == 'add' and key not in or_keys:
+            problems.append("{0} was not copied to Glacier".format(key))
+        elif action == 'add' and (
+                or_keys[key].content_type != va_keys[key].content_type or
+                or_keys[key].metadata != va_keys[key].metadata):
+            problems.append("{0} lost its content type or metadata "
+                            "in the copy".format(key))
+        elif action == 'delete' and key in va_keys:
+            problems.append("{0} was not deleted from S3".format(key))
+    return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmark cleanup_001 against a local fake S3')
+    parser.add_argument('--keys', type=int, default=2000,
+                        help="Number of aws_files rows (half copies, "
+                        "half deletes)")
+    parser.add_argument('--latency', type=float, default=20.0,
+                        help="Milliseconds per simulated S3 request")
+    parser.add_argument('--concurrency', default='1,4,16,32',
+                        help="Comma-separated worker counts to try")
+    parser.add_argument('--rate', type=float, default=0,
+                        help="Max S3 requests per second. 0 means no cap.")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="Fraction of S3 requests that fail with 503")
+    parser.add_argument('--retries', type=int, default=5)
+    parser.add_argument('--retry-base-delay', type=float, default=0.05,
+                        help="Seconds before the first retry")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of cleanup_001 instances sharing "
+                        "the queue")
+    parser.add_argument('--crawl-coverage', type=float, default=1.0,
+                        help="Fraction of keys whose content type and "
+                        "metadata are in the crawl db")
+    args = parser.parse_args()
+
+    print("{0} rows, {1}ms latency, {2} requests/s cap, {3} error rate, "
+          "{4} workers".format(args.keys, args.latency, args.rate or 'no',
+                                 args.error_rate, args.workers))
+    print("{0:>11} {1:>9} {2:>10} {3:>9} {4:>8} {5:>8} {6:>7}".format(
+        'concurrency', 'seconds', 'rows/s', 'requests', 'errors',
+        'retries', 'failed'))
+    all_ok = True
+    for concurrency in [int(c) for c in args.concurrency.split(',')]:
+        work_dir = tempfile.mkdtemp()
+        s3 = build_fixture(work_dir, args.keys, args.latency / 1000.0,
+                           args.error_rate, args.crawl_coverage)
+        failed, elapsed, retries = run(s3, work_dir, args.workers,
+                                       concurrency, args.rate, args.retries,
+                                       args.retry_base_delay)
+        print("{0:>11d} {1:>9.2f} {2:>10.1f} {3:>9d} {4:>8d} {5:>8d} {6:>7d}".format(
+            concurrency, elapsed, args.keys / elapsed, s3.request_count(),
+            s3.error_count(), retries, failed))
+        conn = connect(work_dir)
+        problems = verify(s3, conn, args.error_rate)
+        if failed == 0 and problems:
+            all_ok = False
+            for problem in problems[:10]:
+                print("    " + problem)
+        conn.close()
+        shutil.rmtree(work_dir)
+    sys.exit(0 if all_ok else 1)
@@ -0,0 +1,137 @@
+#! /usr/bin/env python
+# benchmark_fixity.py
+"""
+Runs fixity_check.py's local backend over a directory of synthetic
+files at several thread counts and buffer sizes, and checks that it
+finds the damage we did: one file in 50 has a flipped byte, and one
+in 100 is missing.
+
+The files are written just before the runs, so they're usually in the
+page cache, and this mostly measures hashing. Point --dir at files on
+the storage you care about to include the disk.
+
+Usage:
+
+python benchmark_fixity.py --files 200 --size-mb 4 --threads 1,2,4,8
+python benchmark_fixity.py --buffer-kb 64,1024,8192 --threads 4
+"""
+import argparse
+import hashlib
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+import fixity_check
+
+
+def build_fixture(work_dir, num_files, size):
+    """
+    Writes num_files files of size bytes to work_dir/objects, and
+    returns a connection to work_dir/aptrust.db with a files row and
+    md5 and sha256 checksums rows for each. Returns the expected
+    count of each status too.
+    """
+    rng = random.Random(1)
+    objects_dir = os.path.join(work_dir, 'objects')
+    os.mkdir(objects_dir)
+    conn = sqlite3.connect(os.path.join(work_dir, 'aptrust.db'))
+    conn.execute("""create table files(
+    id integer primary key autoincrement,
+    object_id int,
+    uri varchar(255),
+    size unsigned big int,
+    identifier varchar(255),
+    state char(1),
+    uri_uuid varchar(40))""")
+    conn.execute("""create table checksums(
+    id integer primary key autoincrement,
+    file_id int,
+    algorithm varchar(10),
+    digest varchar(80),
+    date_time datetime)""")
+    conn.execute("create index ix_checksum_file_id on checksums(file_id)")
+    expected = {'ok': 0, 'mismatch': 0, 'missing': 0}
+    for i in range(num_files):
+        uuid = "{0:032x}".format(rng.getrandbits(128))
+        data = os.urandom(size)
+        c = conn.execute("""insert into files(object_id, uri, size,
+        identifier, state, uri_uuid) values (?,?,?,?,?,?)""",
+                         (1, fixity_check.VA_BUCKET_NAME + '/' + uuid, size,
+                          "test.edu/bag/data/file_{0}".format(i), 'A', uuid))
+        for algorithm, digest in [('md5', hashlib.md5(data).hexdigest()),
+                                  ('sha256', hashlib.sha256(data).hexdigest())]:
+            conn.execute("""insert into checksums(file_id, algorithm, digest,
+            date_time) values (?,?,?,?)""",
+                         (c.lastrowid, algorithm, digest,
+                          '2016-01-01T00:00:00Z'))
+        if i % 100 == 99:
+            expected['missing'] += 1
+            continue
+        if i % 50 == 49:
+            data = data[:size // 2] + chr(ord(data[size // 2]) ^ 1) + \
+                data[size // 2 + 1:]
+            expected['mismatch'] += 1
+        else:
+            expected['ok'] += 1
+        with open(os.path.join(objects_dir, uuid), 'wb') as f:
+            f.write(data)
+    conn.commit()
+    return conn, expected
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmark fixity_check on synthetic files')
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--size-mb', type=float, default=4.0,
+                        help="Size of each file in MB")
+    parser.add_argument('--threads', default='1,2,4,8',
+                        help="Comma-separated thread counts to try")
+    parser.add_argument('--buffer-kb', default=str(
+        fixity_check.BUFFER_SIZE // 1024),
+                        help="Comma-separated buffer sizes to try, in KB")
+    parser.add_argument('--dir',
+                        help="Write the files here instead of a "
+                        "temporary directory")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(dir=args.dir)
+    try:
+        conn, expected = build_fixture(work_dir, args.files,
+                                       int(args.size_mb * 1048576))
+        backend = fixity_check.LocalBackend(os.path.join(work_dir, 'objects'))
+        fixity_check.create_tables_if_necessary(conn)
+        print("{0} files of {1} MB".format(args.files, args.size_mb))
+        print("{0:>7} {1:>10} {2:>9} {3:>9} {4:>8} {5:>4}".format(
+            'threads', 'buffer KB', 'seconds', 'MB/s', 'files/s', 'ok'))
+        all_ok = True
+        for buffer_kb in [int(b) for b in args.buffer_kb.split(',')]:
+            for threads in [int(t) for t in args.threads.split(',')]:
+                rows = fixity_check.files_to_check(conn)
+                stderr = sys.stderr
+                sys.stderr = open(os.devnull, 'w')
+                try:
+                    run = fixity_check.check(conn, backend, rows, threads,
+                                             buffer_kb * 1024)
+                finally:
+                    sys.stderr.close()
+                    sys.stderr = stderr
+                found = {'ok': run['ok'], 'mismatch': run['mismatched'],
+                         'missing': run['missing']}
+                ok = found == expected and not run['errors']
+                all_ok = all_ok and ok
+                print("{0:>7d} {1:>10d} {2:>9.2f} {3:>9.1f} {4:>8.1f} "
+                      "{5:>4}".format(threads, buffer_kb, run['seconds'],
+                                      run['mb_per_second'],
+                                      run['files_per_second'],
+                                      'yes' if ok else 'no'))
+                if not ok:
+                    print("    expected {0}, found {1}".format(expected,
+                                                                found))
+        conn.close()
+    finally:
+        shutil.rmtree(work_dir)
+    sys.exit(0 if all_ok else 1)
@@ -0,0 +1,186 @@
+#! /usr/bin/env python
+# benchmark_loaders.py
+"""
+Measures end-to-end loader throughput on synthetic data from
+generate_test_data.py, so we can compare loader changes without the
+production dumps.
+
+Each step runs as a separate process in a scratch directory, exactly
+the way we run the loaders when building aptrust.db:
+
+1. fedora_to_sql.py for institutions, users, processed items and objects
+2. logs_to_sql.py for apt_record.json
+3. s3_buckets_to_sql.py --listing for the S3 and Glacier keys
+4. sqlite3 db/aptrust.db < merge_dbs.sql
+
+For each step we report the elapsed time, the number of rows the step
+added to its database, rows per second, and the peak resident set size
+of the process. The loaders' own output goes to loaders.log in the
+scratch directory.
+
+Usage:
+
+python benchmark_loaders.py --bags 1000 --files-per-bag 20
+python benchmark_loaders.py --data-dir data/synthetic --output loaders.json
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import generate_test_data
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def benchmark(data_dir, work_dir):
+    """
+    Runs each loader step in work_dir against the files in data_dir.
+    Returns a list of results, one dict per step.
+    """
+    os.mkdir(os.path.join(work_dir, 'db'))
+    log = open(os.path.join(work_dir, 'loaders.log'), 'w')
+    results = []
+    try:
+        for name, command, stdin_path, db_name in loader_steps(data_dir):
+            db_path = os.path.join(work_dir, 'db', db_name)
+            rows_before = count_rows(db_path)
+            log.write("=== {0}\n".format(name))
+            log.flush()
+            seconds, peak_rss_kb = run_step(command, stdin_path, work_dir, log)
+            rows = count_rows(db_path) - rows_before
+            results.append({
+                'step': name,
+                'seconds': seconds,
+                'rows': rows,
+                'rows_per_second': rows / seconds if seconds > 0 else 0,
+                'peak_rss_mb': peak_rss_kb / 1024.0,
+            })
+    finally:
+        log.close()
+    return results
+
+def loader_steps(data_dir):
+    """
+    Returns (name, command, stdin file, database written) for each step.
+    """
+    python = sys.executable
+    fedora = os.path.join(REPO_DIR, 'fedora_to_sql.py')
+    steps = []
+    for file_name in ['institutions.json', 'users.json',
+                      'processed_items.json', 'objects.json']:
+        steps.append(('fedora_to_sql ' + file_name,
+                      [python, fedora, os.path.join(data_dir, file_name)],
+                      None, 'aptrust_fedora.db'))
+    steps.append(('logs_to_sql apt_record.json',
+                  [python, os.path.join(REPO_DIR, 'logs_to_sql.py'),
+                   os.path.join(data_dir, 'apt_record.json')],
+                  None, 'aptrust_logs.db'))
+    steps.append(('s3_buckets_to_sql --listing',
+                  [python, os.path.join(REPO_DIR, 's3_buckets_to_sql.py'),
+                   '--listing', os.path.join(data_dir, 's3_listing.json')],
+                  None, 'aptrust_s3.db'))
+    steps.append(('merge_dbs.sql', ['sqlite3', 'db/aptrust.db'],
+                  os.path.join(REPO_DIR, 'merge_dbs.sql'), 'aptrust.db'))
+    return steps
+
+def run_step(command, stdin_path, work_dir, log):
+    """
+    Runs the command in work_dir and waits for it. Returns the elapsed
+    seconds and the process's peak RSS in kilobytes. (getrusage reports
+    ru_maxrss in kilobytes on Linux, but in bytes on OS X.)
+    """
+    stdin = open(stdin_path) if stdin_path else None
+    try:
+        start = time.time()
+        process = subprocess.Popen(command, cwd=work_dir, stdin=stdin,
+                                   stdout=log, stderr=subprocess.STDOUT)
+        # wait4 gives us the resource usage of this process alone.
+        # RUSAGE_CHILDREN would report the largest of all the steps.
+        pid, status, usage = os.wait4(process.pid, 0)
+        seconds = time.time() - start
+    finally:
+        if stdin:
+            stdin.close()
+    if not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0:
+        raise RuntimeError("{0} failed with status {1}. See {2}".format(
+            " ".join(command), status, log.name))
+    return seconds, usage.ru_maxrss
+
+def count_rows(db_path):
+    """
+    Returns the total number of rows in all tables in the database,
+    or zero if it doesn't exist yet.
+    """
+    if not os.path.exists(db_path):
+        return 0
+    conn = sqlite3.connect(db_path)
+    query = """select name from sqlite_master where type='table'
+    and name != 'sqlite_sequence'"""
+    total = 0
+    for row in conn.execute(query).fetchall():
+        total += conn.execute(
+            "select count(*) from [{0}]".format(row[0])).fetchone()[0]
+    conn.close()
+    return total
+
+def report(results):
+    print("{0:<34} {1:>9} {2:>11} {3:>11} {4:>9}".format(
+        'step', 'seconds', 'rows', 'rows/s', 'peak MB'))
+    for r in results:
+        print("{0:<34} {1:>9.2f} {2:>11d} {3:>11.1f} {4:>9.1f}".format(
+            r['step'], r['seconds'], r['rows'], r['rows_per_second'],
+            r['peak_rss_mb']))
+    seconds = sum(r['seconds'] for r in results)
+    rows = sum(r['rows'] for r in results)
+    print("{0:<34} {1:>9.2f} {2:>11d} {3:>11.1f}".format(
+        'total', seconds, rows, rows / seconds if seconds > 0 else 0))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmark the loaders and merge_dbs.sql on '
+        'synthetic data')
+    parser.add_argument('--data-dir',
+                        help="Use the files generate_test_data.py already "
+                        "wrote to this directory, instead of generating "
+                        "new ones")
+    parser.add_argument('--bags', type=int, default=1000)
+    parser.add_argument('--files-per-bag', type=int, default=20)
+    parser.add_argument('--institutions', type=int, default=10)
+    parser.add_argument('--error-rate', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output',
+                        help="Also write the results to this JSON file")
+    parser.add_argument('--keep', action='store_true',
+                        help="Don't delete the scratch directory")
+    args = parser.parse_args()
+
+    scratch_dir = tempfile.mkdtemp(prefix='benchmark_loaders_')
+    data_dir = args.data_dir
+    if data_dir is None:
+        data_dir = os.path.join(scratch_dir, 'data')
+        print("Generating {0} bags of {1} files".format(
+            args.bags, args.files_per_bag))
+        generate_test_data.generate(data_dir, args.bags, args.files_per_bag,
+                                    args.institutions, args.error_rate,
+                                    args.seed)
+    data_dir = os.path.abspath(data_dir)
+    work_dir = os.path.join(scratch_dir, 'work')
+    os.mkdir(work_dir)
+    try:
+        results = benchmark(data_dir, work_dir)
+    finally:
+        if args.keep:
+            print("Scratch files are in {0}".format(scratch_dir))
+        else:
+            shutil.rmtree(scratch_dir)
+    report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
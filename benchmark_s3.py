@@ -0,0 +1,147 @@
+#! /usr/bin/env python
+# benchmark_s3.py
+"""
+Measures S3 crawler throughput against the local stand-in in fake_s3.py,
+so we can compare crawler changes without touching production buckets.
+
+This runs three benchmarks against a synthetic bucket:
+
+1. Listing alone (bucket.list()).
+2. The full crawl: s3_buckets_to_sql.list_bucket into a scratch db,
+   then an incremental crawl of the unchanged bucket into the same db,
+   which measures the path where every key is already there.
+3. The metadata fetch path (one HEAD per key) at several concurrency
+   levels.
+
+Usage:
+
+python benchmark_s3.py --keys 20000 --latency 5 --concurrency 1,4,16
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from Queue import Queue
+
+import fake_s3
+import s3_buckets_to_sql
+from metrics import Metrics
+
+BUCKET_NAME = 'aptrust.preservation.storage'
+
+
+def benchmark_listing(s3):
+    bucket = s3.get_bucket(BUCKET_NAME)
+    start = time.time()
+    count = 0
+    for key in bucket.list():
+        count += 1
+    return count, time.time() - start
+
+
+def benchmark_crawl(s3, db_path, incremental):
+    """
+    Runs list_bucket into the database at db_path. The crawler's output
+    and progress lines are discarded while it runs. Returns the number
+    of keys in the database, the elapsed seconds, and the number of
+    keys with each status.
+    """
+    conn = sqlite3.connect(db_path)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        metrics = Metrics('list_bucket', stream=sys.stdout)
+        start = time.time()
+        s3_buckets_to_sql.list_bucket(BUCKET_NAME, conn, incremental, s3=s3,
+                                      metrics=metrics)
+        elapsed = time.time() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    count = conn.execute("select count(*) from s3_keys").fetchone()[0]
+    conn.close()
+    return count, elapsed, metrics.counters
+
+
+def benchmark_metadata_fetch(s3, key_names, concurrency):
+    """
+    Fetches metadata for every key, the way the crawler does, using
+    the specified number of threads.
+    """
+    bucket = s3.get_bucket(BUCKET_NAME)
+    queue = Queue()
+    for name in key_names:
+        queue.put(name)
+    def fetch():
+        while True:
+            name = queue.get()
+            if name is None:
+                return
+            bucket.get_key(name).metadata
+    threads = [threading.Thread(target=fetch) for i in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        queue.put(None)
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(key_names), time.time() - start
+
+
+def report(label, count, elapsed, requests):
+    rate = count / elapsed if elapsed > 0 else 0
+    print("{0:<28} {1:>9d} keys {2:>9.2f}s {3:>10.1f} keys/s {4:>9d} requests".format(
+        label, count, elapsed, rate, requests))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmark the S3 crawler against a local fake S3')
+    parser.add_argument('--keys', type=int, default=10000,
+                        help="Number of keys in the synthetic bucket")
+    parser.add_argument('--files-per-bag', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=5.0,
+                        help="Milliseconds per simulated S3 request")
+    parser.add_argument('--concurrency', default='1,2,4,8,16',
+                        help="Comma-separated thread counts for the "
+                        "metadata fetch benchmark")
+    args = parser.parse_args()
+
+    s3 = fake_s3.FakeS3Connection(latency=args.latency / 1000.0)
+    bucket = fake_s3.build_synthetic_bucket(
+        s3, BUCKET_NAME, args.keys, args.files_per_bag, seed=1)
+    key_names = sorted(bucket.keys.keys())
+    print("{0} keys, {1}ms latency per request".format(
+        args.keys, args.latency))
+
+    s3.reset_request_counts()
+    count, elapsed = benchmark_listing(s3)
+    report('list', count, elapsed, s3.request_count())
+
+    # The incremental crawl runs against the db the full crawl built,
+    # so it finds every key already there.
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        db_path = os.path.join(tmp_dir, 'aptrust_s3.db')
+        for incremental in [False, True]:
+            s3.reset_request_counts()
+            count, elapsed, statuses = benchmark_crawl(s3, db_path,
+                                                       incremental)
+            label = 'list_bucket'
+            if incremental:
+                label = 'list_bucket (incremental)'
+            report(label, count, elapsed, s3.request_count())
+            print("    " + ", ".join("{0} {1}".format(status, statuses[status])
+                                     for status in sorted(statuses)))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    for concurrency in [int(c) for c in args.concurrency.split(',')]:
+        s3.reset_request_counts()
+        count, elapsed = benchmark_metadata_fetch(s3, key_names, concurrency)
+        report('metadata fetch x{0}'.format(concurrency), count, elapsed,
+               s3.request_count())
@@ -14,11 +14,13 @@
 drop table if exists audit_001_objects;
 drop table if exists audit_001_files;
 drop table if exists audit_001_problem_files;
+drop table if exists audit_001_file_keys;
 
 
 create table audit_001_objects (
   bucket varchar(80),
   key varchar(80),
+  bag_key varchar(255),
   institution_id int,
   object_id int,
   fedora_object_pid varchar(40),
@@ -36,9 +38,13 @@ create table audit_001_objects (
   access_assignment_count int not null default 0
 );
 
+-- The event counts come from event_counts, which fedora_to_sql.py
+-- keeps as it loads events, so no query here has to read events.
+-- An object's counts are its own events, which have file_id 0.
 insert into audit_001_objects(
   bucket,
   key,
+  bag_key,
   institution_id,
   object_id,
   fedora_object_pid,
@@ -56,6 +62,7 @@ insert into audit_001_objects(
   access_assignment_count)
 select wi.bucket,        -- S3 receiving bucket
        wi.name,          -- name of tar file
+       o.bag_key,        -- institution/bag_name, without .tar
        o.institution_id,
        o.id as object_id,
        o.pid as fedora_object_pid,
@@ -66,18 +73,68 @@ select wi.bucket,        -- S3 receiving bucket
        ir.error_message,
        ir.stage,
        ir.retry,
-       0,
-       0,
-       0,
-       0,
-       0
+       coalesce((select ec.event_count from event_counts ec
+                 where ec.file_id = 0 and ec.object_id = o.id
+                 and ec.type = 'identifier_assignment'), 0),
+       coalesce((select ec.event_count from event_counts ec
+                 where ec.file_id = 0 and ec.object_id = o.id
+                 and ec.type = 'ingest'), 0),
+       coalesce((select ec.event_count from event_counts ec
+                 where ec.file_id = 0 and ec.object_id = o.id
+                 and ec.type = 'fixity_check'), 0),
+       coalesce((select ec.event_count from event_counts ec
+                 where ec.file_id = 0 and ec.object_id = o.id
+                 and ec.type = 'fixity_generation'), 0),
+       coalesce((select ec.event_count from event_counts ec
+                 where ec.file_id = 0 and ec.object_id = o.id
+                 and ec.type = 'access_assignment'), 0)
        from work_items wi
-       inner join objects o on o.bag_name = rtrim(wi.name, '.tar')
-       inner join ingest_records ir on ir.object_identifier = o.identifier || '.tar'
+       inner join objects o on o.bag_key = wi.bag_key
+       inner join ingest_records ir on ir.bag_key = o.bag_key
        inner join ingest_tar_results tr on tr.ingest_record_id = ir.id
        inner join ingest_bag_read_results br on br.ingest_record_id = ir.id
        where wi.stage='Record' and wi.status='Failed';
 
+create index ix_audit_001_objects_key on audit_001_objects(key);
+create index ix_audit_001_objects_bag_key on audit_001_objects(bag_key);
+
+
+-- A generic file can be stored under its uuid or its storage_uuid,
+-- so it can have S3 and Glacier keys under either name. Finding them
+-- here, with an equality join on the name, lets DuckDB (see
+-- duckdb_audit.py) hash join s3_keys. Joining s3_keys to the files on
+-- "name in (igf.uuid, igf.storage_uuid)" makes it compare every file
+-- with every key. The cross joins make SQLite look each key up by
+-- bucket and name in ix_s3_bucket_name. With "bucket in (...)", it
+-- may pick ix_s3_deleted_at instead and read every live key for
+-- every file. (Unary + or "indexed by" would also force the index,
+-- but DuckDB can't run either.)
+create table audit_001_file_keys (
+  gf_id int,
+  bucket varchar(80),
+  s3_keys_id int,
+  name varchar(40)
+);
+
+insert into audit_001_file_keys (gf_id, bucket, s3_keys_id, name)
+select n.gf_id, k.bucket, k.id, k.name
+from (select igf.id as gf_id, igf.uuid as name
+      from ingest_generic_files igf
+      where igf.ingest_tar_result_id in (select tar_result_id from audit_001_objects)
+      union
+      select igf.id, igf.storage_uuid
+      from ingest_generic_files igf
+      where igf.ingest_tar_result_id in (select tar_result_id from audit_001_objects)) n
+cross join (select 'aptrust.preservation.storage' as bucket
+            union all
+            select 'aptrust.preservation.oregon') b
+cross join s3_keys k
+where k.bucket = b.bucket
+and k.name = n.name
+and k.deleted_at is null;
+
+create index ix_audit_001_file_keys_gf_id on audit_001_file_keys(gf_id, bucket);
+
 
 create table audit_001_files (
   ingest_record_id int,
@@ -88,11 +145,13 @@ create table audit_001_files (
   gf_identifier varchar(255),
   gf_needs_save boolean,
   gf_storage_url varchar(255),
+  gf_storage_uuid varchar(40),
   gf_stored_at varchar(255),
   gf_replication_error text,
   fedora_file_id int,
   fedora_file_pid varchar(40),
   fedora_file_uri varchar(255),
+  fedora_file_uuid varchar(40),
   s3_keys_id_s3 int,
   s3_key varchar(40),
   s3_keys_id_glacier int,
@@ -114,11 +173,13 @@ insert into audit_001_files (
   gf_identifier,
   gf_needs_save,
   gf_storage_url,
+  gf_storage_uuid,
   gf_stored_at,
   gf_replication_error,
   fedora_file_id,
   fedora_file_pid,
   fedora_file_uri,
+  fedora_file_uuid,
   s3_keys_id_s3,
   s3_key,
   s3_keys_id_glacier,
@@ -137,25 +198,37 @@ select o.ingest_record_id,
        igf.identifier,
        igf.needs_save,
        igf.storage_url,
+       igf.storage_uuid,
        igf.stored_at,
        igf.replication_error,
        f.id,
        f.pid,
        f.uri,
-       s1.id as s3_keys_id_s3,
+       f.uri_uuid,
+       s1.s3_keys_id as s3_keys_id_s3,
        s1.name as s3_key,
-       s2.id as s3_keys_id_glacier,
+       s2.s3_keys_id as s3_keys_id_glacier,
        s2.name as glacier_key,
-       0,
-       0,
-       0,
-       0,
-       0
+       coalesce((select ec.event_count from event_counts ec
+                 where ec.file_id = f.id and ec.object_id = f.object_id
+                 and ec.type = 'identifier_assignment'), 0),
+       coalesce((select ec.event_count from event_counts ec
+                 where ec.file_id = f.id and ec.object_id = f.object_id
+                 and ec.type = 'ingest'), 0),
+       coalesce((select ec.event_count from event_counts ec
+                 where ec.file_id = f.id and ec.object_id = f.object_id
+                 and ec.type = 'fixity_check'), 0),
+       coalesce((select ec.event_count from event_counts ec
+                 where ec.file_id = f.id and ec.object_id = f.object_id
+                 and ec.type = 'fixity_generation'), 0),
+       coalesce((select ec.event_count from event_counts ec
+                 where ec.file_id = f.id and ec.object_id = f.object_id
+                 and ec.type = 'access_assignment'), 0)
 from ingest_unpacked_files uf
 inner join audit_001_objects o on o.tar_result_id = uf.ingest_tar_result_id
 left join ingest_generic_files igf on igf.ingest_tar_result_id = uf.ingest_tar_result_id and igf.file_path = uf.file_path
-left join s3_keys s1 on (s1.name = igf.uuid or s1.name = substr(igf.storage_url, 55)) and s1.bucket = 'aptrust.preservation.storage'
-left join s3_keys s2 on (s2.name = igf.uuid or s2.name = substr(igf.storage_url, 55)) and s2.bucket = 'aptrust.preservation.oregon'
+left join audit_001_file_keys s1 on s1.gf_id = igf.id and s1.bucket = 'aptrust.preservation.storage'
+left join audit_001_file_keys s2 on s2.gf_id = igf.id and s2.bucket = 'aptrust.preservation.oregon'
 left join files f on f.identifier = o.object_identifier || '/' || uf.file_path
 where uf.file_path like 'data/%';
 
@@ -163,6 +236,8 @@ where uf.file_path like 'data/%';
 create index ix_audit_001_files_ingest_record_id on audit_001_files(ingest_record_id);
 create index ix_audit_001_files_gf_file_path on audit_001_files(gf_file_path);
 
+drop table audit_001_file_keys;
+
 
 create table audit_001_problem_files (
   ingest_record_id int,
@@ -172,10 +247,12 @@ create table audit_001_problem_files (
   gf_identifier varchar(255),
   gf_needs_save boolean,
   gf_storage_url varchar(255),
+  gf_storage_uuid varchar(40),
   gf_stored_at varchar(255),
   gf_replication_error text,
   fedora_file_pid varchar(40),
   fedora_file_uri varchar(255),
+  fedora_file_uuid varchar(40),
   s3_key varchar(40),
   glacier_key varchar(40),
   duplicate_s3 boolean not null default false,
@@ -192,10 +269,12 @@ insert into audit_001_problem_files (
   gf_identifier,
   gf_needs_save,
   gf_storage_url,
+  gf_storage_uuid,
   gf_stored_at,
   gf_replication_error,
   fedora_file_pid,
   fedora_file_uri,
+  fedora_file_uuid,
   s3_key,
   glacier_key,
   duplicate_s3,
@@ -210,10 +289,12 @@ select
   f.gf_identifier,
   f.gf_needs_save,
   f.gf_storage_url,
+  f.gf_storage_uuid,
   f.gf_stored_at,
   o.error_message,
   f.fedora_file_pid,
   f.fedora_file_uri,
+  f.fedora_file_uuid,
   f.s3_key,
   f.glacier_key,
   0,
@@ -225,21 +306,23 @@ select
   where f.gf_needs_save = 1
   and (f.s3_key is null or f.glacier_key is null or
        f.s3_key != f.gf_uuid or f.glacier_key != f.gf_uuid or
-       substr(f.gf_storage_url, 55) != f.gf_uuid or
-       substr(f.fedora_file_uri, 55) != f.gf_uuid or
+       f.gf_storage_uuid != f.gf_uuid or
+       f.fedora_file_uuid != f.gf_uuid or
        f.gf_storage_url != f.fedora_file_uri);
 
 
 update audit_001_problem_files set duplicate_s3 = 1
 where gf_needs_save = 1 and s3_key is not null
-and (s3_key != gf_uuid or s3_key != substr(fedora_file_uri, 55));
+and (s3_key != gf_uuid or s3_key != fedora_file_uuid);
 
 update audit_001_problem_files set missing_s3 = 1
 where gf_needs_save = 1 and s3_key is null;
 
 update audit_001_problem_files set duplicate_glacier = 1
 where gf_needs_save = 1 and glacier_key is not null
-and (glacier_key != gf_uuid or glacier_key != substr(fedora_file_uri, 55));
+and (glacier_key != gf_uuid or glacier_key != fedora_file_uuid);
 
 update audit_001_problem_files set missing_glacier = 1
 where gf_needs_save = 1 and glacier_key is null;
+
+create index ix_audit_001_problem_files_ingest_record_id on audit_001_problem_files(ingest_record_id);
@@ -0,0 +1,541 @@
+#! /usr/bin/env python
+# check_query_plans.py
+"""
+Checks the query plans of the audit SQL, so a query that quietly
+turns into a full scan of a 100M-row table gets caught before we
+run it against the real aptrust.db.
+
+This builds a scratch aptrust.db the same way we build the real one:
+the loaders create their own databases and indexes, we fill those
+with synthetic bags, files, checksums, events and S3 keys, and
+merge_dbs.sql merges them. It then runs every statement in
+build_audit_001_tables.sql and audit_001_rollups.sql and every query
+in audit_001.py, reconcile_files.py and compare_checksums.py, in the
+order the scripts run them. Each statement is run through EXPLAIN
+QUERY PLAN before it is executed and timed.
+
+A plan fails the check if it:
+
+- scans one of the LARGE_TABLES (SCAN ...), unless the query is
+  expected to read the whole table,
+- builds an automatic index, which means SQLite couldn't find a
+  declared index for a join, or
+- searches an index only by equality (or IS NULL) on one of the
+  LOW_SELECTIVITY_COLUMNS, e.g. "deleted_at=?". Most rows share a
+  value of those columns, so a lookup like that reads nearly the
+  whole table, and inside a join it reads it once per outer row.
+  Ranges on them, like "last_modified>?" after a watermark, are fine.
+
+To mark a statement in a .sql file as an intended full scan, put
+a comment line like this one directly above it:
+
+    -- plan: allow scan ingest_unpacked_files
+
+The plans, timings and failures are written to a JSON file. The
+script exits with status 1 if any plan fails.
+
+Usage:
+
+python check_query_plans.py
+python check_query_plans.py --bags 2000 --files-per-bag 50 --output plans.json
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+import audit_001
+import compare_checksums
+import fedora_to_sql
+import identifiers
+import logs_to_sql
+import reconcile_files
+import s3_buckets_to_sql
+
+# Tables that grow with the number of files we preserve. A full scan
+# of any of these is too slow to run per bag or per file.
+LARGE_TABLES = set([
+    'work_items',
+    'objects',
+    'files',
+    'checksums',
+    'events',
+    'event_counts',
+    'ingest_records',
+    'ingest_s3_files',
+    'ingest_tar_results',
+    'ingest_unpacked_files',
+    'ingest_generic_files',
+    'ingest_bag_read_results',
+    's3_keys',
+    's3_meta',
+])
+
+# Columns whose values most rows share. Without ANALYZE statistics,
+# SQLite will happily look rows up by an index on one of these.
+LOW_SELECTIVITY_COLUMNS = set([
+    'deleted_at',
+    'last_modified',
+    'last_seen_at',
+    'state',
+    'storage_class',
+])
+
+INSTITUTIONS = ['test.edu', 'example.edu', 'sample.org']
+S3_URL = 'https://s3.amazonaws.com/aptrust.preservation.storage/'
+
+SCAN_PATTERN = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+SEARCH_PATTERN = re.compile(
+    r'^SEARCH (?:TABLE )?(\w+) USING (?:COVERING )?INDEX (\w+) \((.+)\)')
+CONSTRAINT_PATTERN = re.compile(r'^(\w+)\s*(=|>|<|>=|<=| IN )')
+ALLOW_PATTERN = re.compile(r'^--\s*plan:\s*allow scan\s+(.+)$')
+TABLE_ALIAS_PATTERN = re.compile(
+    r'\b(?:from|join|update|into)\s+(?:\w+\.)?(\w+)(?:\s+(?:as\s+)?(\w+))?',
+    re.IGNORECASE)
+SQL_KEYWORDS = set(['on', 'where', 'inner', 'left', 'join', 'order', 'group',
+                    'select', 'set', 'values', 'limit', 'using', 'and'])
+EXPLAINABLE = ('select', 'insert', 'update', 'delete', 'with', 'create table')
+
+
+class PlanChecker(object):
+    """
+    Explains, runs and times statements against the fixture database,
+    and collects the results.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.results = []
+
+    def run(self, name, source, sql, params=(), allow_scans=()):
+        """
+        Explains and then executes a statement. Returns the rows it
+        returned, if any.
+        """
+        result = {
+            'name': name,
+            'source': source,
+            'sql': sql.strip(),
+            'plan': [],
+            'violations': [],
+        }
+        if sql.strip().lower().startswith(EXPLAINABLE):
+            plan = self.conn.execute("explain query plan " + sql, params)
+            result['plan'] = [row[3] for row in plan.fetchall()]
+            result['violations'] = find_violations(
+                sql, result['plan'], allow_scans)
+        start = time.time()
+        rows = self.conn.execute(sql, params).fetchall()
+        result['seconds'] = round(time.time() - start, 6)
+        result['rows'] = len(rows)
+        self.results.append(result)
+        return rows
+
+    def run_script(self, path):
+        """
+        Runs each statement in a .sql file, in order.
+        """
+        for number, (sql, allow_scans) in enumerate(read_sql_statements(path)):
+            name = "{0} statement {1}".format(os.path.basename(path), number + 1)
+            self.run(name, path, sql, allow_scans=allow_scans)
+        self.conn.commit()
+
+    def violations(self):
+        return [(r['name'], v) for r in self.results for v in r['violations']]
+
+
+def find_violations(sql, plan, allow_scans):
+    """
+    Returns a list of problems with the plan. Plans refer to tables
+    by their aliases, so we map aliases back to table names first.
+    """
+    aliases = {}
+    for match in TABLE_ALIAS_PATTERN.finditer(sql):
+        table, alias = match.group(1), match.group(2)
+        aliases[table] = table
+        if alias and alias.lower() not in SQL_KEYWORDS:
+            aliases[alias] = table
+    problems = []
+    for detail in plan:
+        if 'AUTOMATIC' in detail:
+            problems.append("Automatic index: {0}".format(detail))
+            continue
+        match = SCAN_PATTERN.match(detail)
+        if match:
+            table = aliases.get(match.group(1), match.group(1))
+            if table in LARGE_TABLES and table not in allow_scans:
+                problems.append("Full scan of {0}: {1}".format(table, detail))
+            continue
+        match = SEARCH_PATTERN.match(detail)
+        if match and low_selectivity_search(match.group(3)):
+            problems.append("Low-selectivity index: {0}".format(detail))
+    return problems
+
+def low_selectivity_search(constraints):
+    """
+    Returns True if the constraints of an index search, e.g.
+    "deleted_at=?" or "bucket=? AND name=?", are all on
+    LOW_SELECTIVITY_COLUMNS and at least one is an equality.
+    """
+    equality = False
+    for term in constraints.split(' AND '):
+        match = CONSTRAINT_PATTERN.match(term.strip())
+        if not match or match.group(1) not in LOW_SELECTIVITY_COLUMNS:
+            return False
+        if match.group(2) in ('=', ' IN '):
+            equality = True
+    return equality
+
+def read_sql_statements(path):
+    """
+    Yields (statement, allow_scans) for each statement in a .sql file.
+    Full-line comments are dropped, except for plan annotations, which
+    apply to the statement that follows them.
+    """
+    statement = ''
+    allow_scans = set()
+    with open(path) as f:
+        for line in f:
+            stripped = line.strip()
+            if stripped.startswith('--'):
+                match = ALLOW_PATTERN.match(stripped)
+                if match:
+                    allow_scans.update(match.group(1).split())
+                continue
+            statement += line
+            if sqlite3.complete_statement(statement):
+                yield statement.strip(), allow_scans
+                statement = ''
+                allow_scans = set()
+
+
+#------------------------------------------------------------------------
+# Fixture
+#------------------------------------------------------------------------
+
+def build_fixture(work_dir, num_bags, files_per_bag, seed):
+    """
+    Creates the loader databases in work_dir/db using the loaders' own
+    schema code, fills them with synthetic records, and merges them into
+    work_dir/db/aptrust.db with merge_dbs.sql. Returns the number of
+    seconds the merge took.
+    """
+    rng = random.Random(seed)
+    db_dir = os.path.join(work_dir, 'db')
+    os.mkdir(db_dir)
+    logs = sqlite3.connect(os.path.join(db_dir, 'aptrust_logs.db'))
+    fedora = sqlite3.connect(os.path.join(db_dir, 'aptrust_fedora.db'))
+    s3 = sqlite3.connect(os.path.join(db_dir, 'aptrust_s3.db'))
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        logs_to_sql.initialize_db(logs)
+        fedora_to_sql.initialize_db(fedora)
+        s3_buckets_to_sql.create_db_if_necessary(s3)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    for i, institution in enumerate(INSTITUTIONS):
+        fedora.execute("""insert into institutions(pid, name, brief_name,
+        identifier) values (?,?,?,?)""", ('inst:{0}'.format(i), institution,
+                                          institution.split('.')[0],
+                                          institution))
+    for i in range(num_bags):
+        add_bag(rng, logs, fedora, s3, i, files_per_bag)
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        fedora_to_sql.create_event_counts_if_necessary(fedora)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    for conn in [logs, fedora, s3]:
+        conn.commit()
+        conn.close()
+
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'merge_dbs.sql')) as f:
+        merge_sql = f.read()
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        conn = sqlite3.connect('db/aptrust.db')
+        start = time.time()
+        conn.executescript(merge_sql)
+        elapsed = time.time() - start
+        conn.close()
+    finally:
+        os.chdir(cwd)
+    return elapsed
+
+def add_bag(rng, logs, fedora, s3, number, files_per_bag):
+    """
+    Adds one bag to the loader databases. Every fourth bag failed in
+    the Record stage, which is what audit_001 looks for, and some of
+    its files are missing from Fedora, S3 or Glacier.
+    """
+    institution_number = number % len(INSTITUTIONS)
+    institution = INSTITUTIONS[institution_number]
+    bag_name = "{0}.bag_{1:06d}".format(institution, number)
+    tar_name = bag_name + '.tar'
+    identifier = "{0}/{1}".format(institution, bag_name)
+    bag_key = identifiers.bag_key(institution, bag_name)
+    failed = number % 4 == 0
+    now = datetime(2015, 9, 1)
+
+    fedora.execute("""insert into work_items(name, etag, bucket,
+    institution_id, stage, status, object_identifier, bag_key)
+    values (?,?,?,?,?,?,?,?)""", (
+        tar_name, hashlib.md5(tar_name).hexdigest(),
+        'aptrust.receiving.' + institution, institution_number + 1,
+        'Record', 'Failed' if failed else 'Success', identifier, bag_key))
+    object_id = fedora.execute("""insert into objects(institution_id, pid,
+    bag_name, identifier, state, bag_key) values (?,?,?,?,?,?)""", (
+        institution_number + 1, 'obj:{0}'.format(number), bag_name,
+        identifier, 'A', bag_key)).lastrowid
+    fedora.execute("""insert into events(object_id, identifier, type,
+    date_time) values (?,?,?,?)""", (object_id, str(uuid.UUID(
+        int=rng.getrandbits(128))), 'ingest', now))
+
+    ingest_record_id = logs.execute("""insert into ingest_records(
+    error_message, stage, retry, object_identifier, bag_key)
+    values (?,?,?,?,?)""", (
+        'Fluctus error' if failed else None, 'Record', failed,
+        identifier + '.tar', bag_key)).lastrowid
+    logs.execute("""insert into ingest_s3_files(ingest_record_id,
+    bucket_name, key, size, etag, last_modified) values (?,?,?,?,?,?)""", (
+        ingest_record_id, 'aptrust.receiving.' + institution, tar_name,
+        rng.randint(1000, 10 ** 9), hashlib.md5(tar_name).hexdigest(), now))
+    tar_result_id = logs.execute("""insert into ingest_tar_results(
+    ingest_record_id, input_file) values (?,?)""", (
+        ingest_record_id, tar_name)).lastrowid
+    logs.execute("""insert into ingest_bag_read_results(ingest_record_id,
+    bag_path) values (?,?)""", (ingest_record_id, bag_name))
+
+    for j in range(files_per_bag):
+        file_path = "data/file_{0:05d}.txt".format(j)
+        file_uuid = str(uuid.UUID(int=rng.getrandbits(128)))
+        file_identifier = "{0}/{1}".format(identifier, file_path)
+        size = rng.randint(100, 10 * 1024 * 1024)
+        md5 = hashlib.md5(file_uuid).hexdigest()
+        sha256 = hashlib.sha256(file_uuid).hexdigest()
+        storage_url = S3_URL + file_uuid
+        logs.execute("""insert into ingest_unpacked_files(
+        ingest_tar_result_id, file_path) values (?,?)""", (
+            tar_result_id, file_path))
+        logs.execute("""insert into ingest_generic_files(
+        ingest_tar_result_id, file_path, size, md5, sha256, uuid,
+        storage_url, identifier, needs_save, storage_uuid)
+        values (?,?,?,?,?,?,?,?,?,?)""", (
+            tar_result_id, file_path, size, md5, sha256, file_uuid,
+            storage_url, file_identifier, True, file_uuid))
+
+        if not (failed and j % 5 == 1):
+            file_id = fedora.execute("""insert into files(object_id, pid,
+            uri, size, identifier, state, uri_uuid)
+            values (?,?,?,?,?,?,?)""", (
+                object_id, 'file:{0}:{1}'.format(number, j), storage_url,
+                size, file_identifier, 'A', file_uuid)).lastrowid
+            for algorithm, digest in [('md5', md5), ('sha256', sha256)]:
+                fedora.execute("""insert into checksums(file_id, algorithm,
+                digest, date_time) values (?,?,?,?)""", (
+                    file_id, algorithm, digest, now))
+            for event_type in ['identifier_assignment', 'fixity_check']:
+                fedora.execute("""insert into events(object_id, file_id,
+                identifier, type, date_time) values (?,?,?,?,?)""", (
+                    object_id, file_id,
+                    str(uuid.UUID(int=rng.getrandbits(128))), event_type, now))
+
+        buckets = ['aptrust.preservation.storage', 'aptrust.preservation.oregon']
+        if failed and j % 5 == 2:
+            buckets = buckets[:1]
+        for bucket in buckets:
+            key_id = s3.execute("""insert into s3_keys(bucket, name,
+            content_type, etag, last_modified, storage_class, size,
+            last_seen_at, bag_key) values (?,?,?,?,?,?,?,?,?)""", (
+                bucket, file_uuid, 'text/plain', md5, now, 'STANDARD',
+                size, now, bag_key)).lastrowid
+            s3.executemany("insert into s3_meta(key_id, name, value) values (?,?,?)", [
+                (key_id, 'institution', institution),
+                (key_id, 'bag', bag_name),
+                (key_id, 'bagpath', file_path),
+                (key_id, 'md5', md5),
+                (key_id, 'sha256', sha256)])
+
+
+#------------------------------------------------------------------------
+# Checks
+#------------------------------------------------------------------------
+
+def check_audit_001(checker, repo_dir):
+    """
+    Runs the audit_001 build and rollup scripts, then the per-bag, bulk and SQL
+    engine queries from audit_001.py.
+    """
+    checker.run_script(os.path.join(repo_dir, 'build_audit_001_tables.sql'))
+    checker.run_script(os.path.join(repo_dir, 'audit_001_rollups.sql'))
+
+    source = 'audit_001.py'
+    bags = checker.run('BAG_NAMES_QUERY', source, audit_001.BAG_NAMES_QUERY,
+                       allow_scans=['audit_001_objects'])
+    bag_name = bags[0][0]
+    checker.run('OBJECT_QUERY', source, audit_001.OBJECT_QUERY, (bag_name,))
+    files = checker.run('UNPACKED_FILES_QUERY', source,
+                        audit_001.UNPACKED_FILES_QUERY, (bag_name,))
+    bag_key = checker.run('BAG_KEY_QUERY', source, audit_001.BAG_KEY_QUERY,
+                          (bag_name,))[0][0]
+    file_path = files[0][0]
+    checker.run('FEDORA_URL_QUERY', source, audit_001.FEDORA_URL_QUERY,
+                (bag_name, file_path))
+    checker.run('AWS_KEYS_QUERY', source, audit_001.AWS_KEYS_QUERY,
+                ('aptrust.preservation.storage', bag_key, file_path))
+
+    # Bulk mode reads every failed bag in one pass, so it may scan
+    # the small audit tables, but not the large source tables.
+    for name in ['BULK_OBJECTS_QUERY', 'BULK_FILES_QUERY', 'BULK_URLS_QUERY']:
+        checker.run(name, source, getattr(audit_001, name),
+                    allow_scans=['audit_001_objects', 'audit_001_files'])
+    checker.run('BULK_AWS_KEYS_QUERY', source, audit_001.BULK_AWS_KEYS_QUERY,
+                ('aptrust.preservation.storage',),
+                allow_scans=['audit_001_objects'])
+
+    for number, statement in enumerate(audit_001.SQL_ENGINE_STATEMENTS):
+        checker.run('SQL_ENGINE_STATEMENTS[{0}]'.format(number), source,
+                    statement)
+    for name in ['SQL_ENGINE_KEY_ACTIONS_QUERY', 'SQL_ENGINE_URL_ACTIONS_QUERY',
+                 'SQL_ENGINE_BAGS_QUERY']:
+        checker.run(name, source, getattr(audit_001, name))
+
+def check_reconciliation(checker):
+    """
+    Builds file_reconciliation, then adds a few source rows and
+    checks the queries that find and refresh the affected files.
+    """
+    source = 'reconcile_files.py'
+    conn = checker.conn
+    params = {
+        'refreshed_at': datetime.utcnow(),
+        's3_bucket': reconcile_files.S3_BUCKET,
+        'glacier_bucket': reconcile_files.GLACIER_BUCKET,
+    }
+    checker.run('RECONCILIATION_SELECT (full build)', source,
+                "create table file_reconciliation as " +
+                reconcile_files.RECONCILIATION_SELECT.format(where=""),
+                params, allow_scans=['ingest_generic_files'])
+    reconcile_files.create_indexes(conn)
+    watermarks = reconcile_files.current_watermarks(conn)
+    reconcile_files.read_watermarks(conn)
+    reconcile_files.save_watermarks(conn, watermarks)
+    conn.commit()
+
+    # Refresh once so the temp tables exist, then explain each step.
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        reconcile_files.refresh(conn)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    marks = {}
+    for source_column, value in reconcile_files.read_watermarks(conn).items():
+        marks[source_column.replace('.', '_')] = value
+    for number, query in enumerate(reconcile_files.AFFECTED_QUERIES):
+        checker.run('AFFECTED_QUERIES[{0}]'.format(number), source, query,
+                    marks)
+    where = """where igf.id in
+    (select generic_file_id from reconciliation_affected)"""
+    checker.run('RECONCILIATION_SELECT (refresh)', source,
+                "insert into file_reconciliation " +
+                reconcile_files.RECONCILIATION_SELECT.format(where=where),
+                params)
+    conn.commit()
+
+def check_compare_checksums(checker):
+    """
+    Checks the three source queries of compare_checksums.py. Each one
+    reads its whole table, but must do it in UUID order through an
+    index: a sort would hold the whole table before the first row
+    comes back.
+    """
+    source = 'compare_checksums.py'
+    for name, sql, params, table in [
+            ('INGEST_QUERY', compare_checksums.INGEST_QUERY, (),
+             'ingest_generic_files'),
+            ('FEDORA_QUERY', compare_checksums.FEDORA_QUERY, (), 'files'),
+            ('S3_QUERY', compare_checksums.S3_QUERY,
+             (compare_checksums.S3_BUCKET,), 's3_keys')]:
+        checker.run(name, source, sql, params, allow_scans=[table])
+        result = checker.results[-1]
+        for detail in result['plan']:
+            if 'TEMP B-TREE' in detail:
+                result['violations'].append("Sort: {0}".format(detail))
+
+
+def row_counts(conn):
+    counts = {}
+    for table in sorted(LARGE_TABLES):
+        counts[table] = conn.execute(
+            "select count(*) from {0}".format(table)).fetchone()[0]
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Check the query plans of the audit SQL')
+    parser.add_argument('--bags', type=int, default=400,
+                        help="Number of bags in the fixture")
+    parser.add_argument('--files-per-bag', type=int, default=20)
+    parser.add_argument('--output', default='query_plans.json',
+                        help="Where to write plans and timings")
+    parser.add_argument('--keep', action='store_true',
+                        help="Keep the fixture database and print its path")
+    args = parser.parse_args()
+
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    work_dir = tempfile.mkdtemp()
+    merge_seconds = build_fixture(work_dir, args.bags, args.files_per_bag,
+                                  seed=1)
+    conn = sqlite3.connect(os.path.join(work_dir, 'db', 'aptrust.db'))
+    checker = PlanChecker(conn)
+    check_audit_001(checker, repo_dir)
+    check_reconciliation(checker)
+    check_compare_checksums(checker)
+    counts = row_counts(conn)
+    conn.close()
+
+    violations = checker.violations()
+    report = {
+        'generated_at': datetime.utcnow().isoformat(),
+        'sqlite_version': sqlite3.sqlite_version,
+        'bags': args.bags,
+        'files_per_bag': args.files_per_bag,
+        'merge_seconds': round(merge_seconds, 6),
+        'row_counts': counts,
+        'queries': checker.results,
+        'ok': len(violations) == 0,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    for result in checker.results:
+        print("{0:>10.4f}s  {1:<8} {2}".format(
+            result['seconds'], 'FAIL' if result['violations'] else 'ok',
+            result['name']))
+    for name, violation in violations:
+        print("{0}: {1}".format(name, violation))
+    print("Checked {0} statements, {1} problems. Plans written to {2}".format(
+        len(checker.results), len(violations), args.output))
+    if args.keep:
+        print("Fixture database: {0}".format(
+            os.path.join(work_dir, 'db', 'aptrust.db')))
+    else:
+        shutil.rmtree(work_dir)
+    sys.exit(1 if violations else 0)
@@ -6,97 +6,596 @@
 Deletes some duplicate files from S3 and copies
 some files from S3 to Glacier that had not previously
 been coped to Glacier.
+
+Copies and deletes run in a pool of worker threads. Deletes go to S3
+in batches of up to 1000 keys per multi-object delete request. Copies
+use the content type and metadata that s3_buckets_to_sql.py saved in
+db/aptrust.db, looked up for each batch of keys as it is claimed, and
+only fall back to asking S3 (a HEAD request) for keys the crawl didn't
+record. The main thread
+is the only one that writes to audit001_summary.db: workers hand back
+the result of each action, and the main thread records completion
+times in batches. All workers share a cap on S3 requests per second,
+and requests that fail with a server error or a network error are
+retried with exponential backoff.
+
+The aws_files table works as a queue, so several cleanup_001
+processes can share the work. Each process claims rows a batch at a
+time with a lease, renews its leases while it works, and retires rows
+as their actions complete. If a process dies, its leases expire and
+other processes (or the next run) claim the rows again. Rows whose
+action fails are set aside until their lease would have expired, and
+rows that have been claimed --max-attempts times without completing
+are left for a person to look at, with the error in last_error.
+
+Usage:
+
+python cleanup_001.py --concurrency 16 --max-requests-per-second 200
 """
 
+import argparse
 import os
+import random
+import socket
 import sqlite3
 import sys
-from boto.s3.connection import S3Connection
-from datetime import datetime
+import threading
+import time
+from Queue import Queue
+from datetime import datetime, timedelta
+
+from metrics import Metrics, add_metrics_arguments, metrics_from_args
+
+try:
+    from boto.s3.connection import S3Connection
+except ImportError:
+    # boto is only required when talking to the real S3. The
+    # benchmarks pass in buckets from fake_s3.FakeS3Connection instead.
+    S3Connection = None
 
 VA_BUCKET_NAME = "aptrust.preservation.storage"
 OR_BUCKET_NAME = "aptrust.preservation.oregon"
 
+CRAWL_DB_PATH = 'db/aptrust.db'
+
+# The content type boto gives keys from a bucket listing. Crawls from
+# before s3_buckets_to_sql saved the real content type have this for
+# every key, so we can't trust it.
+DEFAULT_CONTENT_TYPE = 'application/octet-stream'
+
 S3_PREFIX = "https://s3.amazonaws.com/aptrust.preservation.storage/"
 GLACIER_PREFIX = "https://s3.amazonaws.com/aptrust.preservation.oregon/"
 
-def copy_missing_files_to_glacier(conn, va_bucket, or_bucket):
+# Completion times are written in batches of this many rows.
+BATCH_SIZE = 500
+
+# Rows are claimed from the queue this many at a time.
+CLAIM_SIZE = 100
+
+# A claim on a row lasts this many seconds unless it's renewed. Leases
+# are renewed every third of this, so a process that stops renewing
+# loses its rows to other processes soon after.
+LEASE_SECONDS = 300
+
+# Rows that have been claimed this many times without being completed,
+# because their action failed or their process died, are no longer
+# claimed.
+MAX_ATTEMPTS = 3
+
+# S3's multi-object delete takes at most this many keys per request.
+# Copies are claimed in batches of the same size.
+MULTI_DELETE_LIMIT = 1000
+
+# The crawled content type and metadata for a batch of copies are
+# looked up this many keys per query.
+KEY_INFO_QUERY_SIZE = 500
+
+# Per-key error codes in a multi-object delete response that
+# mean S3 might delete the key if we ask again.
+RETRYABLE_ERROR_CODES = ['InternalError', 'ServiceUnavailable', 'SlowDown']
+
+# Retries wait a random time of up to RETRY_BASE_DELAY * 2^attempt
+# seconds, but never more than RETRY_MAX_DELAY.
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30.0
+
+
+class RateLimiter(object):
     """
-    Copy files from S3 bucket in Virginia to Glacier in Oregon.
-    We're working on a list of items we know are in S3 but not
-    yet in Glacier.
+    Spaces out requests from any number of threads so that no more
+    than rate requests start per second. A rate of zero means no limit.
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_time = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class DeleteError(Exception):
+    """
+    A key that S3 failed to delete, from the errors in a
+    multi-object delete response.
+    """
+    def __init__(self, error_code, message):
+        Exception.__init__(self, "{0}: {1}".format(error_code, message))
+        self.error_code = error_code
+
+
+class WorkQueue(object):
+    """
+    The aws_files table as a queue of actions shared by any number of
+    cleanup_001 processes. Param worker_id identifies this process in
+    lease_owner. Copies and deletes are safe to repeat, so a row whose
+    lease expires while its action is still running does no harm
+    beyond a wasted request.
+    """
+    def __init__(self, conn, worker_id, lease_seconds=LEASE_SECONDS,
+                 max_attempts=MAX_ATTEMPTS):
+        self.conn = conn
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+    def lease_expiry(self):
+        return datetime.utcnow() + timedelta(seconds=self.lease_seconds)
+
+    def pending_count(self, action):
+        """
+        Returns the number of rows with the specified action that
+        aren't completed and haven't used up their attempts, including
+        rows other processes hold.
+        """
+        query = """select count(*) from aws_files where action = ?
+        and action_completed_at is null and attempts < ?"""
+        return self.conn.execute(
+            query, (action, self.max_attempts)).fetchone()[0]
+
+    def abandoned_count(self, action):
+        """
+        Returns the number of rows with the specified action that have
+        been claimed max_attempts times without being completed.
+        """
+        query = """select count(*) from aws_files where action = ?
+        and action_completed_at is null and attempts >= ?"""
+        return self.conn.execute(
+            query, (action, self.max_attempts)).fetchone()[0]
+
+    def claim(self, action, limit):
+        """
+        Leases up to limit rows with the specified action that aren't
+        completed and aren't leased by anyone, or whose lease has
+        expired. Returns (id, key) for each row claimed. The claim runs
+        in an immediate transaction, so no two processes can claim the
+        same row.
+        """
+        now = datetime.utcnow()
+        query = """select id, key from aws_files where action = ?
+        and action_completed_at is null and attempts < ?
+        and (lease_expires_at is null or lease_expires_at <= ?)
+        order by id limit ?"""
+        self.conn.commit()
+        self.conn.execute("begin immediate")
+        try:
+            rows = self.conn.execute(
+                query, (action, self.max_attempts, now, limit)).fetchall()
+            expires_at = self.lease_expiry()
+            self.conn.executemany("""update aws_files set lease_owner=?,
+            lease_expires_at=?, attempts=attempts + 1 where id=?""",
+                                  [(self.worker_id, expires_at, pk)
+                                   for pk, key in rows])
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+        return rows
+
+    def renew(self):
+        """
+        Extends the lease on every row this process holds.
+        """
+        self.conn.execute("""update aws_files set lease_expires_at=?
+        where lease_owner=? and action_completed_at is null""",
+                          (self.lease_expiry(), self.worker_id))
+        self.conn.commit()
+
+    def retire(self, completed, failed):
+        """
+        Records completed actions and releases the rows of failed ones.
+        Put a timestamp in the database, so we can create a PREMIS event
+        saying when the add/remove action was completed. Param completed
+        is a list of (completed_at, id) tuples, and param failed is a
+        list of (error, id) tuples. Failed rows can't be claimed again
+        until a lease would have expired.
+        """
+        self.conn.executemany("""update aws_files set action_completed_at=?,
+        lease_owner=null, lease_expires_at=null, last_error=null
+        where id=?""", completed)
+        expires_at = self.lease_expiry()
+        self.conn.executemany("""update aws_files set lease_owner=null,
+        lease_expires_at=?, last_error=? where id=?""",
+                              [(expires_at, str(err), pk)
+                               for err, pk in failed])
+        self.conn.commit()
+
+
+class ActionPool(object):
+    """
+    Runs one action (copy or delete) for many aws_files rows in a pool
+    of worker threads. Param action is a function that takes a list of
+    key names, does the work, and returns a dict of errors for any keys
+    that failed on their own (or None). It must call pool.request()
+    before each S3 request it makes, so the pool can enforce the rate
+    limit.
+    """
+    def __init__(self, concurrency=8, max_requests_per_second=0,
+                 retries=5, metrics=None, retry_base_delay=RETRY_BASE_DELAY):
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(max_requests_per_second)
+        self.retries = retries
+        self.retry_base_delay = retry_base_delay
+        self.metrics = metrics or Metrics('cleanup_001')
+
+    def request(self):
+        self.limiter.wait()
+
+    def run(self, queue, row_action, action, action_name, batch_size=1,
+            claim_size=CLAIM_SIZE, prepare=None, finished=None):
+        """
+        Claims the aws_files rows whose action is row_action ('add' or
+        'delete') from queue, runs action on their keys batch_size keys
+        at a time, and retires the rows. Param action_name describes
+        the action in the log and the metrics, e.g. 'copy to Glacier'.
+        Rows are claimed at least claim_size at a time. Param prepare,
+        if given, is called in this thread with the keys of each claim
+        before any of them go to the workers. Param finished, if given,
+        is called in this thread with each key once its action has
+        completed or failed for good, retries included. Returns the
+        number of rows that failed, once there are no more rows to
+        claim.
+        """
+        tasks = Queue()
+        results = Queue()
+        workers = []
+        for i in range(self.concurrency):
+            worker = threading.Thread(target=self.work,
+                                      args=(tasks, results, action))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        stop = threading.Event()
+        ticker = threading.Thread(target=self.tick, args=(
+            stop, results, queue.lease_seconds / 3.0))
+        ticker.daemon = True
+        ticker.start()
+        claim_size = max(batch_size, claim_size)
+        in_progress = 0
+        exhausted = False
+        failed = 0
+        completed = []
+        failures = []
+        while True:
+            # Claim more rows when the workers are about to run out,
+            # rather than leasing rows we won't get to for a while.
+            while not exhausted and in_progress < self.concurrency * batch_size:
+                with self.metrics.stage('claim'):
+                    rows = queue.claim(row_action, claim_size)
+                if not rows:
+                    exhausted = True
+                elif prepare:
+                    prepare([key for pk, key in rows])
+                for i in range(0, len(rows), batch_size):
+                    tasks.put(rows[i:i + batch_size])
+                in_progress += len(rows)
+            if not in_progress:
+                break
+            result = results.get()
+            if result is None:
+                queue.renew()
+                continue
+            pk, key, completed_at, err = result
+            in_progress -= 1
+            if finished:
+                finished(key)
+            if err is None:
+                sys.stderr.write("{0}: {1}\n".format(action_name, key))
+                completed.append((completed_at, pk))
+                self.metrics.count(action_name)
+            else:
+                sys.stderr.write("{0} failed: {1}: {2}\n".format(
+                    action_name, key, err))
+                failures.append((err, pk))
+                self.metrics.count(action_name + ' failed')
+                failed += 1
+            if len(completed) + len(failures) >= BATCH_SIZE:
+                self.retire(queue, completed, failures)
+                completed = []
+                failures = []
+            self.metrics.progress()
+        self.retire(queue, completed, failures)
+        stop.set()
+        for worker in workers:
+            tasks.put(None)
+        for worker in workers:
+            worker.join()
+        return failed
+
+    def tick(self, stop, results, interval):
+        """
+        Runs in its own thread. Puts None on results every interval
+        seconds until stop is set, so the main thread renews its leases
+        even when every worker is stuck on a slow request.
+        """
+        while not stop.wait(interval):
+            results.put(None)
+
+    def work(self, tasks, results, action):
+        """
+        Runs in each worker thread. Takes batches of rows from tasks
+        until it gets None, and puts (id, key, completed_at, error) on
+        results for each row.
+        """
+        while True:
+            batch = tasks.get()
+            if batch is None:
+                return
+            try:
+                errors = self.with_retries(action, [key for pk, key in batch])
+            except Exception as err:
+                errors = dict((key, err) for pk, key in batch)
+            completed_at = datetime.utcnow()
+            for pk, key in batch:
+                err = errors.get(key)
+                results.put((pk, key, None if err else completed_at, err))
+
+    def with_retries(self, action, keys):
+        """
+        Runs action on keys. If the request fails with a retryable
+        error, or some keys fail with retryable errors, waits and tries
+        again with just those keys, up to self.retries times. Returns a
+        dict of errors for the keys that still failed. Raises errors
+        that aren't worth retrying.
+        """
+        failures = {}
+        attempt = 0
+        while True:
+            try:
+                errors = action(keys) or {}
+            except Exception as err:
+                if not is_retryable(err):
+                    raise
+                errors = dict((key, err) for key in keys)
+            failures.update(errors)
+            keys = [key for key in keys
+                    if key in errors and is_retryable(errors[key])]
+            if not keys or attempt >= self.retries:
+                return failures
+            for key in keys:
+                del failures[key]
+            delay = min(RETRY_MAX_DELAY,
+                        self.retry_base_delay * 2 ** attempt)
+            self.metrics.count('retries')
+            with self.metrics.stage('backoff'):
+                time.sleep(random.uniform(0, delay))
+            attempt += 1
+
+    def retire(self, queue, completed, failures):
+        if not completed and not failures:
+            return
+        with self.metrics.stage('commit'):
+            queue.retire(completed, failures)
+
+
+def is_retryable(err):
+    """
+    Returns True for errors that may go away if we try again: S3 server
+    errors (including 503 SlowDown, which means we're being throttled)
+    and network errors. Client errors, such as a missing key or access
+    denied, won't.
+    """
+    if getattr(err, 'error_code', None) in RETRYABLE_ERROR_CODES:
+        return True
+    status = getattr(err, 'status', None)
+    if status is not None:
+        return status >= 500
+    return isinstance(err, IOError)
+
+def add_queue_columns_if_necessary(conn):
+    """
+    Summary databases created before cleanup_001 ran as a queue don't
+    have the lease and attempt columns on aws_files. Add them.
     """
     c = conn.cursor()
-    query = """select id, key from aws_files where action = 'add'
-    and action_completed_at is null"""
-    c.execute(query)
-    for row in c.fetchall():
-        pk = row[0]
-        uuid = row[1]
-        s3_url = S3_PREFIX + uuid
-        glacier_url = GLACIER_PREFIX + uuid
-        sys.stderr.write("Copying {0} to {1}\n".format(uuid, glacier_url))
-        copy_file(va_bucket, or_bucket, uuid)
-        mark_as_completed(conn, pk)
+    c.execute("PRAGMA table_info(aws_files)")
+    columns = [row[1] for row in c.fetchall()]
+    new_columns = [('lease_owner', 'varchar(80) null'),
+                   ('lease_expires_at', 'datetime null'),
+                   ('attempts', 'integer not null default 0'),
+                   ('last_error', 'varchar(255) null')]
+    for column, definition in new_columns:
+        if column not in columns:
+            print("Adding column {0} to aws_files".format(column))
+            statement = "alter table aws_files add column {0} {1}".format(
+                column, definition)
+            conn.execute(statement)
+            conn.commit()
+    c.execute("""SELECT name FROM sqlite_master WHERE type='index'
+    AND name='ix_aws_files_queue'""")
+    if not c.fetchone():
+        print("Creating index ix_aws_files_queue on aws_files")
+        statement = """create index ix_aws_files_queue
+        on aws_files(action, action_completed_at, lease_expires_at)"""
+        conn.execute(statement)
+        conn.commit()
     c.close()
 
-def copy_file(va_bucket, or_bucket, uuid):
+def crawled_key_info(conn, keys):
     """
-    This performs the remote copy.
+    Returns {key name: (content type, metadata)} for keys, from the
+    s3_keys and s3_meta tables of the crawl database attached as
+    'aptrust'. Keys the crawl didn't record, or recorded without a
+    content type or metadata, are left out. Returns an empty dict if
+    the crawl database isn't attached.
     """
-    key = va_bucket.get_key(uuid)
-    metadata = key.metadata
-    header_data = {"Content-Type": key.content_type }
-    print("    {0} to OR".format(uuid))
-    or_bucket.copy_key(uuid, VA_BUCKET_NAME, uuid, headers=header_data, metadata=metadata)
+    attached = [row[1] for row in conn.execute("pragma database_list")]
+    if 'aptrust' not in attached:
+        return {}
+    info = {}
+    # SQLite before 3.32 allows at most 999 parameters per statement.
+    for i in range(0, len(keys), KEY_INFO_QUERY_SIZE):
+        chunk = keys[i:i + KEY_INFO_QUERY_SIZE]
+        query = """select k.name, k.content_type, m.name, m.value
+        from aptrust.s3_keys k
+        inner join aptrust.s3_meta m on m.key_id = k.id
+        where k.bucket = ? and k.name in ({0}) and k.deleted_at is null
+        and k.content_type is not null and k.content_type != ?
+        and not exists (select 1 from aptrust.s3_keys newer
+          where newer.bucket = k.bucket and newer.name = k.name
+          and newer.deleted_at is null and newer.id > k.id)""".format(
+              ",".join("?" * len(chunk)))
+        params = [VA_BUCKET_NAME] + chunk + [DEFAULT_CONTENT_TYPE]
+        for key, content_type, name, value in conn.execute(query, params):
+            if key not in info:
+                info[key] = (content_type, {})
+            info[key][1][name] = value
+    return info
 
-def mark_as_completed(conn, pk):
+def copy_missing_files_to_glacier(queue, va_bucket, or_bucket, pool):
     """
-    Put a timestamp in the database, so we can create a PREMIS event saying
-    when the add/remove action was completed.
+    Copy files from S3 bucket in Virginia to Glacier in Oregon.
+    We're working on a list of items we know are in S3 but not
+    yet in Glacier. Rows are claimed MULTI_DELETE_LIMIT at a time, and
+    the crawled content type and metadata of each claim's keys are
+    looked up as it's claimed, so we only hold them for the keys we're
+    working on. Returns the number of copies that failed.
     """
-    cursor = conn.cursor()
-    statement = "update aws_files set action_completed_at=? where id=?"
-    now = datetime.utcnow()
-    values = (now, pk,)
-    print("    {0}").format(now.isoformat())
-    cursor.execute(statement, values)
-    conn.commit()
-    cursor.close()
+    key_info = {}
+    pool.metrics.set_totals(
+        total=pool.metrics.items + queue.pending_count('add'))
+    def prepare(uuids):
+        with pool.metrics.stage('key info'):
+            key_info.update(crawled_key_info(queue.conn, uuids))
+    def copy(uuids):
+        # Retries call this again, so the info stays until the row is
+        # finished.
+        content_type, metadata = key_info.get(uuids[0], (None, None))
+        copy_file(va_bucket, or_bucket, uuids[0], pool, content_type, metadata)
+    def finished(uuid):
+        key_info.pop(uuid, None)
+    return pool.run(queue, 'add', copy, 'copy to Glacier',
+                    claim_size=MULTI_DELETE_LIMIT, prepare=prepare,
+                    finished=finished)
 
-def delete_duplicate_files(conn, va_bucket):
+def copy_file(va_bucket, or_bucket, uuid, pool, content_type=None,
+              metadata=None):
+    """
+    This performs the remote copy. Passing metadata makes S3 replace the
+    key's metadata and content type instead of copying them, so we pass
+    the ones the crawl recorded. If we don't have them, we ask S3.
+    """
+    if content_type is None or metadata is None:
+        pool.metrics.count('head fallback')
+        pool.request()
+        with pool.metrics.stage('head'):
+            key = va_bucket.get_key(uuid)
+        content_type = key.content_type
+        metadata = key.metadata
+    header_data = {"Content-Type": content_type }
+    pool.request()
+    with pool.metrics.stage('copy'):
+        or_bucket.copy_key(uuid, VA_BUCKET_NAME, uuid, headers=header_data, metadata=metadata)
+
+def delete_duplicate_files(queue, va_bucket, pool):
     """
     For files that were ingested twice, we want to delete one of the duplicates.
     The duplicates are in S3 only. There are no duplicates in Glacier.
+    Returns the number of deletes that failed.
     """
-    c = conn.cursor()
-    query = """select id, key from aws_files where action = 'delete'
-    and action_completed_at is null"""
-    c.execute(query)
-    for row in c.fetchall():
-        pk = row[0]
-        uuid = row[1]
-        s3_url = S3_PREFIX + uuid
-        sys.stderr.write("Removing {0}\n".format(uuid))
-        delete_file(va_bucket, uuid)
-        mark_as_completed(conn, pk)
-    c.close()
+    pool.metrics.set_totals(
+        total=pool.metrics.items + queue.pending_count('delete'))
+    def delete(uuids):
+        return delete_files(va_bucket, uuids, pool)
+    return pool.run(queue, 'delete', delete, 'delete from S3',
+                    batch_size=MULTI_DELETE_LIMIT)
 
-def delete_file(va_bucket, uuid):
+def delete_files(va_bucket, uuids, pool):
     """
-    Deletes a file from our S3 bucket in Virginia.
+    Deletes up to MULTI_DELETE_LIMIT files from our S3 bucket in Virginia
+    with a single multi-object delete request. S3 reports errors for
+    each key separately, so some keys can fail while the rest are
+    deleted. Returns a dict of DeleteErrors for the keys that failed.
     """
-    key = va_bucket.get_key(uuid)
-    print("    {0} deleted from VA".format(uuid))
-    va_bucket.delete_key(uuid)
+    pool.request()
+    with pool.metrics.stage('delete'):
+        # In quiet mode, the response lists only the keys that failed.
+        result = va_bucket.delete_keys(uuids, quiet=True)
+    errors = {}
+    for error in result.errors:
+        errors[error.key] = DeleteError(error.code, error.message)
+    return errors
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Copy missing files to Glacier and delete duplicates '
+        'from S3, as listed in db/audit001_summary.db')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help="Number of copies or deletes to run at once")
+    parser.add_argument('--max-requests-per-second', type=float, default=100,
+                        help="Cap on S3 requests per second across all "
+                        "workers. 0 means no cap.")
+    parser.add_argument('--retries', type=int, default=5,
+                        help="Times to retry a request that fails with "
+                        "a server or network error")
+    parser.add_argument('--worker-id',
+                        default="{0}:{1}".format(socket.gethostname(),
+                                                 os.getpid()),
+                        help="Name for this process in the lease_owner "
+                        "column. Defaults to hostname:pid.")
+    parser.add_argument('--lease-seconds', type=int, default=LEASE_SECONDS,
+                        help="Seconds before rows claimed by a process "
+                        "that stopped renewing them can be claimed again")
+    parser.add_argument('--max-attempts', type=int, default=MAX_ATTEMPTS,
+                        help="Stop claiming rows that have been claimed "
+                        "this many times without being completed")
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics = metrics_from_args('cleanup_001', args)
+    pool = ActionPool(args.concurrency, args.max_requests_per_second,
+                      args.retries, metrics)
     s3 = S3Connection()
     va_bucket = s3.get_bucket(VA_BUCKET_NAME)
     or_bucket = s3.get_bucket(OR_BUCKET_NAME)
-    conn = sqlite3.connect('db/audit001_summary.db')
+    # Other cleanup_001 processes may hold the write lock for a moment
+    # while they claim or retire rows.
+    conn = sqlite3.connect('db/audit001_summary.db', timeout=60)
+    add_queue_columns_if_necessary(conn)
+    queue = WorkQueue(conn, args.worker_id, args.lease_seconds,
+                      args.max_attempts)
+    if os.path.exists(CRAWL_DB_PATH):
+        conn.execute("attach ? as aptrust", (CRAWL_DB_PATH,))
+    else:
+        print("{0} not found. Fetching metadata from S3 for every "
+              "copy.".format(CRAWL_DB_PATH))
     print("--- Copying to Glacier ---")
-    copy_missing_files_to_glacier(conn, va_bucket, or_bucket)
+    failed = copy_missing_files_to_glacier(queue, va_bucket, or_bucket, pool)
     print("--- Deleting duplicates from S3 ---")
-    delete_duplicate_files(conn, va_bucket)
+    failed += delete_duplicate_files(queue, va_bucket, pool)
+    abandoned = queue.abandoned_count('add') + queue.abandoned_count('delete')
     conn.close()
+    metrics.finish()
+    if abandoned:
+        print("{0} actions have been tried {1} times and won't be retried. "
+              "See last_error in aws_files.".format(abandoned,
+                                                     args.max_attempts))
+    if failed:
+        print("{0} actions failed. Run again to retry them.".format(failed))
+        sys.exit(1)
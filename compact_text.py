@@ -0,0 +1,306 @@
+#! /usr/bin/env python
+# compact_text.py
+"""
+Shrinks aptrust.db by storing its long, repetitive text columns once.
+Fluctus error bodies and event details repeat thousands of times, so
+most of the space in these columns holds copies:
+
+    events.detail, events.outcome_information,
+    ingest_records.error_message, ingest_fetch_results.warning,
+    ingest_checksum_errors.error_message
+
+Each distinct value goes into the text_store table once, keyed by its
+SHA-1. With --compress, values are also zlib-compressed when that makes
+them smaller. The table is renamed to <table>_compact. Its text
+columns are emptied, and each value is replaced by an id in
+<column>_text_id. A view with the table's old name and columns reads
+the text back, so queries and scripts don't change.
+
+Compressed values are stored the way SQLite archives store files, and
+read back with sqlar_uncompress(). The sqlite3 shell has that function
+built in. Python scripts must call register_functions(conn) before
+they read these tables. The audit scripts in this repo do that.
+
+Run this after merge_dbs.sql, and after shard_by_institution.py, which
+needs the plain tables. --expand puts the text back into the tables.
+
+Usage:
+
+python compact_text.py
+python compact_text.py --compress
+python compact_text.py --db db/shards/test.edu.db --compress
+python compact_text.py --expand
+"""
+import argparse
+import hashlib
+import os
+import sqlite3
+import zlib
+
+from metrics import add_metrics_arguments, metrics_from_args
+
+DB_PATH = 'db/aptrust.db'
+
+# The tables and columns to store in text_store.
+COMPACT_COLUMNS = [
+    ('events', ['detail', 'outcome_information']),
+    ('ingest_records', ['error_message']),
+    ('ingest_fetch_results', ['warning']),
+    ('ingest_checksum_errors', ['error_message']),
+]
+
+COMPACT_SUFFIX = '_compact'
+
+# Values are added to text_store in batches of this many.
+BATCH_SIZE = 5000
+
+
+def text_hash(text):
+    """
+    Returns the SHA-1 hex digest of text, which is how text_store
+    finds a value. Returns None for None.
+    """
+    if text is None:
+        return None
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def sqlar_compress(data):
+    """
+    Returns data zlib-compressed, or data itself if compressing doesn't
+    make it smaller. This is what the sqlite3 shell's sqlar_compress()
+    does, so sqlar_uncompress() can read it.
+    """
+    compressed = zlib.compress(data)
+    if len(compressed) < len(data):
+        return compressed
+    return data
+
+def sqlar_uncompress(data, size):
+    """
+    The sqlite3 shell's sqlar_uncompress(), for Python connections.
+    Returns data as is if it's already size bytes long, which means it
+    was stored uncompressed.
+    """
+    if data is None:
+        return None
+    if len(data) == size:
+        return data
+    return sqlite3.Binary(zlib.decompress(bytes(data)))
+
+def register_functions(conn):
+    """
+    Adds the functions the compacted tables' views call to a
+    connection. Call this before reading aptrust.db from Python.
+    """
+    conn.create_function('sqlar_uncompress', 2, sqlar_uncompress)
+
+def compacted_columns(conn):
+    """
+    Returns a dict of table name => list of columns that are stored
+    in text_store.
+    """
+    columns = {}
+    if not table_exists(conn, 'compact_text_columns'):
+        return columns
+    for table, column in conn.execute("""select table_name, column_name
+    from compact_text_columns order by rowid"""):
+        columns.setdefault(table, []).append(column)
+    return columns
+
+def table_exists(conn, name):
+    query = "select 1 from sqlite_master where type='table' and name=?"
+    return conn.execute(query, (name,)).fetchone() is not None
+
+def create_tables_if_necessary(conn):
+    if not table_exists(conn, 'text_store'):
+        print("Creating table text_store")
+        conn.execute("""create table text_store(
+        id integer primary key autoincrement,
+        hash varchar(40) not null,
+        size int not null,
+        body blob not null)""")
+        print("Creating unique index ix_text_store_hash on text_store")
+        conn.execute("create unique index ix_text_store_hash on text_store(hash)")
+    if not table_exists(conn, 'compact_text_columns'):
+        print("Creating table compact_text_columns")
+        conn.execute("""create table compact_text_columns(
+        table_name varchar(80) not null,
+        column_name varchar(80) not null)""")
+
+def store_texts(conn, table, column, compress, metrics):
+    """
+    Adds each distinct value of table.column to text_store, unless
+    it's already there.
+    """
+    statement = """insert or ignore into text_store(hash, size, body)
+    values (?,?,?)"""
+    cursor = conn.cursor()
+    cursor.execute("select distinct {0} from {1} where {0} is not null".format(
+        column, table))
+    while True:
+        rows = cursor.fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+        values = []
+        for row in rows:
+            data = row[0].encode('utf-8')
+            if compress:
+                body = sqlar_compress(data)
+            else:
+                body = data
+            values.append((text_hash(row[0]), len(data), sqlite3.Binary(body)))
+        conn.executemany(statement, values)
+        metrics.progress(items=len(rows))
+    cursor.close()
+
+def compact_table(conn, table, columns, compress, metrics):
+    """
+    Moves the text in table's columns to text_store, and puts a view in
+    the table's place. Runs in one transaction.
+    """
+    conn.create_function('text_hash', 1, text_hash)
+    stored = table + COMPACT_SUFFIX
+    conn.execute("begin")
+    for column in columns:
+        with metrics.stage('store'):
+            store_texts(conn, table, column, compress, metrics)
+    conn.execute("alter table {0} rename to {1}".format(table, stored))
+    existing = [row[1] for row in conn.execute(
+        "pragma table_info({0})".format(stored))]
+    assignments = []
+    for column in columns:
+        if column + '_text_id' not in existing:
+            conn.execute("alter table {0} add column {1}_text_id int".format(
+                stored, column))
+        assignments.append("""{0}_text_id = (select s.id from text_store s
+        where s.hash = text_hash({0})), {0} = null""".format(column))
+        conn.execute("""insert into compact_text_columns(table_name,
+        column_name) values (?,?)""", (table, column))
+    with metrics.stage('update'):
+        conn.execute("update {0} set {1}".format(stored,
+                                                 ", ".join(assignments)))
+    conn.execute("commit")
+
+def expand_table(conn, table, columns, metrics):
+    """
+    Puts the text from text_store back into table's columns, and
+    replaces the view with the table. Runs in one transaction.
+    """
+    stored = table + COMPACT_SUFFIX
+    conn.execute("begin")
+    conn.execute("drop view if exists {0}".format(table))
+    assignments = ["""{0} = (select cast(sqlar_uncompress(s.body, s.size) as text)
+    from text_store s where s.id = {0}_text_id), {0}_text_id = null""".format(
+        column) for column in columns]
+    with metrics.stage('update'):
+        conn.execute("update {0} set {1}".format(stored,
+                                                 ", ".join(assignments)))
+    conn.execute("alter table {0} rename to {1}".format(stored, table))
+    # SQLite can only drop columns from 3.35 on. With an older one, the
+    # empty id columns stay, and compact_table reuses them.
+    if sqlite3.sqlite_version_info >= (3, 35, 0):
+        for column in columns:
+            conn.execute("alter table {0} drop column {1}_text_id".format(
+                table, column))
+    conn.execute("delete from compact_text_columns where table_name=?",
+                 (table,))
+    conn.execute("commit")
+
+def create_views(conn):
+    """
+    (Re)creates the view for each compacted table. The views only call
+    sqlar_uncompress() if text_store holds compressed values, so an
+    uncompressed database can be read without it.
+    """
+    compressed = conn.execute("""select exists(select 1 from text_store
+    where length(body) != size)""").fetchone()[0]
+    if compressed:
+        text = "cast(sqlar_uncompress(s.body, s.size) as text)"
+    else:
+        text = "cast(s.body as text)"
+    conn.execute("begin")
+    for table, columns in compacted_columns(conn).items():
+        stored = table + COMPACT_SUFFIX
+        select_list = []
+        for row in conn.execute("pragma table_info({0})".format(stored)):
+            name = row[1]
+            if name in columns:
+                select_list.append("""(select {0} from text_store s
+                where s.id = t.{1}_text_id) as {1}""".format(text, name))
+            elif not (name.endswith('_text_id') and
+                      name[:-len('_text_id')] in columns):
+                select_list.append("t." + name)
+        conn.execute("drop view if exists {0}".format(table))
+        conn.execute("create view {0} as select {1} from {2} t".format(
+            table, ", ".join(select_list), stored))
+    conn.execute("commit")
+
+def delete_unused_texts(conn):
+    """
+    Deletes the values in text_store that no compacted column uses.
+    """
+    used = []
+    for table, columns in compacted_columns(conn).items():
+        for column in columns:
+            # Rows with no text have a null id. A null in the list
+            # would make "not in" match nothing.
+            used.append("""select {0}_text_id from {1}{2}
+            where {0}_text_id is not null""".format(
+                column, table, COMPACT_SUFFIX))
+    if used:
+        conn.execute("delete from text_store where id not in ({0})".format(
+            " union ".join(used)))
+    else:
+        conn.execute("delete from text_store")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Store repetitive text columns of aptrust.db once')
+    parser.add_argument('--db', default=DB_PATH,
+                        help="Database to compact. Defaults to db/aptrust.db")
+    parser.add_argument('--compress', action='store_true',
+                        help="zlib-compress the stored text too")
+    parser.add_argument('--expand', action='store_true',
+                        help="Put the text back into the tables")
+    parser.add_argument('--no-vacuum', action='store_true',
+                        help="Skip the VACUUM that gives the freed space "
+                        "back to the filesystem")
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics = metrics_from_args('compact_text', args)
+
+    size_before = os.path.getsize(args.db)
+    conn = sqlite3.connect(args.db)
+    # Transactions are managed explicitly, so the DDL and the updates
+    # for each table commit or roll back together.
+    conn.isolation_level = None
+    register_functions(conn)
+    create_tables_if_necessary(conn)
+    done = compacted_columns(conn)
+    for table, columns in COMPACT_COLUMNS:
+        if args.expand:
+            if table in done:
+                print("Expanding {0}".format(table))
+                expand_table(conn, table, done[table], metrics)
+        elif table in done:
+            print("{0} is already compacted".format(table))
+        else:
+            print("Compacting {0}".format(table))
+            compact_table(conn, table, columns, args.compress, metrics)
+    with metrics.stage('views'):
+        create_views(conn)
+    with metrics.stage('delete unused'):
+        delete_unused_texts(conn)
+    if not args.no_vacuum:
+        with metrics.stage('vacuum'):
+            conn.execute("vacuum")
+    values, size, stored = conn.execute("""select count(*),
+    coalesce(sum(size), 0), coalesce(sum(length(body)), 0)
+    from text_store""").fetchone()
+    conn.close()
+    print("text_store holds {0} distinct values, {1:.1f} MB of text in "
+          "{2:.1f} MB".format(values, size / 1048576.0, stored / 1048576.0))
+    print("{0} went from {1:.1f} MB to {2:.1f} MB".format(
+        args.db, size_before / 1048576.0, os.path.getsize(args.db) / 1048576.0))
+    metrics.finish()
@@ -0,0 +1,319 @@
+#! /usr/bin/env python
+# compare_checksums.py
+"""
+Compares the sizes and checksums that three systems recorded for each
+stored file, in one pass over db/aptrust.db:
+
+  ingest   ingest_generic_files: size, md5 and sha256 calculated at
+           ingest, by storage_uuid
+  fedora   files and checksums: size and latest md5 and sha256, by
+           uri_uuid
+  s3       s3_keys and s3_meta in the preservation bucket: size, etag
+           and the md5 and sha256 metadata, by key name
+
+Each source is read with one query sorted by UUID, which SQLite
+answers by walking the UUID index, and the three sorted streams are
+merge-joined in Python. Only the rows for one UUID are held at a time,
+so memory doesn't grow with the number of files, and no query joins
+the sources to each other.
+
+For each UUID, the latest ingest record and the newest undeleted S3
+key are compared with each Fedora file. An S3 etag is an md5 unless
+the key was uploaded in parts (its etag then contains a '-'). The
+problems go to the findings table (see audit_rules.py), as one audit
+run, under these rules:
+
+  size_mismatch      the sources don't agree on the size
+  md5_mismatch       the sources don't agree on the md5
+  sha256_mismatch    the sources don't agree on the sha256
+  missing_md5        ingest or Fedora has no md5 for the file
+  missing_sha256     ingest or Fedora has no sha256 for the file
+  missing_fedora     S3 has the UUID, but Fedora doesn't
+  missing_s3         Fedora has an active file with the UUID, but S3
+                     doesn't
+
+UUIDs that only the ingest logs know about aren't reported as
+missing: a failed ingest never stores its files.
+
+Usage:
+
+python compare_checksums.py
+python compare_checksums.py --bucket aptrust.preservation.oregon
+"""
+import argparse
+import itertools
+import sqlite3
+from datetime import datetime
+
+from audit_rules import create_findings_tables
+from compact_text import register_functions
+from metrics import add_metrics_arguments, metrics_from_args
+from reconcile_files import S3_BUCKET
+
+DB_PATH = 'db/aptrust.db'
+
+# Findings are written in batches of this many rows.
+BATCH_SIZE = 5000
+
+RULES = ['size_mismatch', 'md5_mismatch', 'sha256_mismatch', 'missing_md5',
+         'missing_sha256', 'missing_fedora', 'missing_s3']
+
+# Each query returns rows whose first column is the UUID, sorted by
+# UUID and then by id, so that the rows for one file are adjacent and
+# the newest comes last.
+INGEST_QUERY = """select igf.storage_uuid, igf.id, igf.identifier, igf.size,
+  igf.md5, igf.sha256
+from ingest_generic_files igf
+where igf.storage_uuid is not null
+order by igf.storage_uuid, igf.id"""
+
+# One row per checksum. Files with no checksums get one row with a
+# null algorithm.
+FEDORA_QUERY = """select f.uri_uuid, f.id, f.identifier, f.size, f.state,
+  c.algorithm, c.digest, c.date_time
+from files f
+left join checksums c on c.file_id = f.id
+where f.uri_uuid is not null
+order by f.uri_uuid, f.id"""
+
+# One row per md5 or sha256 metadata value. Keys with neither get one
+# row with a null name.
+S3_QUERY = """select k.name, k.id, k.size, k.etag, m.name, m.value
+from s3_keys k
+left join s3_meta m on m.key_id = k.id and m.name in ('md5', 'sha256')
+where k.bucket = ? and k.deleted_at is null
+order by k.name, k.id"""
+
+
+class UnsortedStream(Exception):
+    """
+    A source query returned its UUIDs out of order, so the merge join
+    would miss matches.
+    """
+    pass
+
+
+def uuid_groups(name, cursor):
+    """
+    Yields (uuid, rows) for each UUID in a cursor sorted by UUID.
+    Raises UnsortedStream if a UUID is smaller than the one before.
+    """
+    previous = None
+    for uuid, rows in itertools.groupby(cursor, lambda row: row[0]):
+        if previous is not None and uuid < previous:
+            raise UnsortedStream("{0} returned {1} after {2}".format(
+                name, uuid, previous))
+        previous = uuid
+        yield uuid, list(rows)
+
+def merge_sources(sources):
+    """
+    Merge-joins (name, groups) pairs, where groups come from
+    uuid_groups. Yields (uuid, dict of source name => rows) for every
+    UUID in any source, in order. Sources without the UUID are left
+    out of the dict.
+    """
+    heads = {}
+    for name, groups in sources:
+        head = next(groups, None)
+        if head is not None:
+            heads[name] = (head, groups)
+    while heads:
+        uuid = min(head[0] for head, groups in heads.values())
+        matched = {}
+        for name in list(heads.keys()):
+            head, groups = heads[name]
+            if head[0] == uuid:
+                matched[name] = head[1]
+                head = next(groups, None)
+                if head is None:
+                    del heads[name]
+                else:
+                    heads[name] = (head, groups)
+        yield uuid, matched
+
+def ingest_record(rows):
+    """
+    Returns the latest ingest record for a UUID as a dict.
+    """
+    uuid, generic_file_id, identifier, size, md5, sha256 = rows[-1]
+    return {'id': generic_file_id, 'identifier': identifier, 'size': size,
+            'md5': md5, 'sha256': sha256}
+
+def fedora_files(rows):
+    """
+    Returns a dict for each Fedora file with a UUID, with its latest
+    md5 and sha256.
+    """
+    files = []
+    for file_id, file_rows in itertools.groupby(rows, lambda row: row[1]):
+        f = {'id': file_id, 'md5': None, 'sha256': None}
+        dates = {}
+        for row in file_rows:
+            identifier, size, state, algorithm, digest, date_time = row[2:]
+            f['identifier'] = identifier
+            f['size'] = size
+            f['state'] = state
+            if algorithm in ('md5', 'sha256') and (
+                    algorithm not in dates or date_time >= dates[algorithm]):
+                f[algorithm] = digest
+                dates[algorithm] = date_time
+        files.append(f)
+    return files
+
+def s3_key(rows):
+    """
+    Returns the newest S3 key for a UUID as a dict, with its etag as
+    an md5 if it is one, and its md5 and sha256 metadata.
+    """
+    latest = rows[-1][1]
+    key = {'id': latest, 'etag_md5': None, 'md5': None, 'sha256': None}
+    for name, key_id, size, etag, meta_name, value in rows:
+        if key_id != latest:
+            continue
+        key['size'] = size
+        if etag and '-' not in etag:
+            key['etag_md5'] = etag
+        if meta_name:
+            key[meta_name] = value
+    return key
+
+def disagreement(values):
+    """
+    Returns "source value, ..." for the (source, value) pairs if the
+    non-null values aren't all the same, otherwise None. Digests are
+    compared without regard to case.
+    """
+    values = [(source, value) for source, value in values if value is not None]
+    if len(set(str(value).lower() for source, value in values)) > 1:
+        return ", ".join("{0} {1}".format(source, value)
+                         for source, value in values)
+    return None
+
+def compare(uuid, matched):
+    """
+    Returns a list of (rule, generic_file_id, identifier, detail) for
+    the problems with one UUID.
+    """
+    ingest = None
+    if 'ingest' in matched:
+        ingest = ingest_record(matched['ingest'])
+    files = []
+    if 'fedora' in matched:
+        files = fedora_files(matched['fedora'])
+    key = None
+    if 's3' in matched:
+        key = s3_key(matched['s3'])
+    generic_file_id = ingest['id'] if ingest else None
+
+    problems = []
+    if not files:
+        if key:
+            problems.append(('missing_fedora', generic_file_id,
+                             ingest['identifier'] if ingest else None,
+                             "UUID {0} is in S3, but not in Fedora".format(
+                                 uuid)))
+        # Still compare the ingest record with the key.
+        files = [None]
+    elif not key and any(f['state'] == 'A' for f in files):
+        problems.append(('missing_s3', generic_file_id, files[0]['identifier'],
+                         "UUID {0} is not in S3".format(uuid)))
+
+    for f in files:
+        identifier = (f or ingest or {}).get('identifier')
+        sizes = [('ingest', ingest and ingest['size']),
+                 ('fedora', f and f['size']),
+                 ('s3', key and key['size'])]
+        md5s = [('ingest', ingest and ingest['md5']),
+                ('fedora', f and f['md5']),
+                ('s3 etag', key and key['etag_md5']),
+                ('s3 metadata', key and key['md5'])]
+        sha256s = [('ingest', ingest and ingest['sha256']),
+                   ('fedora', f and f['sha256']),
+                   ('s3 metadata', key and key['sha256'])]
+        for rule, values in [('size_mismatch', sizes),
+                             ('md5_mismatch', md5s),
+                             ('sha256_mismatch', sha256s)]:
+            detail = disagreement(values)
+            if detail:
+                problems.append((rule, generic_file_id, identifier,
+                                 "UUID {0}: {1}".format(uuid, detail)))
+        for algorithm in ['md5', 'sha256']:
+            missing = []
+            if ingest and not ingest[algorithm]:
+                missing.append('ingest')
+            if f and not f[algorithm]:
+                missing.append('fedora')
+            if missing:
+                problems.append(('missing_' + algorithm, generic_file_id,
+                                 identifier, "UUID {0}: no {1} in {2}".format(
+                                     uuid, algorithm, " or ".join(missing))))
+    return problems
+
+def compare_checksums(conn, bucket=S3_BUCKET, metrics=None):
+    """
+    Streams the three sources, compares them UUID by UUID, and writes
+    the problems to the findings table as one audit run. Returns the
+    id of the run.
+    """
+    create_findings_tables(conn)
+    c = conn.cursor()
+    c.execute("insert into audit_runs(started_at, rules) values (?,?)",
+              (datetime.utcnow(), ",".join(RULES)))
+    run_id = c.lastrowid
+    conn.commit()
+
+    ingest = conn.execute(INGEST_QUERY)
+    fedora = conn.execute(FEDORA_QUERY)
+    s3 = conn.execute(S3_QUERY, (bucket,))
+    sources = [('ingest', uuid_groups('ingest', ingest)),
+               ('fedora', uuid_groups('fedora', fedora)),
+               ('s3', uuid_groups('s3', s3))]
+
+    statement = """insert into findings(run_id, rule, generic_file_id,
+    identifier, detail) values (?,?,?,?,?)"""
+    uuids_compared = 0
+    findings = []
+    finding_count = 0
+    for uuid, matched in merge_sources(sources):
+        uuids_compared += 1
+        if 'fedora' in matched or 's3' in matched:
+            for problem in compare(uuid, matched):
+                findings.append((run_id,) + problem)
+        if len(findings) >= BATCH_SIZE:
+            conn.executemany(statement, findings)
+            finding_count += len(findings)
+            findings = []
+        if metrics:
+            metrics.progress()
+    conn.executemany(statement, findings)
+    finding_count += len(findings)
+    for cursor in [ingest, fedora, s3]:
+        cursor.close()
+
+    conn.execute("""update audit_runs set finished_at=?, rows_scanned=?,
+    finding_count=? where id=?""", (datetime.utcnow(), uuids_compared,
+                                   finding_count, run_id))
+    conn.commit()
+    print("Compared {0} UUIDs. Recorded {1} findings as run {2}".format(
+        uuids_compared, finding_count, run_id))
+    return run_id
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Compare ingest, Fedora and S3 sizes and checksums '
+        'in one pass')
+    parser.add_argument('--db', default=DB_PATH,
+                        help="Database to audit. Defaults to db/aptrust.db")
+    parser.add_argument('--bucket', default=S3_BUCKET,
+                        help="S3 bucket to compare. Defaults to the "
+                        "preservation bucket.")
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics = metrics_from_args('compare_checksums', args)
+    conn = sqlite3.connect(args.db)
+    register_functions(conn)
+    compare_checksums(conn, args.bucket, metrics)
+    conn.close()
+    metrics.finish()
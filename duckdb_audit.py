@@ -0,0 +1,304 @@
+#! /usr/bin/env python3
+# duckdb_audit.py
+"""
+Runs audit SQL scripts, such as build_audit_001_tables.sql and
+audit_001_rollups.sql, on DuckDB instead of SQLite, and writes the
+tables they build back into db/aptrust.db with the same columns,
+defaults and indexes the sqlite3 command would give them.
+
+SQLite runs each of those joins and rollups on one core, a row at a
+time. DuckDB runs them on every core, a column at a time, which pays
+off once aptrust.db runs to several GB.
+
+The tables the scripts read are first exported from aptrust.db into
+a DuckDB database file, db/aptrust.duckdb. Values are copied exactly
+as SQLite stores them (dates stay strings), through a CSV file that
+DuckDB loads in parallel. The export is reused until aptrust.db
+changes, so only the first run pays for it. aptrust.db is only read
+until the end, when the result tables are replaced in one transaction.
+
+Each script must be a series of statements like the ones in
+build_audit_001_tables.sql: drop table, create table, insert ...
+select, update and create index. Tables are built in DuckDB. Indexes
+are only created in SQLite.
+
+DuckDB is optional. Unlike the rest of these scripts, this one needs
+Python 3, and exits with a message if it's run with Python 2:
+
+pip3 install duckdb
+
+Usage:
+
+python3 duckdb_audit.py build_audit_001_tables.sql audit_001_rollups.sql
+python3 duckdb_audit.py --threads 8 --memory-limit 16GB build_audit_001_tables.sql
+python3 duckdb_audit.py --refresh audit_001_rollups.sql    # export again
+"""
+import argparse
+import csv
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+
+from compact_text import register_functions
+from metrics import add_metrics_arguments, metrics_from_args
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+DB_PATH = 'db/aptrust.db'
+DUCKDB_PATH = 'db/aptrust.duckdb'
+
+# Stands for NULL in the export CSV files, so NULLs and empty
+# strings survive the trip.
+CSV_NULL = '\\N'
+
+# Result rows are written back to SQLite in batches of this many.
+BATCH_SIZE = 10000
+
+CREATE_TABLE_PATTERN = re.compile(r'^create\s+table\s+(\w+)', re.IGNORECASE)
+DROP_TABLE_PATTERN = re.compile(r'^drop\s+table\s+(?:if\s+exists\s+)?(\w+)',
+                                re.IGNORECASE)
+INDEX_TABLE_PATTERN = re.compile(r'\bon\s+(\w+)\s*\(', re.IGNORECASE)
+TABLE_REFERENCE_PATTERN = re.compile(r'\b(?:from|join)\s+(\w+)', re.IGNORECASE)
+
+
+def read_statements(path):
+    """
+    Returns the statements in a .sql file, without full-line comments.
+    """
+    statements = []
+    statement = ''
+    with open(path) as f:
+        for line in f:
+            if line.strip().startswith('--'):
+                continue
+            statement += line
+            if sqlite3.complete_statement(statement):
+                statements.append(statement.strip())
+                statement = ''
+    return statements
+
+def statement_kind(sql):
+    """
+    Returns 'create table', 'create index', 'drop table' or the first
+    word of any other statement, in lower case.
+    """
+    words = sql.lower().split()
+    if words[0] == 'create' and words[1] == 'unique':
+        return 'create index'
+    if words[0] in ('create', 'drop'):
+        return words[0] + ' ' + words[1]
+    return words[0]
+
+def created_tables(statements):
+    """
+    Returns the names of the tables the statements create, in order,
+    leaving out working tables that a later statement drops again.
+    """
+    tables = []
+    for sql in statements:
+        match = CREATE_TABLE_PATTERN.match(sql)
+        if match and match.group(1) not in tables:
+            tables.append(match.group(1))
+        match = DROP_TABLE_PATTERN.match(sql)
+        if match and match.group(1) in tables:
+            tables.remove(match.group(1))
+    return tables
+
+def source_tables(sqlite_conn, statements):
+    """
+    Returns the tables in aptrust.db that the statements read, other
+    than the ones they create themselves.
+    """
+    # Tables compacted by compact_text.py are views.
+    existing = set(row[0] for row in sqlite_conn.execute(
+        "select name from sqlite_master where type in ('table', 'view')"))
+    created = set(match.group(1) for match in
+                  (CREATE_TABLE_PATTERN.match(sql) for sql in statements)
+                  if match)
+    tables = []
+    for sql in statements:
+        for name in TABLE_REFERENCE_PATTERN.findall(sql):
+            if name in existing and name not in created and name not in tables:
+                tables.append(name)
+    return tables
+
+def duckdb_type(declared_type):
+    """
+    Maps a SQLite column type to the DuckDB type the column's values
+    are loaded as. Only columns with INTEGER affinity (a type that
+    contains "int") are loaded as numbers. Every other column is
+    loaded as a string. Columns declared bool or datetime have NUMERIC
+    affinity, and SQLite keeps any value that doesn't look like a
+    number in them as text. The loaders store timestamps in
+    ingest_generic_files.md5_verified, for instance.
+    """
+    if 'int' in (declared_type or '').lower():
+        return 'BIGINT'
+    return 'VARCHAR'
+
+def export_tables(duck, sqlite_conn, tables, sqlite_mtime, work_dir,
+                  refresh=False):
+    """
+    Copies each of the tables from aptrust.db into the DuckDB database,
+    unless it was exported since aptrust.db last changed.
+    """
+    duck.execute("""create table if not exists duckdb_audit_exports(
+    table_name varchar primary key, sqlite_mtime double,
+    row_count bigint, exported_at timestamp)""")
+    exported = dict(duck.execute(
+        "select table_name, sqlite_mtime from duckdb_audit_exports").fetchall())
+    for table in tables:
+        if not refresh and exported.get(table) == sqlite_mtime:
+            print("{0} is up to date in {1}".format(table, DUCKDB_PATH))
+            continue
+        start = time.time()
+        rows = export_table(duck, sqlite_conn, table, work_dir)
+        duck.execute("delete from duckdb_audit_exports where table_name = ?",
+                     [table])
+        duck.execute("""insert into duckdb_audit_exports
+        values (?, ?, ?, current_timestamp)""", [table, sqlite_mtime, rows])
+        print("Exported {0} rows from {1} in {2:.2f}s".format(
+            rows, table, time.time() - start))
+
+def export_table(duck, sqlite_conn, table, work_dir):
+    """
+    Replaces the table in the DuckDB database with a copy of the one in
+    aptrust.db. Returns the number of rows copied.
+    """
+    columns = [(row[1], duckdb_type(row[2])) for row in sqlite_conn.execute(
+        "pragma table_info({0})".format(table))]
+    csv_path = os.path.join(work_dir, table + '.csv')
+    rows = 0
+    try:
+        with open(csv_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            query = "select {0} from {1}".format(
+                ", ".join('"{0}"'.format(name) for name, _ in columns), table)
+            for row in sqlite_conn.execute(query):
+                writer.writerow([CSV_NULL if value is None else value
+                                 for value in row])
+                rows += 1
+        duck.execute('drop table if exists "{0}"'.format(table))
+        duck.execute('create table "{0}" ({1})'.format(table, ", ".join(
+            '"{0}" {1}'.format(name, type_) for name, type_ in columns)))
+        duck.execute("""insert into "{0}" select * from read_csv(?,
+        header=false, delim=',', quote='"', escape='"', nullstr=?,
+        all_varchar=true)""".format(table), [csv_path, CSV_NULL])
+    finally:
+        if os.path.exists(csv_path):
+            os.remove(csv_path)
+    return rows
+
+def run_statements(duck, statements, metrics):
+    """
+    Runs the statements in DuckDB, except for the create index ones.
+    """
+    for number, sql in enumerate(statements):
+        if statement_kind(sql) == 'create index':
+            continue
+        start = time.time()
+        duck.execute(sql)
+        seconds = time.time() - start
+        metrics.add_time('duckdb', seconds)
+        print("{0:>10.2f}s  {1}".format(seconds, sql.split('\n')[0][:70]))
+
+def write_back(duck, sqlite_conn, statements, tables, metrics):
+    """
+    Replaces the tables in aptrust.db with the ones DuckDB built. The
+    drop table and create table statements run in SQLite first, so
+    the tables have the scripts' own column types and defaults, then
+    the rows are copied and their indexes created. Working tables
+    the scripts drop again aren't copied.
+    """
+    for sql in statements:
+        if statement_kind(sql) in ('drop table', 'create table'):
+            sqlite_conn.execute(sql)
+    for table in tables:
+        start = time.time()
+        columns = [row[1] for row in sqlite_conn.execute(
+            "pragma table_info({0})".format(table))]
+        column_list = ", ".join('"{0}"'.format(name) for name in columns)
+        insert = "insert into {0} ({1}) values ({2})".format(
+            table, column_list, ",".join("?" * len(columns)))
+        cursor = duck.execute('select {0} from "{1}"'.format(column_list,
+                                                            table))
+        rows = 0
+        while True:
+            batch = cursor.fetchmany(BATCH_SIZE)
+            if not batch:
+                break
+            sqlite_conn.executemany(insert, batch)
+            rows += len(batch)
+            metrics.progress(items=len(batch))
+        metrics.add_time('write back', time.time() - start)
+        print("Wrote {0} rows to {1}".format(rows, table))
+    for sql in statements:
+        match = INDEX_TABLE_PATTERN.search(sql)
+        if statement_kind(sql) == 'create index' and match.group(1) in tables:
+            with metrics.stage('create index'):
+                sqlite_conn.execute(sql)
+    with metrics.stage('commit'):
+        sqlite_conn.commit()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Run audit SQL scripts on DuckDB and write the '
+        'results back to db/aptrust.db')
+    parser.add_argument('scripts', nargs='+',
+                        help="SQL scripts to run, in order")
+    parser.add_argument('--threads', type=int,
+                        help="Threads for DuckDB to use. Defaults to the "
+                        "number of cores.")
+    parser.add_argument('--memory-limit',
+                        help="Memory limit for DuckDB, e.g. 16GB. DuckDB "
+                        "spills to disk beyond it.")
+    parser.add_argument('--refresh', action='store_true',
+                        help="Export the source tables again even if "
+                        "aptrust.db hasn't changed")
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    if sys.version_info[0] < 3:
+        sys.exit("duckdb_audit.py needs Python 3. Run it with python3.")
+    if duckdb is None:
+        sys.exit("duckdb_audit.py needs the duckdb package. "
+                 "Run pip install duckdb (Python 3 only), or run the "
+                 "scripts with sqlite3 instead.")
+    metrics = metrics_from_args('duckdb_audit', args)
+
+    statements = []
+    for path in args.scripts:
+        statements.extend(read_statements(path))
+    tables = created_tables(statements)
+
+    sqlite_conn = sqlite3.connect(DB_PATH)
+    register_functions(sqlite_conn)
+    sqlite_mtime = os.path.getmtime(DB_PATH)
+    duck = duckdb.connect(DUCKDB_PATH)
+    if args.threads:
+        duck.execute("set threads = {0:d}".format(args.threads))
+    if args.memory_limit:
+        duck.execute("set memory_limit = ?", [args.memory_limit])
+    work_dir = tempfile.mkdtemp(dir=os.path.dirname(DUCKDB_PATH))
+    try:
+        with metrics.stage('export'):
+            export_tables(duck, sqlite_conn,
+                          source_tables(sqlite_conn, statements),
+                          sqlite_mtime, work_dir, args.refresh)
+    finally:
+        os.rmdir(work_dir)
+    run_statements(duck, statements, metrics)
+    write_back(duck, sqlite_conn, statements, tables, metrics)
+    sqlite_conn.close()
+    # Writing the results changed aptrust.db, but not the tables we
+    # exported. If nothing else changed it, the export is still good.
+    duck.execute("""update duckdb_audit_exports set sqlite_mtime = ?
+    where sqlite_mtime = ?""", [os.path.getmtime(DB_PATH), sqlite_mtime])
+    duck.close()
+    metrics.finish()
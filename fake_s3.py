@@ -0,0 +1,358 @@
+#! /usr/bin/env python
+# fake_s3.py
+"""
+A local, in-memory stand-in for the parts of boto's S3 interface that
+s3_buckets_to_sql.py and cleanup_001.py use. It lets us run and profile
+those scripts without touching the production buckets.
+
+Every simulated request sleeps for the connection's latency, so the
+timings roughly resemble a real crawl, and every request is counted by
+type (LIST, HEAD, COPY, DELETE, MULTI_DELETE), so we can see how many
+API calls a change saves. Sleeping releases the GIL, so requests issued from several
+threads overlap the way real HTTP requests would. Set error_rate to make
+that fraction of requests fail with a 503 SlowDown error, the way S3
+does when it's throttling us, to exercise retry logic.
+
+Usage:
+
+    s3 = FakeS3Connection(latency=0.02)
+    build_synthetic_bucket(s3, 'aptrust.preservation.storage', 10000)
+    list_bucket('aptrust.preservation.storage', conn, s3=s3)
+
+Or load the buckets from a listing written by generate_test_data.py:
+
+    load_listing(s3, 'data/synthetic/s3_listing.json')
+"""
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+# S3 returns at most this many keys per LIST request.
+LIST_PAGE_SIZE = 1000
+
+# A multi-object delete request can name at most this many keys.
+MULTI_DELETE_LIMIT = 1000
+
+# boto assigns this to keys that come from a bucket listing,
+# since listings don't include the content type.
+DEFAULT_CONTENT_TYPE = 'application/octet-stream'
+
+
+class FakeS3Error(Exception):
+    """
+    Stands in for boto.exception.S3ResponseError. Like boto's error,
+    it has the HTTP status and the S3 error code.
+    """
+    def __init__(self, status, reason, error_code):
+        Exception.__init__(self, "{0} {1}: {2}".format(
+            status, reason, error_code))
+        self.status = status
+        self.reason = reason
+        self.error_code = error_code
+
+
+class FakeS3Connection(object):
+    """
+    Stands in for boto.s3.connection.S3Connection. Param latency is
+    the number of seconds each simulated request takes, and error_rate
+    is the fraction of requests that fail with a FakeS3Error.
+    """
+    def __init__(self, latency=0.0, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.buckets = {}
+        self.requests = {}
+        self.errors = {}
+        self.deleted_keys = 0
+        self.lock = threading.Lock()
+
+    def create_bucket(self, bucket_name):
+        bucket = FakeBucket(self, bucket_name)
+        self.buckets[bucket_name] = bucket
+        return bucket
+
+    def get_bucket(self, bucket_name, validate=True):
+        if validate:
+            self.request('LIST')
+        return self.buckets[bucket_name]
+
+    def request(self, request_type):
+        """
+        Simulates a single round trip to S3.
+        """
+        with self.lock:
+            self.requests[request_type] = self.requests.get(request_type, 0) + 1
+            failed = self.error_rate > 0 and self.rng.random() < self.error_rate
+            if failed:
+                self.errors[request_type] = self.errors.get(request_type, 0) + 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if failed:
+            raise FakeS3Error(503, 'Slow Down', 'SlowDown')
+
+    def request_count(self, request_type=None):
+        """
+        Returns the number of requests of the specified type,
+        or the total number of requests if request_type is None.
+        """
+        with self.lock:
+            if request_type is None:
+                return sum(self.requests.values())
+            return self.requests.get(request_type, 0)
+
+    def error_count(self, request_type=None):
+        """
+        Returns the number of simulated failures of the specified
+        type, or of all types if request_type is None.
+        """
+        with self.lock:
+            if request_type is None:
+                return sum(self.errors.values())
+            return self.errors.get(request_type, 0)
+
+    def deleted_key_count(self):
+        """
+        Returns the number of keys multi-object deletes have deleted,
+        counting a key again each time it's deleted.
+        """
+        with self.lock:
+            return self.deleted_keys
+
+    def reset_request_counts(self):
+        with self.lock:
+            self.requests = {}
+            self.errors = {}
+            self.deleted_keys = 0
+
+
+class FakeBucket(object):
+    """
+    Stands in for boto.s3.bucket.Bucket.
+    """
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.name = name
+        self.keys = {}
+
+    def add_key(self, name, size, content_type, metadata, last_modified=None):
+        """
+        Puts a key directly into the bucket, without counting a request.
+        """
+        key = FakeKey(self, name)
+        key.size = size
+        key.content_type = content_type
+        key.metadata = dict(metadata)
+        key.etag = '"{0}"'.format(metadata.get('md5') or
+                                  hashlib.md5(name).hexdigest())
+        key.last_modified = last_modified or iso_timestamp(datetime.utcnow())
+        with self.connection.lock:
+            self.keys[name] = key
+        return key
+
+    def list(self, prefix=''):
+        """
+        Yields keys in name order, the way S3 does, one page of
+        LIST_PAGE_SIZE keys per simulated request. Like boto's listing
+        keys, these have no user metadata and a default content type.
+        """
+        with self.connection.lock:
+            names = sorted(n for n in self.keys if n.startswith(prefix))
+        for i, name in enumerate(names):
+            if i % LIST_PAGE_SIZE == 0:
+                self.connection.request('LIST')
+            with self.connection.lock:
+                key = self.keys.get(name)
+            if key is not None:
+                yield key.listing_copy()
+
+    def get_key(self, key_name):
+        """
+        Simulates a HEAD request. Returns a copy of the key with its
+        metadata, or None if the key doesn't exist.
+        """
+        self.connection.request('HEAD')
+        with self.connection.lock:
+            key = self.keys.get(key_name)
+        if key is None:
+            return None
+        return key.copy()
+
+    def copy_key(self, new_key_name, src_bucket_name, src_key_name,
+                 metadata=None, headers=None, **kwargs):
+        """
+        Simulates a server-side copy from another bucket on the same
+        connection. As with boto, metadata replaces the source key's
+        metadata when it's not None, and the Content-Type header sets
+        the content type.
+        """
+        self.connection.request('COPY')
+        src_bucket = self.connection.buckets[src_bucket_name]
+        with self.connection.lock:
+            src = src_bucket.keys[src_key_name]
+        key = src.copy()
+        key.bucket = self
+        key.name = new_key_name
+        key.last_modified = iso_timestamp(datetime.utcnow())
+        if metadata is not None:
+            key.metadata = dict(metadata)
+        if headers and 'Content-Type' in headers:
+            key.content_type = headers['Content-Type']
+        with self.connection.lock:
+            self.keys[new_key_name] = key
+        return key
+
+    def delete_key(self, key_name):
+        """
+        Simulates a single-key DELETE. Like S3, deleting a key that
+        doesn't exist is not an error.
+        """
+        self.connection.request('DELETE')
+        with self.connection.lock:
+            self.keys.pop(key_name, None)
+
+    def delete_keys(self, keys, quiet=False):
+        """
+        Simulates a multi-object delete: one request for up to
+        MULTI_DELETE_LIMIT keys. Returns a FakeMultiDeleteResult. As
+        with S3, keys that don't exist count as deleted, and a key can
+        fail on its own while the others are deleted. Here, each key
+        fails with an InternalError at the connection's error_rate,
+        and those failures are counted as DELETE_KEY errors.
+        """
+        if len(keys) > MULTI_DELETE_LIMIT:
+            raise FakeS3Error(400, 'Bad Request', 'MalformedXML')
+        self.connection.request('MULTI_DELETE')
+        result = FakeMultiDeleteResult()
+        with self.connection.lock:
+            for key_name in keys:
+                if (self.connection.error_rate > 0 and
+                        self.connection.rng.random() < self.connection.error_rate):
+                    errors = self.connection.errors
+                    errors['DELETE_KEY'] = errors.get('DELETE_KEY', 0) + 1
+                    result.errors.append(FakeDeleteError(
+                        key_name, 'InternalError',
+                        'We encountered an internal error. Please try again.'))
+                    continue
+                self.keys.pop(key_name, None)
+                self.connection.deleted_keys += 1
+                if not quiet:
+                    result.deleted.append(FakeDeletedKey(key_name))
+        return result
+
+
+class FakeKey(object):
+    """
+    Stands in for boto.s3.key.Key.
+    """
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.cache_control = None
+        self.content_type = DEFAULT_CONTENT_TYPE
+        self.etag = None
+        self.last_modified = None
+        self.storage_class = 'STANDARD'
+        self.size = 0
+        self.metadata = {}
+
+    def copy(self):
+        key = FakeKey(self.bucket, self.name)
+        key.__dict__.update(self.__dict__)
+        key.metadata = dict(self.metadata)
+        return key
+
+    def listing_copy(self):
+        key = self.copy()
+        key.content_type = DEFAULT_CONTENT_TYPE
+        key.metadata = {}
+        return key
+
+
+class FakeMultiDeleteResult(object):
+    """
+    Stands in for boto.s3.multidelete.MultiDeleteResult.
+    """
+    def __init__(self):
+        self.deleted = []
+        self.errors = []
+
+
+class FakeDeletedKey(object):
+    """
+    Stands in for boto.s3.multidelete.Deleted.
+    """
+    def __init__(self, key):
+        self.key = key
+
+
+class FakeDeleteError(object):
+    """
+    Stands in for boto.s3.multidelete.Error.
+    """
+    def __init__(self, key, code, message):
+        self.key = key
+        self.code = code
+        self.message = message
+
+
+def iso_timestamp(dt):
+    return dt.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+def build_synthetic_bucket(s3, bucket_name, num_keys, files_per_bag=20,
+                           institutions=None, seed=None):
+    """
+    Creates a bucket on the fake connection holding num_keys keys,
+    grouped into bags of files_per_bag files. Key names are UUIDs and
+    each key has the institution, bag, bagpath, md5 and sha256 metadata
+    that our ingest services store with every file.
+    """
+    rng = random.Random(seed)
+    if institutions is None:
+        institutions = ['test.edu', 'example.edu', 'sample.org']
+    bucket = s3.create_bucket(bucket_name)
+    start = datetime(2015, 9, 1)
+    bag_number = 0
+    for i in range(num_keys):
+        if i % files_per_bag == 0:
+            bag_number += 1
+            institution = institutions[bag_number % len(institutions)]
+            bag = "{0}.bag_{1:08d}".format(institution, bag_number)
+        name = str(uuid.UUID(int=rng.getrandbits(128)))
+        bagpath = "data/file_{0:05d}.txt".format(i % files_per_bag)
+        metadata = {
+            'institution': institution,
+            'bag': bag,
+            'bagpath': bagpath,
+            'md5': hashlib.md5(name).hexdigest(),
+            'sha256': hashlib.sha256(name).hexdigest(),
+        }
+        last_modified = iso_timestamp(start + timedelta(seconds=i))
+        bucket.add_key(name, rng.randint(100, 10 * 1024 * 1024),
+                       'text/plain', metadata, last_modified)
+    return bucket
+
+
+def load_listing(s3, file_path):
+    """
+    Adds the keys in a listing written by generate_test_data.py to the
+    fake connection, creating buckets as needed. The listing has one
+    JSON record per line, with the bucket, name, size, content_type,
+    last_modified and metadata of a key. Returns the number of keys.
+    """
+    count = 0
+    with open(file_path) as f:
+        for line in f:
+            data = json.loads(line)
+            bucket = s3.buckets.get(data['bucket'])
+            if bucket is None:
+                bucket = s3.create_bucket(data['bucket'])
+            bucket.add_key(data['name'], data['size'], data['content_type'],
+                           data['metadata'], data['last_modified'])
+            count += 1
+    return count
@@ -7,16 +7,20 @@ creates a small file called institutions.json and a big file
 called objects.json. Each file contains one JSON record per
 line.
 """
+import argparse
 from datetime import datetime
 import json
 import os
 import sqlite3
-import sys
+import time
+
+from identifiers import bag_key, bag_key_from_identifier, uuid_from_url
+from metrics import Metrics, add_metrics_arguments, metrics_from_args
 
 # We cache institution ids when loading objects
 institutions = {}
 
-def import_json(conn, file_path):
+def import_json(conn, file_path, metrics=None):
     line_number = 0
     records_saved = 0
     save_function = save_intellectual_object
@@ -38,27 +42,38 @@ def import_json(conn, file_path):
     else:
         print "Assuming you're saving Fedora objects, files and events"
         cache_institutions(conn)
+    if metrics is None:
+        metrics = Metrics('fedora_to_sql')
+    metrics.set_totals(total_bytes=os.path.getsize(file_path))
     with open(file_path) as f:
         for line in f:
             new_id = 0
             line_number += 1
-            if line_number % 500 == 0:
-                print("Processed {0} lines".format(line_number))
             try:
-                data = json.loads(line)
+                with metrics.stage('decode'):
+                    data = json.loads(line)
             except ValueError as err:
                 print("Error decoding JSON on line {0}: {1}".format(line_number, err))
             try:
+                # save_function checks whether each record
+                # exists before inserting it, so the save stage
+                # includes the dedupe queries.
+                started = time.time()
                 conn.execute("begin")
                 new_id = save_function(conn, data)
-                conn.execute("commit")
+                metrics.add_time('save', time.time() - started)
+                with metrics.stage('commit'):
+                    conn.execute("commit")
             except (sqlite3.Error, RuntimeError) as err:
                 print("Insert failed for record {0}/{1}".format(
                     data['id'], data.get('identifier', 'no identifier')))
                 print(err)
                 conn.execute("rollback")
+                metrics.count('failed')
             if new_id > 0:
                 records_saved += 1
+                metrics.count('saved')
+            metrics.progress(bytes_read=len(line))
     print("Processed {0} json records. Saved {1} new records".format(
         line_number, records_saved))
 
@@ -143,7 +158,8 @@ def save_intellectual_object(conn, data):
         return 0
     statement = """insert into objects(
     pid, institution_id, title, description, access, bag_name,
-    identifier, state, alt_identifier) values (?,?,?,?,?,?,?,?,?)
+    identifier, state, alt_identifier, bag_key)
+    values (?,?,?,?,?,?,?,?,?,?)
     """
     alt_identifier = None
     if len(data['alt_identifier']) > 0:
@@ -156,7 +172,8 @@ def save_intellectual_object(conn, data):
               data['bag_name'],
               data['identifier'],
               data['state'],
-              alt_identifier)
+              alt_identifier,
+              bag_key_from_identifier(data['identifier']))
     object_id = do_save(conn, statement, values)
     if data['premisEvents'] is not None:
         for event in data['premisEvents']:
@@ -187,12 +204,12 @@ def save_file(conn, data, object_id):
         return 0
     statement = """insert into files(object_id,
     pid, uri, size, created, modified, file_format, identifier,
-    state) values (?,?,?,?,?,?,?,?,?)
+    state, uri_uuid) values (?,?,?,?,?,?,?,?,?,?)
     """
     values = (object_id, data['id'], data['uri'],
               data['size'], data['created'], data['modified'],
               data['file_format'], data['identifier'],
-              data['state'],)
+              data['state'], uuid_from_url(data['uri']),)
     file_id = do_save(conn, statement, values)
     if data['checksum'] is not None:
         for checksum in data['checksum']:
@@ -233,7 +250,21 @@ def save_event(conn, data, object_id, file_id):
               data['outcome'], data['outcome_detail'],
               data['object'], data['agent'],
               data['outcome_information'],)
-    return do_save(conn, statement, values)
+    event_id = do_save(conn, statement, values)
+    count_event(conn, object_id, file_id, data['type'])
+    return event_id
+
+def count_event(conn, object_id, file_id, event_type):
+    """
+    Adds one to the count of events of this type in event_counts, for
+    the file if there is one, otherwise for the object. Rows for
+    object-level events have file_id 0.
+    """
+    key = (file_id or 0, object_id or 0, event_type or '')
+    conn.execute("""insert or ignore into event_counts(file_id, object_id,
+    type, event_count) values (?,?,?,0)""", key)
+    conn.execute("""update event_counts set event_count = event_count + 1
+    where file_id=? and object_id=? and type=?""", key)
 
 def save_user(conn, data):
     if user_by_email(conn, data['email']):
@@ -272,7 +303,8 @@ def save_work_item(conn, data):
     institution_id, file_mod_date, note, action,
     stage, status, outcome, retry, reviewed,
     object_identifier, generic_file_identifier,
-    created_at, updated_at) values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+    created_at, updated_at, bag_key)
+    values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
     """
     if record_exists(conn, 'work_items', 'id', data['id']):
         return 0
@@ -294,7 +326,8 @@ def save_work_item(conn, data):
               data['object_identifier'],
               data['generic_file_identifier'],
               data['created_at'],
-              data['updated_at'],)
+              data['updated_at'],
+              bag_key(data['institution'], data['name']),)
     return do_save(conn, statement, values)
 
 
@@ -417,6 +450,7 @@ def initialize_db(conn):
         generic_file_identifier varchar(255),
         created_at datetime,
         updated_at datetime,
+        bag_key varchar(255),
         FOREIGN KEY(institution_id)
         REFERENCES institutions(id));"""
         conn.execute(statement)
@@ -434,6 +468,7 @@ def initialize_db(conn):
         identifier text,
         state text,
         alt_identifier text,
+        bag_key text,
         FOREIGN KEY(institution_id) REFERENCES institutions(id))"""
         conn.execute(statement)
         conn.commit()
@@ -450,6 +485,7 @@ def initialize_db(conn):
         file_format text,
         identifier text,
         state text,
+        uri_uuid text,
         FOREIGN KEY(object_id) REFERENCES objects(id))"""
         conn.execute(statement)
         conn.commit()
@@ -497,6 +533,24 @@ def initialize_db(conn):
         conn.execute(statement)
         conn.commit()
 
+        print("Creating index ix_obj_bag_key on objects")
+        statement = """create index ix_obj_bag_key on
+        objects(bag_key)"""
+        conn.execute(statement)
+        conn.commit()
+
+        print("Creating index ix_work_items_bag_key on work_items")
+        statement = """create index ix_work_items_bag_key on
+        work_items(bag_key)"""
+        conn.execute(statement)
+        conn.commit()
+
+        print("Creating index ix_work_items_stage_status on work_items")
+        statement = """create index ix_work_items_stage_status on
+        work_items(stage, status)"""
+        conn.execute(statement)
+        conn.commit()
+
         print("Creating index ix_file_pid on files")
         statement = """create unique index ix_file_pid on
         files(pid)"""
@@ -515,6 +569,12 @@ def initialize_db(conn):
         conn.execute(statement)
         conn.commit()
 
+        print("Creating index ix_file_uri_uuid on files")
+        statement = """create index ix_file_uri_uuid on
+        files(uri_uuid)"""
+        conn.execute(statement)
+        conn.commit()
+
         print("Creating index ix_checksum_file_id on checksums")
         statement = """create index ix_checksum_file_id on
         checksums(file_id)"""
@@ -541,14 +601,51 @@ def initialize_db(conn):
 
     c.close()
 
+def create_event_counts_if_necessary(conn):
+    """
+    Creates the event_counts table, which has the number of events of
+    each type for each object and file, and fills it from the events
+    already loaded in one pass. After that, save_event keeps it up to
+    date.
+    """
+    query = """SELECT name FROM sqlite_master WHERE type='table'
+    AND name='event_counts'"""
+    if conn.execute(query).fetchone():
+        return
+    print("Creating table event_counts")
+    statement = """create table event_counts(
+    file_id int not null,
+    object_id int not null,
+    type text not null,
+    event_count int not null default 0)"""
+    conn.execute(statement)
+    conn.commit()
+
+    print("Counting events")
+    statement = """insert into event_counts(file_id, object_id, type,
+    event_count)
+    select coalesce(file_id, 0), coalesce(object_id, 0), coalesce(type, ''),
+    count(*)
+    from events
+    group by coalesce(file_id, 0), coalesce(object_id, 0), coalesce(type, '')"""
+    conn.execute(statement)
+    conn.commit()
+
+    print("Creating index ix_event_counts on event_counts")
+    statement = """create unique index ix_event_counts on
+    event_counts(object_id, file_id, type)"""
+    conn.execute(statement)
+    conn.commit()
+
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Missing arg: path to json data file")
-        print("Usage: python fedora_to_sql.py <path/to/institutions.json>")
-        print("Or...  python fedora_to_sql.py <path/to/users.json>")
-        print("Or...  python fedora_to_sql.py <path/to/processed_items.json>")
-        print("Or...  python fedora_to_sql.py <path/to/objects.json>")
-        sys.exit()
+    parser = argparse.ArgumentParser(
+        description='Load a Fedora JSON dump into db/aptrust_fedora.db. '
+        'Load institutions.json first, then users.json, '
+        'processed_items.json and objects.json.')
+    parser.add_argument('file_path', help="Path to the JSON data file")
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics = metrics_from_args('fedora_to_sql', args)
     if not os.path.exists('db'):
         os.mkdir('db')
     conn = sqlite3.connect('db/aptrust_fedora.db')
@@ -556,6 +653,9 @@ if __name__ == "__main__":
     # manage these manually.
     conn.isolation_level = None
     #conn.row_factory = sqlite3.Row
-    initialize_db(conn)
-    import_json(conn, sys.argv[1])
+    with metrics.stage('initialize'):
+        initialize_db(conn)
+        create_event_counts_if_necessary(conn)
+    import_json(conn, args.file_path, metrics)
     conn.close()
+    metrics.finish()
@@ -0,0 +1,505 @@
+#! /usr/bin/env python
+# fixity_check.py
+"""
+Verifies the files in preservation storage against the checksums in
+db/aptrust.db. For each active generic file in the files table, reads
+the stored object (named by the file's uri_uuid) from a storage
+backend, calculates its md5 and sha256 in a single pass, and compares
+them and its size with the file's latest md5 and sha256 in the
+checksums table. Each file's result goes to the fixity_results table,
+and each run's totals and throughput go to fixity_runs.
+
+Reads are spread over a pool of threads. hashlib releases the GIL
+while it hashes large buffers, and S3 reads spend most of their time
+waiting on the network, so the threads keep several reads and hashes
+going at once. The main thread is the only one that writes to the
+database.
+
+The status of each result is one of:
+
+  ok          the size and every checksum we have match
+  mismatch    the size or a checksum doesn't match
+  missing     the backend doesn't have the object
+  error       the object couldn't be read
+  unverified  the object was read, but the file has no checksums
+
+Backends:
+
+  s3      Reads keys from the preservation bucket (or --bucket).
+          Requires boto.
+  local   Reads files named by UUID from a directory (--root), such
+          as a copy of the bucket restored from Glacier.
+
+Usage:
+
+python fixity_check.py --backend s3 --threads 16
+python fixity_check.py --backend local --root /mnt/restore --object test.edu/bag
+"""
+import argparse
+import errno
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+import time
+from Queue import Queue
+from datetime import datetime
+
+from metrics import add_metrics_arguments, metrics_from_args
+
+try:
+    from boto.exception import S3ResponseError
+    from boto.s3.connection import S3Connection
+except ImportError:
+    # boto is only required for the s3 backend.
+    S3Connection = None
+    S3ResponseError = None
+
+DB_PATH = 'db/aptrust.db'
+VA_BUCKET_NAME = 'aptrust.preservation.storage'
+
+# Objects are read and hashed this many bytes at a time. Large buffers
+# mean fewer reads, and let hashlib release the GIL for longer. Much
+# larger ones fall out of the CPU cache between the md5 and the sha256.
+BUFFER_SIZE = 1024 * 1024
+
+# Files are read from the database, and their results written, in
+# batches of this many rows.
+BATCH_SIZE = 500
+
+# The queue of rows waiting for a thread holds at most this many rows
+# per thread.
+QUEUE_ROWS_PER_THREAD = 4
+
+# Selects the size and latest checksums of the next batch of active
+# files, after the file id given as the first parameter.
+FILES_QUERY = """select f.id, f.identifier, f.uri_uuid, f.size,
+  (select digest from checksums where file_id = f.id and algorithm = 'md5'
+   order by date_time desc limit 1) as md5,
+  (select digest from checksums where file_id = f.id and algorithm = 'sha256'
+   order by date_time desc limit 1) as sha256
+from files f
+{join}
+where f.id > ? and f.state = 'A' and f.uri_uuid is not null {where}
+order by f.id
+limit ?"""
+
+# Counts the files FILES_QUERY will return, and their bytes.
+FILES_TOTAL_QUERY = """select count(*), coalesce(sum(size), 0) from (
+  select f.size from files f
+  {join}
+  where f.state = 'A' and f.uri_uuid is not null {where}
+  order by f.id
+  {limit})"""
+
+RESULT_COLUMNS = ['file_id', 'identifier', 'uuid', 'status', 'size',
+                  'expected_size', 'md5', 'expected_md5', 'sha256',
+                  'expected_sha256', 'error', 'seconds', 'checked_at']
+
+
+class MissingObject(Exception):
+    """
+    The backend has no object with the requested UUID.
+    """
+    pass
+
+
+class LocalBackend(object):
+    """
+    Reads objects from files named by UUID in the root directory.
+    """
+    name = 'local'
+
+    def __init__(self, root):
+        self.root = root
+        self.location = root
+
+    def open(self, uuid):
+        try:
+            return open(os.path.join(self.root, uuid), 'rb')
+        except IOError as err:
+            if err.errno == errno.ENOENT:
+                raise MissingObject(uuid)
+            raise
+
+
+class S3Backend(object):
+    """
+    Reads objects from an S3 bucket with a single GET each.
+    """
+    name = 's3'
+
+    def __init__(self, bucket_name, s3=None):
+        if s3 is None:
+            if S3Connection is None:
+                sys.exit("boto is required for the s3 backend. "
+                         "Run pip install boto.")
+            s3 = S3Connection()
+        self.bucket = s3.get_bucket(bucket_name)
+        self.location = bucket_name
+
+    def open(self, uuid):
+        # new_key doesn't make a request, so a missing key shows up
+        # as a 404 on the GET instead of costing a HEAD for every key.
+        key = self.bucket.new_key(uuid)
+        try:
+            key.open_read()
+        except S3ResponseError as err:
+            if err.status == 404:
+                raise MissingObject(uuid)
+            raise
+        return key
+
+
+def object_filter(object_identifier):
+    """
+    Returns the join, where clause and parameters that limit
+    FILES_QUERY and FILES_TOTAL_QUERY to the files of one object.
+    """
+    if not object_identifier:
+        return "", "", []
+    return ("inner join objects o on o.id = f.object_id",
+            "and o.identifier = ?", [object_identifier])
+
+def files_to_check(conn, object_identifier=None, limit=None,
+                   batch_size=BATCH_SIZE):
+    """
+    Yields (id, identifier, uuid, size, md5, sha256) for each active
+    file, or for the files of one object, with its latest checksums.
+    Files are read batch_size at a time, each batch with a new query
+    that starts after the last file id. So memory doesn't grow with
+    the number of files, and no query is left open while results are
+    committed.
+    """
+    join, where, params = object_filter(object_identifier)
+    query = FILES_QUERY.format(join=join, where=where)
+    last_id = 0
+    count = 0
+    while not limit or count < limit:
+        size = batch_size
+        if limit:
+            size = min(size, limit - count)
+        rows = conn.execute(query, [last_id] + params + [size]).fetchall()
+        for row in rows:
+            yield row
+        if len(rows) < size:
+            return
+        last_id = rows[-1][0]
+        count += len(rows)
+
+def files_total(conn, object_identifier=None, limit=None):
+    """
+    Returns the number of files files_to_check will yield, and their
+    total size in bytes.
+    """
+    join, where, params = object_filter(object_identifier)
+    limit_clause = ""
+    if limit:
+        limit_clause = "limit ?"
+        params.append(limit)
+    query = FILES_TOTAL_QUERY.format(join=join, where=where,
+                                     limit=limit_clause)
+    return conn.execute(query, params).fetchone()
+
+def read_chunks(f, buffer_size):
+    """
+    Yields the contents of file-like object f, buffer_size bytes at a
+    time. Real files are read into one reusable buffer.
+    """
+    if hasattr(f, 'readinto'):
+        buf = bytearray(buffer_size)
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                return
+            yield view[:n]
+    else:
+        while True:
+            chunk = f.read(buffer_size)
+            if not chunk:
+                return
+            yield chunk
+
+def check_file(backend, row, buffer_size):
+    """
+    Reads one object from the backend, hashing it as it goes, and
+    returns its result as a dict with the RESULT_COLUMNS keys.
+    """
+    file_id, identifier, uuid, size, md5, sha256 = row
+    result = dict((column, None) for column in RESULT_COLUMNS)
+    result.update({'file_id': file_id, 'identifier': identifier,
+                   'uuid': uuid, 'expected_size': size,
+                   'expected_md5': md5, 'expected_sha256': sha256})
+    start = time.time()
+    try:
+        f = backend.open(uuid)
+        try:
+            md5_hash = hashlib.md5()
+            sha256_hash = hashlib.sha256()
+            bytes_read = 0
+            for chunk in read_chunks(f, buffer_size):
+                md5_hash.update(chunk)
+                sha256_hash.update(chunk)
+                bytes_read += len(chunk)
+        finally:
+            f.close()
+        result['size'] = bytes_read
+        result['md5'] = md5_hash.hexdigest()
+        result['sha256'] = sha256_hash.hexdigest()
+        result['status'] = fixity_status(result)
+    except MissingObject:
+        result['status'] = 'missing'
+    except Exception as err:
+        result['status'] = 'error'
+        result['error'] = str(err)
+    result['seconds'] = time.time() - start
+    result['checked_at'] = datetime.utcnow()
+    return result
+
+def check_files(backend, buffer_size, tasks, done):
+    """
+    Runs in each worker thread. Checks the rows from tasks until it
+    gets None, and puts each result on done.
+    """
+    while True:
+        row = tasks.get()
+        if row is None:
+            return
+        done.put(check_file(backend, row, buffer_size))
+
+def fixity_status(result):
+    """
+    Returns the status for an object that was read: 'mismatch' if its
+    size or a checksum differs from what we expected, 'unverified' if
+    we have no checksums for it, and 'ok' otherwise.
+    """
+    for column in ['size', 'md5', 'sha256']:
+        expected = result['expected_' + column]
+        if expected is not None and str(expected).lower() != str(result[column]):
+            return 'mismatch'
+    if result['expected_md5'] is None and result['expected_sha256'] is None:
+        return 'unverified'
+    return 'ok'
+
+def check(conn, backend, rows, threads, buffer_size=BUFFER_SIZE,
+          metrics=None, total=None, total_bytes=None):
+    """
+    Checks the objects for rows (from files_to_check) in a pool of
+    threads, and saves the results and the run's throughput. Rows are
+    read in this thread and handed to the workers through a queue that
+    holds at most QUEUE_ROWS_PER_THREAD rows per thread, so rows can be
+    a generator over any number of files, and a large object only ties
+    up the thread reading it. Params total and total_bytes (from
+    files_total), if known, are for the progress report. Returns the
+    fixity_runs row as a dict.
+    """
+    create_tables_if_necessary(conn)
+    started_at = datetime.utcnow()
+    c = conn.execute("""insert into fixity_runs(backend, location, threads,
+    buffer_size, started_at) values (?,?,?,?,?)""",
+                     (backend.name, backend.location, threads, buffer_size,
+                      started_at))
+    conn.commit()
+    run_id = c.lastrowid
+    if metrics:
+        metrics.set_totals(total=total, total_bytes=total_bytes)
+    counts = {'ok': 0, 'mismatch': 0, 'missing': 0, 'error': 0,
+              'unverified': 0}
+    totals = {'files': 0, 'bytes_read': 0}
+    results = []
+
+    def record(result):
+        totals['files'] += 1
+        totals['bytes_read'] += result['size'] or 0
+        counts[result['status']] += 1
+        if result['status'] not in ('ok', 'unverified'):
+            sys.stderr.write("{0}: {1} {2} {3}\n".format(
+                result['status'], result['uuid'], result['identifier'],
+                result['error'] or ''))
+        results.append(result)
+        if len(results) >= BATCH_SIZE:
+            save_results(conn, run_id, results, metrics)
+            del results[:]
+        if metrics:
+            metrics.add_time('read and hash', result['seconds'])
+            metrics.progress(bytes_read=result['size'] or 0)
+
+    start = time.time()
+    tasks = Queue(threads * QUEUE_ROWS_PER_THREAD)
+    done = Queue()
+    workers = []
+    for i in range(threads):
+        worker = threading.Thread(target=check_files, args=(
+            backend, buffer_size, tasks, done))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+    pending = 0
+    try:
+        for row in rows:
+            tasks.put(row)
+            pending += 1
+            # Record whatever has finished, without waiting.
+            while not done.empty():
+                record(done.get())
+                pending -= 1
+        while pending:
+            record(done.get())
+            pending -= 1
+        save_results(conn, run_id, results, metrics)
+    finally:
+        for worker in workers:
+            tasks.put(None)
+        for worker in workers:
+            worker.join()
+    files = totals['files']
+    bytes_read = totals['bytes_read']
+    seconds = time.time() - start
+    run = {
+        'id': run_id,
+        'finished_at': datetime.utcnow(),
+        'files': files,
+        'bytes_read': bytes_read,
+        'seconds': seconds,
+        'mb_per_second': bytes_read / 1048576.0 / seconds if seconds else 0,
+        'files_per_second': files / seconds if seconds else 0,
+        'ok': counts['ok'],
+        'mismatched': counts['mismatch'],
+        'missing': counts['missing'],
+        'errors': counts['error'],
+        'unverified': counts['unverified'],
+    }
+    conn.execute("""update fixity_runs set finished_at=:finished_at,
+    files=:files, bytes_read=:bytes_read, seconds=:seconds,
+    mb_per_second=:mb_per_second, files_per_second=:files_per_second,
+    ok=:ok, mismatched=:mismatched, missing=:missing, errors=:errors,
+    unverified=:unverified where id=:id""", run)
+    conn.commit()
+    return run
+
+def save_results(conn, run_id, results, metrics=None):
+    if not results:
+        return
+    statement = "insert into fixity_results(run_id, {0}) values ({1})".format(
+        ", ".join(RESULT_COLUMNS), ",".join("?" * (len(RESULT_COLUMNS) + 1)))
+    values = [[run_id] + [r[column] for column in RESULT_COLUMNS]
+              for r in results]
+    start = time.time()
+    conn.executemany(statement, values)
+    conn.commit()
+    if metrics:
+        metrics.add_time('save', time.time() - start)
+
+def create_tables_if_necessary(conn):
+    query = """SELECT name FROM sqlite_master WHERE type='table'
+    AND name='fixity_runs'"""
+    c = conn.cursor()
+    c.execute(query)
+    row = c.fetchone()
+    if not row or len(row) < 1:
+        print("Creating table fixity_runs")
+        statement = """create table fixity_runs(
+        id integer primary key autoincrement,
+        backend varchar(20),
+        location varchar(255),
+        threads int,
+        buffer_size int,
+        started_at datetime,
+        finished_at datetime,
+        files int,
+        bytes_read unsigned big int,
+        seconds real,
+        mb_per_second real,
+        files_per_second real,
+        ok int,
+        mismatched int,
+        missing int,
+        errors int,
+        unverified int)"""
+        conn.execute(statement)
+        conn.commit()
+
+        print("Creating table fixity_results")
+        statement = """create table fixity_results(
+        id integer primary key autoincrement,
+        run_id int not null,
+        file_id int not null,
+        identifier varchar(255),
+        uuid varchar(40),
+        status varchar(20) not null,
+        size unsigned big int,
+        expected_size unsigned big int,
+        md5 varchar(80),
+        expected_md5 varchar(80),
+        sha256 varchar(80),
+        expected_sha256 varchar(80),
+        error text,
+        seconds real,
+        checked_at datetime,
+        FOREIGN KEY(run_id) REFERENCES fixity_runs(id),
+        FOREIGN KEY(file_id) REFERENCES files(id))"""
+        conn.execute(statement)
+        conn.commit()
+
+        print("Creating index ix_fixity_results_run_id on fixity_results")
+        statement = """create index ix_fixity_results_run_id
+        on fixity_results(run_id, status)"""
+        conn.execute(statement)
+        conn.commit()
+
+        print("Creating index ix_fixity_results_file_id on fixity_results")
+        statement = """create index ix_fixity_results_file_id
+        on fixity_results(file_id)"""
+        conn.execute(statement)
+        conn.commit()
+    c.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Verify stored files against the checksums in '
+        'db/aptrust.db')
+    parser.add_argument('--backend', default='s3',
+                        help="Read objects from 's3' or 'local'")
+    parser.add_argument('--bucket', default=VA_BUCKET_NAME,
+                        help="S3 bucket to read, for the s3 backend")
+    parser.add_argument('--root',
+                        help="Directory of files named by UUID, for the "
+                        "local backend")
+    parser.add_argument('--threads', type=int, default=8,
+                        help="Number of objects to read and hash at once")
+    parser.add_argument('--buffer-size', type=int, default=BUFFER_SIZE,
+                        help="Bytes to read and hash at a time")
+    parser.add_argument('--object',
+                        help="Only check the files of the object with "
+                        "this identifier")
+    parser.add_argument('--limit', type=int,
+                        help="Check at most this many files")
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    if args.backend == 'local':
+        if not args.root:
+            parser.error("--backend local requires --root")
+        backend = LocalBackend(args.root)
+    elif args.backend == 's3':
+        backend = S3Backend(args.bucket)
+    else:
+        parser.error("Unknown backend: {0}".format(args.backend))
+    metrics = metrics_from_args('fixity_check', args)
+    conn = sqlite3.connect(DB_PATH)
+    total, total_bytes = files_total(conn, args.object, args.limit)
+    print("Checking {0} files".format(total))
+    rows = files_to_check(conn, args.object, args.limit)
+    run = check(conn, backend, rows, args.threads, args.buffer_size, metrics,
+                total, total_bytes)
+    conn.close()
+    metrics.finish()
+    print("{0} ok, {1} mismatched, {2} missing, {3} errors, {4} unverified. "
+          "{5:.1f} MB/s, {6:.1f} files/s.".format(
+              run['ok'], run['mismatched'], run['missing'], run['errors'],
+              run['unverified'], run['mb_per_second'],
+              run['files_per_second']))
+    if run['mismatched'] or run['missing'] or run['errors']:
+        sys.exit(1)
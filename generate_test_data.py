@@ -0,0 +1,399 @@
+#! /usr/bin/env python
+# generate_test_data.py
+"""
+Writes a synthetic set of the files our loaders read, so we can measure
+and profile the loaders without the production dumps, which are huge
+and contain sensitive information. The output directory gets:
+
+- apt_record.json: one ingest log record per bag, in the same format
+  as test/data/apt_record_sample.json (for logs_to_sql.py)
+- institutions.json, users.json, processed_items.json and objects.json:
+  the Fedora dumps from the fluctus rake tasks (for fedora_to_sql.py)
+- s3_listing.json: one line per key in the preservation and Glacier
+  buckets, with the metadata our ingest services store with each key
+  (for s3_buckets_to_sql.py --listing)
+
+Everything is generated from the seed, so the same arguments always
+produce the same files. Records are written as they're generated, so
+memory use doesn't grow with the number of bags, and you can generate
+tens of millions of rows.
+
+A fraction of bags (--error-rate) look like the ones audit_001.py was
+written for: Fluctus returned an error while recording the bag, so the
+ingest record has an error message, the work item failed in the Record
+stage, some of the bag's files never made it into Fedora, and some
+were never copied to Glacier.
+
+Usage:
+
+python generate_test_data.py --bags 1000 --files-per-bag 20 --output-dir data/synthetic
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import uuid
+from datetime import datetime, timedelta
+
+S3_BUCKET = 'aptrust.preservation.storage'
+GLACIER_BUCKET = 'aptrust.preservation.oregon'
+STORAGE_URL = 'https://s3.amazonaws.com/aptrust.preservation.storage/'
+
+# Bag number 1 is ingested at this time, and each
+# bag after that one minute later than the last.
+START_TIME = datetime(2015, 9, 1)
+
+TAG_FILES = ['aptrust-info.txt', 'bag-info.txt', 'bagit.txt',
+             'manifest-md5.txt']
+
+# (extension, mime type) for the files in each bag's data directory
+FILE_TYPES = [('txt', 'text/plain'),
+              ('xml', 'application/xml'),
+              ('jpg', 'image/jpeg'),
+              ('tif', 'image/tiff'),
+              ('pdf', 'application/pdf'),
+              ('mov', 'video/quicktime')]
+
+FEDORA_ERROR = ("POST to Fluctus returned status 500 Internal Server "
+                "Error while recording generic files")
+
+
+def generate(output_dir, bags, files_per_bag, institution_count,
+             error_rate, seed):
+    """
+    Writes all of the data files to output_dir. Returns a dict of
+    the number of records written to each file.
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    rng = random.Random(seed)
+    institutions = make_institutions(institution_count)
+    counts = {}
+    path = os.path.join(output_dir, 'institutions.json')
+    counts['institutions.json'] = write_lines(path, institutions)
+    path = os.path.join(output_dir, 'users.json')
+    counts['users.json'] = write_lines(
+        path, [make_user(i) for i in institutions])
+
+    pids = itertools.count(institution_count + 1)
+    files = {}
+    for name in ['apt_record.json', 'processed_items.json',
+                 'objects.json', 's3_listing.json']:
+        files[name] = open(os.path.join(output_dir, name), 'w')
+        counts[name] = 0
+    try:
+        for number in range(1, bags + 1):
+            institution = institutions[number % len(institutions)]
+            bag = make_bag(rng, number, institution, files_per_bag,
+                           rng.random() < error_rate)
+            write_line(files['apt_record.json'], make_apt_record(bag))
+            write_line(files['processed_items.json'],
+                       make_work_item(bag, institution))
+            write_line(files['objects.json'],
+                       make_fedora_object(rng, bag, pids))
+            counts['apt_record.json'] += 1
+            counts['processed_items.json'] += 1
+            counts['objects.json'] += 1
+            for key in make_s3_keys(bag):
+                write_line(files['s3_listing.json'], key)
+                counts['s3_listing.json'] += 1
+            if number % 10000 == 0:
+                print("Generated {0} bags".format(number))
+    finally:
+        for f in files.values():
+            f.close()
+    return counts
+
+def write_lines(path, records):
+    with open(path, 'w') as f:
+        for record in records:
+            write_line(f, record)
+    return len(records)
+
+def write_line(f, record):
+    f.write(json.dumps(record, separators=(',', ':')))
+    f.write("\n")
+
+def make_institutions(count):
+    institutions = [{"pid": "aptrust:1", "name": "APTrust",
+                     "brief_name": "apt", "identifier": "aptrust.org",
+                     "dpn_uuid": None}]
+    for i in range(2, count + 1):
+        institutions.append({
+            "pid": "aptrust:{0}".format(i),
+            "name": "Synthetic University {0}".format(i),
+            "brief_name": "syn{0}".format(i),
+            "identifier": "syn{0}.edu".format(i),
+            "dpn_uuid": None})
+    return institutions
+
+def make_user(institution):
+    return {
+        "id": int(institution['pid'].split(':')[1]),
+        "email": "admin@{0}".format(institution['identifier']),
+        "name": "{0} Admin".format(institution['name']),
+        "phone_number": "4345551212",
+        "institution_pid": institution['pid'],
+        "encrypted_api_secret_key": None,
+        "encrypted_password": "x" * 60,
+        "created_at": timestamp(START_TIME),
+        "updated_at": timestamp(START_TIME)}
+
+def make_bag(rng, number, institution, files_per_bag, failed):
+    """
+    Returns a dict describing one bag and the files in its data
+    directory. The make_* functions below turn it into the record
+    each source system would have for it.
+    """
+    inst = institution['identifier']
+    name = "{0}.bag_{1:08d}".format(inst, number)
+    ingested_at = START_TIME + timedelta(minutes=number)
+    files = []
+    for i in range(files_per_bag):
+        extension, mime_type = FILE_TYPES[i % len(FILE_TYPES)]
+        path = "data/file_{0:05d}.{1}".format(i, extension)
+        # In failed bags, every third file never made it into Fedora,
+        # and those and the next file over were never sent to Glacier.
+        files.append({
+            'path': path,
+            'size': rng.randint(100, 10 * 1024 * 1024),
+            'md5': "{0:032x}".format(rng.getrandbits(128)),
+            'sha256': "{0:064x}".format(rng.getrandbits(256)),
+            'uuid': random_uuid(rng),
+            'mime_type': mime_type,
+            'identifier': "{0}/{1}/{2}".format(inst, name, path),
+            'in_fedora': not failed or i % 3 != 0,
+            'in_glacier': not failed or i % 3 == 2,
+        })
+    return {
+        'number': number,
+        'institution': inst,
+        'name': name,
+        'tar_name': name + '.tar',
+        'identifier': "{0}/{1}".format(inst, name),
+        'etag': "{0:032x}".format(rng.getrandbits(128)),
+        'size': sum(f['size'] for f in files) + 10240,
+        'ingested_at': ingested_at,
+        'failed': failed,
+        'files': files,
+    }
+
+def make_apt_record(bag):
+    """
+    Returns an ingest log record in the format of apt_record.json.
+    """
+    bucket = "aptrust.receiving.{0}".format(bag['institution'])
+    local_file = "/mnt/apt/data/{0}".format(bag['tar_name'])
+    output_dir = "/mnt/apt/data/{0}".format(bag['name'])
+    stored_at = timestamp(bag['ingested_at'] + timedelta(seconds=30))
+    error = FEDORA_ERROR if bag['failed'] else ""
+    generic_files = []
+    for f in bag['files']:
+        generic_files.append({
+            "Path": f['path'],
+            "Size": f['size'],
+            "Created": "0001-01-01T00:00:00Z",
+            "Modified": timestamp(bag['ingested_at'] - timedelta(days=1)),
+            "Md5": f['md5'],
+            "Md5Verified": stored_at,
+            "Sha256": f['sha256'],
+            "Sha256Generated": stored_at,
+            "Uuid": f['uuid'],
+            "UuidGenerated": stored_at,
+            "MimeType": f['mime_type'],
+            "ErrorMessage": "",
+            "StorageURL": STORAGE_URL + f['uuid'],
+            "StoredAt": stored_at,
+            "StorageMd5": f['md5'],
+            "Identifier": f['identifier'],
+            "IdentifierAssigned": stored_at,
+            "ExistingFile": False,
+            "NeedsSave": True,
+            "ReplicationError": ""})
+    data_paths = [f['path'] for f in bag['files']]
+    return {
+        "S3File": {
+            "BucketName": bucket,
+            "Key": {
+                "Key": bag['tar_name'],
+                "LastModified": timestamp(bag['ingested_at']),
+                "Size": bag['size'],
+                "ETag": '"{0}"'.format(bag['etag']),
+                "StorageClass": "STANDARD",
+                "Owner": {"ID": "0" * 64, "DisplayName": "aws-admin"}}},
+        "ErrorMessage": error,
+        "FetchResult": {
+            "BucketName": bucket,
+            "Key": bag['tar_name'],
+            "LocalFile": local_file,
+            "RemoteMd5": bag['etag'],
+            "LocalMd5": bag['etag'],
+            "Md5Verified": True,
+            "Md5Verifiable": True,
+            "ErrorMessage": "",
+            "Warning": "",
+            "Retry": True},
+        "TarResult": {
+            "InputFile": local_file,
+            "OutputDir": output_dir,
+            "ErrorMessage": "",
+            "Warnings": None,
+            "FilesUnpacked": sorted(TAG_FILES + data_paths),
+            "Files": generic_files},
+        "BagReadResult": {
+            "Path": output_dir,
+            "Files": sorted(TAG_FILES + data_paths),
+            "ErrorMessage": "",
+            "Tags": [
+                {"Label": "BagIt-Version", "Value": "0.97"},
+                {"Label": "Tag-File-Character-Encoding", "Value": "UTF-8"},
+                {"Label": "Source-Organization", "Value": bag['institution']},
+                {"Label": "Bagging-Date",
+                 "Value": bag['ingested_at'].strftime('%Y-%m-%d')},
+                {"Label": "Title", "Value": "Synthetic bag {0}".format(
+                    bag['number'])},
+                {"Label": "Access", "Value": "Institution"}],
+            "ChecksumErrors": None},
+        "FedoraResult": {
+            "ObjectIdentifier": bag['identifier'],
+            "GenericFilePaths": data_paths,
+            "MetadataRecords": None,
+            "IsNewObject": True,
+            "ErrorMessage": error},
+        "Stage": "Record",
+        "Retry": True}
+
+def make_work_item(bag, institution):
+    """
+    Returns a processed item record, as dumped by
+    rake fluctus:dump_processed_items.
+    """
+    if bag['failed']:
+        stage, status, outcome = 'Record', 'Failed', FEDORA_ERROR
+    else:
+        stage, status, outcome = 'Cleanup', 'Success', 'Bag ingested'
+    updated_at = timestamp(bag['ingested_at'] + timedelta(minutes=5))
+    return {
+        "id": bag['number'],
+        "name": bag['tar_name'],
+        "etag": '"{0}"'.format(bag['etag']),
+        "bag_date": timestamp(bag['ingested_at'] - timedelta(days=1)),
+        "bucket": "aptrust.receiving.{0}".format(bag['institution']),
+        "user": "admin@{0}".format(institution['identifier']),
+        "institution": bag['institution'],
+        "date": timestamp(bag['ingested_at']),
+        "note": outcome,
+        "action": "Ingest",
+        "stage": stage,
+        "status": status,
+        "outcome": outcome,
+        "retry": True,
+        "reviewed": False,
+        "object_identifier": bag['identifier'],
+        "generic_file_identifier": None,
+        "created_at": timestamp(bag['ingested_at']),
+        "updated_at": updated_at}
+
+def make_fedora_object(rng, bag, pids):
+    """
+    Returns an intellectual object with its generic files, checksums
+    and events, as dumped by rake fluctus:dump_data. Files that didn't
+    make it into Fedora are left out.
+    """
+    recorded_at = timestamp(bag['ingested_at'] + timedelta(minutes=1))
+    generic_files = []
+    for f in bag['files']:
+        if not f['in_fedora']:
+            continue
+        events = [make_event(rng, event_type, f['identifier'], recorded_at)
+                  for event_type in ['identifier_assignment',
+                                     'fixity_generation', 'ingest']]
+        generic_files.append({
+            "id": "aptrust:{0}".format(next(pids)),
+            "uri": STORAGE_URL + f['uuid'],
+            "size": f['size'],
+            "created": recorded_at,
+            "modified": recorded_at,
+            "file_format": f['mime_type'],
+            "identifier": f['identifier'],
+            "state": "A",
+            "checksum": [
+                {"algorithm": "md5", "digest": f['md5'],
+                 "datetime": recorded_at},
+                {"algorithm": "sha256", "digest": f['sha256'],
+                 "datetime": recorded_at}],
+            "premisEvents": events})
+    return {
+        "id": "aptrust:{0}".format(next(pids)),
+        "identifier": bag['identifier'],
+        "title": "Synthetic bag {0}".format(bag['number']),
+        "description": "Generated by generate_test_data.py",
+        "access": "institution",
+        "bag_name": bag['name'],
+        "state": "A",
+        "alt_identifier": [],
+        "premisEvents": [make_event(rng, 'ingest', bag['identifier'],
+                                    recorded_at)],
+        "generic_files": generic_files}
+
+def make_event(rng, event_type, identifier, date_time):
+    return {
+        "identifier": random_uuid(rng),
+        "type": event_type,
+        "date_time": date_time,
+        "detail": "{0} for {1}".format(event_type, identifier),
+        "outcome": "success",
+        "outcome_detail": identifier,
+        "object": "APTrust bagman",
+        "agent": "https://github.com/APTrust/bagman",
+        "outcome_information": None}
+
+def make_s3_keys(bag):
+    """
+    Yields the preservation and Glacier keys for the bag's files,
+    in the format fake_s3.load_listing reads.
+    """
+    for f in bag['files']:
+        metadata = {
+            'institution': bag['institution'],
+            'bag': bag['name'],
+            'bagpath': f['path'],
+            'md5': f['md5'],
+            'sha256': f['sha256'],
+        }
+        buckets = [S3_BUCKET]
+        if f['in_glacier']:
+            buckets.append(GLACIER_BUCKET)
+        for bucket in buckets:
+            yield {
+                "bucket": bucket,
+                "name": f['uuid'],
+                "size": f['size'],
+                "content_type": f['mime_type'],
+                "last_modified": timestamp(bag['ingested_at']),
+                "metadata": metadata}
+
+def random_uuid(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+def timestamp(dt):
+    return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Generate synthetic input files for the loaders')
+    parser.add_argument('--bags', type=int, default=1000)
+    parser.add_argument('--files-per-bag', type=int, default=20)
+    parser.add_argument('--institutions', type=int, default=10)
+    parser.add_argument('--error-rate', type=float, default=0.05,
+                        help="Fraction of bags that failed in the "
+                        "Record stage")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output-dir', default='data/synthetic')
+    args = parser.parse_args()
+    counts = generate(args.output_dir, args.bags, args.files_per_bag,
+                      args.institutions, args.error_rate, args.seed)
+    for name in sorted(counts):
+        print("{0:<24} {1:>10d} records".format(name, counts[name]))
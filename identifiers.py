@@ -0,0 +1,61 @@
+# identifiers.py
+"""
+Helpers for deriving the values we join on across the ingest logs,
+Fedora and S3. The loaders store these values in their own indexed
+columns, so the audit queries can use plain equality joins instead
+of string expressions that SQLite can't use an index for.
+"""
+
+def uuid_from_url(url):
+    """
+    Returns the last component of an S3 storage URL or a Fedora file
+    URI. That's the UUID under which the file is stored in the S3 and
+    Glacier preservation buckets. Returns None if url is empty.
+    """
+    if not url:
+        return None
+    return url.split('/')[-1]
+
+def strip_tar_suffix(name):
+    """
+    Removes a trailing .tar from a bag or tar file name. Note that
+    rstrip('.tar') is not the same thing: it strips any trailing
+    '.', 't', 'a' and 'r' characters, so it turns 'bag.data.tar' into
+    'bag.d'.
+    """
+    if name and name.endswith('.tar'):
+        return name[:-4]
+    return name
+
+def bag_key(institution, bag_name):
+    """
+    Returns the canonical key we use to match a bag across work items,
+    Fedora objects, ingest records and S3 keys: the institution
+    identifier and the bag name without a .tar suffix, separated by a
+    slash. E.g. 'virginia.edu/virginia.edu.uva-lib_2278801'.
+    Returns None if either part is missing.
+    """
+    if not institution or not bag_name:
+        return None
+    return "{0}/{1}".format(institution.lower(), strip_tar_suffix(bag_name))
+
+def bag_key_from_identifier(identifier):
+    """
+    Returns the bag key for an object identifier, which has the form
+    institution/bag_name, with or without a .tar suffix.
+    """
+    if not identifier or '/' not in identifier:
+        return None
+    institution, bag_name = identifier.split('/', 1)
+    return bag_key(institution, bag_name)
+
+def institution_from_identifier(identifier):
+    """
+    Returns the institution identifier, in lower case, at the start of
+    an object identifier or bag key. E.g. 'virginia.edu' for
+    'virginia.edu/virginia.edu.uva-lib_2278801'. Returns None if
+    identifier has no institution part.
+    """
+    if not identifier or '/' not in identifier:
+        return None
+    return identifier.split('/', 1)[0].lower()
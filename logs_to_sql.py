@@ -4,27 +4,34 @@
 Imports JSON data from the apt_record.json log into a SQLite DB.
 Specifically, this imports intellectual object and generic file data.
 """
+import argparse
 from datetime import datetime
 import json
 import os
 import sqlite3
-import sys
+import time
+
+from identifiers import bag_key_from_identifier, uuid_from_url
+from metrics import Metrics, add_metrics_arguments, metrics_from_args
 
 # http://stackoverflow.com/questions/15856976/transactions-with-python-sqlite3
 
-def import_json(file_path, conn):
+def import_json(file_path, conn, metrics=None):
     line_number = 0
     records_inserted = 0
+    if metrics is None:
+        metrics = Metrics('logs_to_sql')
+    metrics.set_totals(total_bytes=os.path.getsize(file_path))
     with open(file_path) as f:
         for line in f:
             line_number += 1
-            if line_number % 500 == 0:
-                print("Processed {0} lines".format(line_number))
             try:
-                data = json.loads(line)
+                with metrics.stage('decode'):
+                    data = json.loads(line)
             except ValueError as err:
                 print("Error decoding JSON on line {0}: {1}".format(line_number, err))
-            records_inserted += insert_record(conn, data)
+            records_inserted += insert_record(conn, data, metrics)
+            metrics.progress(bytes_read=len(line))
     print("Processed {0} json records. Inserted {1} new records".format(
         line_number, records_inserted))
 
@@ -48,18 +55,22 @@ def record_exists(conn, etag, bucket_name, key, s3_file_last_modified):
     cursor.close()
     return result[0] == 1
 
-def insert_record(conn, data):
+def insert_record(conn, data, metrics):
     """
     Adds a record to the database. Returns 0 if the record already exists,
     1 if the record was inserted, and -1 if the insert transaction failed.
     """
-    if record_exists(conn,
-                     data['S3File']['Key']['ETag'].replace('"', ''),
-                     data['S3File']['BucketName'],
-                     data['S3File']['Key']['Key'],
-                     data['S3File']['Key']['LastModified']):
+    with metrics.stage('dedupe'):
+        exists = record_exists(conn,
+                               data['S3File']['Key']['ETag'].replace('"', ''),
+                               data['S3File']['BucketName'],
+                               data['S3File']['Key']['Key'],
+                               data['S3File']['Key']['LastModified'])
+    if exists:
+        metrics.count('existing')
         return 0
     try:
+        started = time.time()
         conn.execute("begin")
         ingest_record_id = insert_ingest_record(conn, data)
 
@@ -105,7 +116,10 @@ def insert_record(conn, data):
                 for metadata_obj in data['FedoraResult']['MetadataRecords']:
                     insert_fedora_metadata(conn, metadata_obj, fedora_result_id)
 
-        conn.execute("commit")
+        metrics.add_time('insert', time.time() - started)
+        with metrics.stage('commit'):
+            conn.execute("commit")
+        metrics.count('inserted')
         return 1
 
     except sqlite3.Error as err:
@@ -113,6 +127,7 @@ def insert_record(conn, data):
             data['S3File']['BucketName'],
             data['S3File']['Key']['Key']))
         conn.execute("rollback")
+        metrics.count('failed')
         return -1
 
 def do_insert(conn, statement, values):
@@ -136,8 +151,9 @@ def insert_ingest_record(conn, data):
       retry,
       object_identifier,
       created_at,
-      updated_at)
-    values(?,?,?,?,?,?)
+      updated_at,
+      bag_key)
+    values(?,?,?,?,?,?,?)
     """
     now = datetime.utcnow()
     object_identifier = get_object_identifier(
@@ -148,7 +164,8 @@ def insert_ingest_record(conn, data):
               data['Retry'],
               object_identifier,
               now,
-              now)
+              now,
+              bag_key_from_identifier(object_identifier))
     return do_insert(conn, statement, values)
 
 def insert_s3_file(conn, data, ingest_record_id):
@@ -271,9 +288,10 @@ def insert_generic_files(conn, generic_file, tar_result_id):
       needs_save,
       replication_error,
       created_at,
-      updated_at
+      updated_at,
+      storage_uuid
     )
-    values(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+    values(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
     """
     now = datetime.utcnow()
     values = (tar_result_id,
@@ -299,6 +317,7 @@ def insert_generic_files(conn, generic_file, tar_result_id):
               generic_file['ReplicationError'],
               now,
               now,
+              uuid_from_url(generic_file['StorageURL']),
     )
     return do_insert(conn, statement, values)
 
@@ -451,7 +470,8 @@ def initialize_db(conn):
         retry bool,
         object_identifier text,
         created_at datetime default current_timestamp,
-        updated_at datetime default current_timestamp)"""
+        updated_at datetime default current_timestamp,
+        bag_key text)"""
         conn.execute(statement)
         conn.commit()
 
@@ -540,6 +560,7 @@ def initialize_db(conn):
         replication_error text,
         created_at datetime default current_timestamp,
         updated_at datetime default current_timestamp,
+        storage_uuid text,
         FOREIGN KEY(ingest_tar_result_id)
         REFERENCES ingest_tar_results(id))"""
         conn.execute(statement)
@@ -654,6 +675,13 @@ def initialize_db(conn):
         conn.execute(statement)
         conn.commit()
 
+        # Index for matching bags across sources
+        print("Creating index ix_bag_key on ingest_records")
+        statement = """create index ix_bag_key on
+        ingest_records(bag_key)"""
+        conn.execute(statement)
+        conn.commit()
+
         # Foreign key indexes
         print("Creating index ix_ingest_fetch_results_fk1")
         statement = """create index ix_ingest_fetch_results_fk1 on
@@ -679,6 +707,13 @@ def initialize_db(conn):
         conn.execute(statement)
         conn.commit()
 
+        # UUID the file is stored under, from the end of storage_url
+        print("Creating index ix_ingest_generic_files_storage_uuid")
+        statement = """create index ix_ingest_generic_files_storage_uuid on
+        ingest_generic_files(storage_uuid)"""
+        conn.execute(statement)
+        conn.commit()
+
         print("Creating index ix_ingest_bag_read_results_fk1")
         statement = """create index ix_ingest_bag_read_results_fk1 on
         ingest_bag_read_results(ingest_record_id)"""
@@ -724,16 +759,20 @@ def initialize_db(conn):
     c.close()
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Missing arg: path to json log file")
-        print("Usage: python logs_to_sql.py <path/to/logfile.json>")
-        sys.exit()
+    parser = argparse.ArgumentParser(
+        description='Load an apt_record.json log into db/aptrust_logs.db')
+    parser.add_argument('file_path', help="Path to the JSON log file")
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics = metrics_from_args('logs_to_sql', args)
     if not os.path.exists('db'):
         os.mkdir('db')
     conn = sqlite3.connect('db/aptrust_logs.db')
     # Turn OFF automatic transactions, because we want to
     # manage these manually.
     conn.isolation_level = None
-    initialize_db(conn)
-    import_json(sys.argv[1], conn)
+    with metrics.stage('initialize'):
+        initialize_db(conn)
+    import_json(args.file_path, conn, metrics)
     conn.close()
+    metrics.finish()
@@ -71,6 +71,7 @@ create table work_items(
   generic_file_identifier varchar(255),
   created_at datetime,
   updated_at datetime,
+  bag_key varchar(255),
   FOREIGN KEY(institution_id)
   REFERENCES institutions(id));
 
@@ -85,6 +86,7 @@ create table objects(
   identifier varchar(255),
   state char(1),
   alt_identifier varchar(255),
+  bag_key varchar(255),
   FOREIGN KEY(institution_id) REFERENCES institutions(id));
 
 create table files(
@@ -98,6 +100,7 @@ create table files(
   file_format varchar(80),
   identifier varchar(255),
   state char(1),
+  uri_uuid varchar(40),
   FOREIGN KEY(object_id) REFERENCES objects(id));
 
 create table checksums(
@@ -124,6 +127,15 @@ create table events(
   FOREIGN KEY(object_id) REFERENCES objects(id)
   FOREIGN KEY(file_id) REFERENCES files(id));
 
+-- Number of events of each type per file, and per object for events
+-- that aren't about a file (those have file_id 0). fedora_to_sql.py
+-- keeps it up to date as it loads events.
+create table event_counts(
+  file_id int not null,
+  object_id int not null,
+  type varchar(80) not null,
+  event_count int not null default 0);
+
 
 --
 -- Import the data
@@ -135,21 +147,27 @@ insert into files select * from fedora.files;
 insert into checksums select * from fedora.checksums;
 insert into events select * from fedora.events;
 insert into work_items select * from fedora.work_items;
+insert into event_counts select * from fedora.event_counts;
 
 --
 -- Create Indexes last, so they don't slow the inserts
 --
 create unique index ix_obj_pid on objects(pid);
 create unique index ix_obj_identifier on objects(identifier);
+create index ix_obj_bag_key on objects(bag_key);
 create unique index ix_file_pid on files(pid);
 create unique index ix_file_identifier on files(identifier);
 create index ix_file_object_id on files(object_id);
+create index ix_file_uri_uuid on files(uri_uuid);
 create index ix_checksum_file_id on checksums(file_id);
 create index ix_events_object_id on events(object_id);
 create index ix_events_file_id on events(file_id);
 create unique index ix_events_identifier on events(identifier);
+create unique index ix_event_counts on event_counts(object_id, file_id, type);
 create unique index ix_users_email on users(email);
 create index ix_name_etag_bucket on work_items(name, etag, bucket);
+create index ix_work_items_bag_key on work_items(bag_key);
+create index ix_work_items_stage_status on work_items(stage, status);
 
 
 ------------------------------------------------------------------------
@@ -164,7 +182,8 @@ create table ingest_records(
   retry bool,
   object_identifier varchar(255),
   created_at datetime default current_timestamp,
-  updated_at datetime default current_timestamp);
+  updated_at datetime default current_timestamp,
+  bag_key varchar(255));
 
 create table ingest_s3_files(
   id integer primary key autoincrement,
@@ -238,6 +257,7 @@ create table ingest_generic_files(
   replication_error text,
   created_at datetime default current_timestamp,
   updated_at datetime default current_timestamp,
+  storage_uuid varchar(40),
   FOREIGN KEY(ingest_tar_result_id)
   REFERENCES ingest_tar_results(id));
 
@@ -338,6 +358,9 @@ on ingest_s3_files(key);
 create index ix_ingest_obj_identifier
 on ingest_records(object_identifier);
 
+create index ix_ingest_bag_key
+on ingest_records(bag_key);
+
 create index ix_ingest_ingest_fetch_results_fk1
 on ingest_fetch_results(ingest_record_id);
 
@@ -350,6 +373,15 @@ on ingest_unpacked_files(ingest_tar_result_id);
 create index ix_ingest_ingest_generic_files_fk1
 on ingest_generic_files(ingest_tar_result_id);
 
+create index ix_ingest_generic_files_identifier
+on ingest_generic_files(identifier);
+
+create index ix_ingest_generic_files_uuid
+on ingest_generic_files(uuid);
+
+create index ix_ingest_generic_files_storage_uuid
+on ingest_generic_files(storage_uuid);
+
 create index ix_ingest_ingest_bag_read_results_fk1
 on ingest_bag_read_results(ingest_record_id);
 
@@ -386,7 +418,10 @@ create table s3_keys(
   etag varchar(80),
   last_modified datetime,
   storage_class varchar(40),
-  size int);
+  size int,
+  last_seen_at datetime,
+  deleted_at datetime,
+  bag_key varchar(255));
 
 create table s3_meta(
   key_id integer,
@@ -406,5 +441,13 @@ insert into s3_meta select * from s3.s3_meta;
 --
 
 create unique index ix_s3_name_etag_bucket on s3_keys(name, etag, bucket);
+create index ix_s3_bucket_name on s3_keys(bucket, name);
+create index ix_s3_bag_key on s3_keys(bag_key);
+create index ix_s3_last_modified on s3_keys(last_modified);
+-- Only deleted keys are indexed, so that "deleted_at is null" can't
+-- use this index. Without statistics SQLite would look live keys up
+-- by it, which reads nearly every key.
+create index ix_s3_deleted_keys on s3_keys(deleted_at)
+  where deleted_at is not null;
 create index ix_s3_meta_key_id on s3_meta(key_id);
 create index ix_s3_meta_name_value on s3_meta(name, value);
@@ -0,0 +1,262 @@
+# metrics.py
+"""
+Progress reporting and per-stage timing for the loaders and audit
+scripts. Each script creates one Metrics object, times the stages of
+its main loop, and reports progress after each record. Progress is
+written to stderr at most once every interval seconds, with the rate,
+the bytes read and an ETA when the total is known, so a run over
+millions of records doesn't spend its time writing to the terminal.
+
+    metrics = Metrics('logs_to_sql', total_bytes=os.path.getsize(path))
+    for line in f:
+        with metrics.stage('decode'):
+            data = json.loads(line)
+        ...
+        metrics.progress(bytes_read=len(line))
+    metrics.finish()
+
+finish() prints the time spent in each stage and, if output_path is
+set, writes everything to a JSON file, so runs can be compared.
+Scripts take these settings from the command line through
+add_metrics_arguments() and metrics_from_args():
+
+    --metrics metrics.json       write the final metrics as JSON
+    --progress-interval 10       seconds between progress lines
+    --profile run.prof           run under cProfile and save the stats
+    --trace-memory               record the top allocation sites
+"""
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    # tracemalloc is in the standard library from Python 3.4 on.
+    # On Python 2 it needs the pytracemalloc backport.
+    tracemalloc = None
+
+
+class Metrics(object):
+    """
+    Collects progress, stage timings and counters for one run of a
+    script. Params total and total_bytes, if known, are used to
+    estimate the time remaining. Stages, counters and progress can be
+    recorded from several threads at once.
+    """
+    def __init__(self, name, total=None, total_bytes=None, interval=10.0,
+                 output_path=None, profile_path=None, trace_memory=False,
+                 stream=None):
+        self.name = name
+        self.total = total
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.output_path = output_path
+        self.profile_path = profile_path
+        self.stream = stream or sys.stderr
+        self.items = 0
+        self.bytes_read = 0
+        self.stages = {}
+        self.stage_order = []
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.started_at = datetime.utcnow()
+        self.start_time = time.time()
+        self.last_report = self.start_time
+        self.profiler = None
+        self.trace_memory = trace_memory and tracemalloc is not None
+        if trace_memory and tracemalloc is None:
+            # Always to stderr, even when progress goes somewhere else.
+            sys.stderr.write("{0}: tracemalloc is not available in this "
+                             "Python. Not tracing memory.\n".format(name))
+        if self.trace_memory:
+            tracemalloc.start()
+        if profile_path:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def set_totals(self, total=None, total_bytes=None):
+        """
+        Sets the expected number of items or bytes, once known.
+        """
+        if total is not None:
+            self.total = total
+        if total_bytes is not None:
+            self.total_bytes = total_bytes
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager that adds the time spent in its block
+        to the named stage.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    def add_time(self, name, seconds, calls=1):
+        """
+        Adds time to the named stage. Use this where a with block
+        would mean re-indenting a long stretch of code.
+        """
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = [0.0, 0]
+                self.stage_order.append(name)
+            stage[0] += seconds
+            stage[1] += calls
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def progress(self, items=1, bytes_read=0):
+        """
+        Records that items were processed and bytes_read bytes were
+        read, and writes a progress line if it's been at least
+        interval seconds since the last one.
+        """
+        with self.lock:
+            self.items += items
+            self.bytes_read += bytes_read
+            now = time.time()
+            due = now - self.last_report >= self.interval
+            if due:
+                self.last_report = now
+        if due:
+            self.report_progress(now)
+
+    def report_progress(self, now=None):
+        now = now or time.time()
+        self.last_report = now
+        elapsed = now - self.start_time
+        rate = self.items / elapsed if elapsed > 0 else 0
+        line = "{0}: {1} items in {2}, {3:.1f}/s".format(
+            self.name, self.items, format_seconds(elapsed), rate)
+        if self.bytes_read:
+            line += ", {0:.1f} MB read".format(self.bytes_read / 1048576.0)
+        fraction = self.fraction_done()
+        if fraction is not None and fraction > 0:
+            remaining = elapsed / fraction - elapsed
+            line += ", {0:.0f}% done, ETA {1}".format(
+                fraction * 100, format_seconds(remaining))
+        self.stream.write(line + "\n")
+
+    def fraction_done(self):
+        if self.total_bytes:
+            return min(1.0, float(self.bytes_read) / self.total_bytes)
+        if self.total:
+            return min(1.0, float(self.items) / self.total)
+        return None
+
+    def to_hash(self):
+        elapsed = time.time() - self.start_time
+        data = {
+            'script': self.name,
+            'started_at': self.started_at.isoformat(),
+            'finished_at': datetime.utcnow().isoformat(),
+            'seconds': elapsed,
+            'items': self.items,
+            'items_per_second': self.items / elapsed if elapsed > 0 else 0,
+            'bytes_read': self.bytes_read,
+            'stages': dict((name, {'seconds': s[0], 'calls': s[1]})
+                           for name, s in self.stages.items()),
+            'counters': dict(self.counters),
+        }
+        if resource is not None:
+            # ru_maxrss is in kilobytes on Linux, but bytes on OS X.
+            data['peak_rss_kb'] = resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss
+        return data
+
+    def finish(self):
+        """
+        Stops the profiler and memory tracer, writes the final progress
+        line and the time spent in each stage, and saves the metrics to
+        output_path, if there is one. Returns the metrics as a dict.
+        """
+        if self.profiler is not None:
+            self.profiler.disable()
+        self.report_progress()
+        data = self.to_hash()
+        for name in self.stage_order:
+            seconds, calls = self.stages[name]
+            self.stream.write("{0}:   {1:<14} {2:>10.2f}s {3:>10d} calls\n".format(
+                self.name, name, seconds, calls))
+        for name in sorted(self.counters):
+            self.stream.write("{0}:   {1:<14} {2:>10d}\n".format(
+                self.name, name, self.counters[name]))
+        if self.trace_memory:
+            data['memory'] = memory_report(tracemalloc.take_snapshot())
+            data['memory']['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        if self.profiler is not None:
+            self.profiler.dump_stats(self.profile_path)
+            data['profile_path'] = self.profile_path
+            self.stream.write("{0}: profile saved to {1}. To see it, run "
+                              "python -m pstats {1}\n".format(
+                                  self.name, self.profile_path))
+        if self.output_path:
+            with open(self.output_path, 'w') as f:
+                json.dump(data, f, indent=2, sort_keys=True)
+        return data
+
+
+def memory_report(snapshot, limit=10):
+    """
+    Returns the source lines that allocated the most memory
+    still in use when the snapshot was taken.
+    """
+    top = []
+    for stat in snapshot.statistics('lineno')[:limit]:
+        frame = stat.traceback[0]
+        top.append({'file': frame.filename, 'line': frame.lineno,
+                    'bytes': stat.size, 'blocks': stat.count})
+    return {'top_allocations': top}
+
+def format_seconds(seconds):
+    seconds = int(seconds)
+    return "{0}:{1:02d}:{2:02d}".format(
+        seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+def add_metrics_arguments(parser):
+    """
+    Adds the metrics and profiling options to an argparse parser.
+    """
+    parser.add_argument('--metrics',
+                        help="Write progress, stage timings and counters "
+                        "to this JSON file when done")
+    parser.add_argument('--progress-interval', type=float, default=10.0,
+                        help="Seconds between progress lines")
+    parser.add_argument('--profile',
+                        help="Run under cProfile and save the stats "
+                        "to this file")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="Record the top memory allocation sites "
+                        "with tracemalloc (Python 3.4+)")
+
+def metrics_from_args(name, args, **kwargs):
+    """
+    Returns a Metrics configured from the options that
+    add_metrics_arguments added. Exits if --trace-memory was given
+    and this Python can't trace memory, rather than running without it.
+    """
+    if args.trace_memory and tracemalloc is None:
+        sys.exit("--trace-memory needs tracemalloc, which is in Python "
+                 "3.4+. On Python 2 it needs the pytracemalloc backport.")
+    return Metrics(name, interval=args.progress_interval,
+                   output_path=args.metrics, profile_path=args.profile,
+                   trace_memory=args.trace_memory, **kwargs)
@@ -0,0 +1,263 @@
+#! /usr/bin/env python
+# reconcile_files.py
+"""
+Maintains the file_reconciliation table in db/aptrust.db. It has one
+row per generic file in the ingest logs (ingest_generic_files), with
+the results of joining that file to its Fedora record, its latest
+Fedora checksums, and its keys in the S3 and Glacier buckets:
+
+- in_fedora, in_s3, in_glacier: whether each system has the file.
+- checksums_match: whether Fedora's latest md5 and sha256 match the
+  checksums calculated at ingest (null if Fedora has no record).
+- authoritative_uuid: the UUID under which the file is actually stored
+  in S3. That's the uuid assigned at ingest if a key by that name
+  exists, otherwise the last component of the storage URL if a key by
+  that name exists, otherwise null.
+
+The first run builds the whole table. After that, each run refreshes
+only the files affected by rows added to ingest_generic_files, files,
+checksums or s3_keys since the last run, plus the files whose S3 keys
+were updated or deleted by an incremental crawl. The high-water marks
+for those source tables are kept in reconciliation_watermarks.
+
+Usage:
+
+python reconcile_files.py              # refresh changed files
+python reconcile_files.py --rebuild    # rebuild the whole table
+"""
+import argparse
+import sqlite3
+from datetime import datetime
+
+from compact_text import register_functions
+
+S3_BUCKET = 'aptrust.preservation.storage'
+GLACIER_BUCKET = 'aptrust.preservation.oregon'
+
+# Each watermark is the maximum value of one source column
+# as of the last refresh.
+WATERMARK_QUERIES = [
+    ('ingest_generic_files.id', "select max(id) from ingest_generic_files"),
+    ('files.id', "select max(id) from files"),
+    ('checksums.id', "select max(id) from checksums"),
+    ('s3_keys.id', "select max(id) from s3_keys"),
+    ('s3_keys.last_modified', "select max(last_modified) from s3_keys"),
+    ('s3_keys.deleted_at', "select max(deleted_at) from s3_keys"),
+]
+
+# Selects reconciliation rows for the generic files matched by
+# {where}. The inner query does the joins, and the outer query
+# derives the summary columns from them.
+RECONCILIATION_SELECT = """
+select r.*,
+  r.fedora_file_id is not null as in_fedora,
+  r.s3_key_id is not null as in_s3,
+  r.glacier_key_id is not null as in_glacier,
+  case when r.fedora_file_id is null then null
+       when r.fedora_md5 = r.md5 and r.fedora_sha256 = r.sha256 then 1
+       else 0 end as checksums_match,
+  case when r.s3_key_id is not null then r.uuid
+       when r.s3_storage_key_id is not null then r.storage_uuid
+       else null end as authoritative_uuid,
+  :refreshed_at as refreshed_at
+from (
+  select igf.id as generic_file_id,
+  ir.id as ingest_record_id,
+  ir.object_identifier as object_identifier,
+  igf.file_path as file_path,
+  igf.identifier as identifier,
+  igf.uuid as uuid,
+  igf.storage_uuid as storage_uuid,
+  igf.storage_url as storage_url,
+  igf.needs_save as needs_save,
+  igf.size as size,
+  igf.md5 as md5,
+  igf.sha256 as sha256,
+  f.id as fedora_file_id,
+  f.uri as fedora_uri,
+  f.uri_uuid as fedora_uuid,
+  f.size as fedora_size,
+  (select digest from checksums where file_id = f.id and algorithm = 'md5'
+   order by date_time desc limit 1) as fedora_md5,
+  (select digest from checksums where file_id = f.id and algorithm = 'sha256'
+   order by date_time desc limit 1) as fedora_sha256,
+  s3.id as s3_key_id,
+  s3.size as s3_size,
+  s3.etag as s3_etag,
+  (select max(id) from s3_keys where name = igf.storage_uuid
+   and bucket = :s3_bucket and deleted_at is null) as s3_storage_key_id,
+  gl.id as glacier_key_id,
+  gl.size as glacier_size,
+  gl.etag as glacier_etag
+  from ingest_generic_files igf
+  inner join ingest_tar_results itr on itr.id = igf.ingest_tar_result_id
+  inner join ingest_records ir on ir.id = itr.ingest_record_id
+  left join files f on f.identifier = igf.identifier
+  left join s3_keys s3 on s3.id =
+    (select max(id) from s3_keys where name = igf.uuid
+     and bucket = :s3_bucket and deleted_at is null)
+  left join s3_keys gl on gl.id =
+    (select max(id) from s3_keys where name = igf.uuid
+     and bucket = :glacier_bucket and deleted_at is null)
+  {where}
+) r"""
+
+# Collect the ids of generic files affected by source rows added or
+# changed since the last refresh.
+AFFECTED_QUERIES = [
+    """insert or ignore into reconciliation_affected
+    select id from ingest_generic_files where id > :ingest_generic_files_id""",
+
+    """insert or ignore into reconciliation_affected
+    select igf.id from files f
+    inner join ingest_generic_files igf on igf.identifier = f.identifier
+    where f.id > :files_id""",
+
+    """insert or ignore into reconciliation_affected
+    select igf.id from checksums c
+    inner join files f on f.id = c.file_id
+    inner join ingest_generic_files igf on igf.identifier = f.identifier
+    where c.id > :checksums_id""",
+
+    """insert or ignore into reconciliation_changed_keys
+    select name from s3_keys where id > :s3_keys_id
+    union select name from s3_keys where last_modified > :s3_keys_last_modified
+    union select name from s3_keys where deleted_at > :s3_keys_deleted_at""",
+
+    """insert or ignore into reconciliation_affected
+    select id from ingest_generic_files
+    where uuid in (select name from reconciliation_changed_keys)""",
+
+    """insert or ignore into reconciliation_affected
+    select id from ingest_generic_files
+    where storage_uuid in (select name from reconciliation_changed_keys)""",
+]
+
+
+def refresh(conn, rebuild=False):
+    """
+    Brings file_reconciliation up to date, building it from scratch if
+    it doesn't exist yet or if rebuild is True. Returns the number of
+    rows written.
+    """
+    ensure_source_indexes(conn)
+    watermarks = read_watermarks(conn)
+    current = current_watermarks(conn)
+    params = {
+        'refreshed_at': datetime.utcnow(),
+        's3_bucket': S3_BUCKET,
+        'glacier_bucket': GLACIER_BUCKET,
+    }
+    if rebuild or not table_exists(conn, 'file_reconciliation') or not watermarks:
+        print("Building file_reconciliation")
+        conn.execute("drop table if exists file_reconciliation")
+        conn.execute("create table file_reconciliation as {0}".format(
+            RECONCILIATION_SELECT.format(where="")), params)
+        create_indexes(conn)
+        count = conn.execute(
+            "select count(*) from file_reconciliation").fetchone()[0]
+    else:
+        count = refresh_affected(conn, watermarks, params)
+    save_watermarks(conn, current)
+    conn.commit()
+    print("Refreshed {0} rows in file_reconciliation".format(count))
+    return count
+
+def refresh_affected(conn, watermarks, params):
+    """
+    Deletes and recalculates the rows for files affected by source
+    rows newer than the saved watermarks.
+    """
+    conn.execute("""create temp table if not exists reconciliation_affected(
+    generic_file_id integer primary key)""")
+    conn.execute("""create temp table if not exists reconciliation_changed_keys(
+    name varchar(255) primary key)""")
+    conn.execute("delete from reconciliation_affected")
+    conn.execute("delete from reconciliation_changed_keys")
+    marks = {}
+    for source, value in watermarks.items():
+        marks[source.replace('.', '_')] = value
+    for query in AFFECTED_QUERIES:
+        conn.execute(query, marks)
+    conn.execute("""delete from file_reconciliation where generic_file_id in
+    (select generic_file_id from reconciliation_affected)""")
+    where = """where igf.id in
+    (select generic_file_id from reconciliation_affected)"""
+    c = conn.execute("insert into file_reconciliation {0}".format(
+        RECONCILIATION_SELECT.format(where=where)), params)
+    return c.rowcount
+
+def create_indexes(conn):
+    conn.execute("""create unique index ix_file_reconciliation_gf_id
+    on file_reconciliation(generic_file_id)""")
+    conn.execute("""create index ix_file_reconciliation_identifier
+    on file_reconciliation(identifier)""")
+    conn.execute("""create index ix_file_reconciliation_object_identifier
+    on file_reconciliation(object_identifier)""")
+    conn.execute("""create index ix_file_reconciliation_uuid
+    on file_reconciliation(uuid)""")
+    conn.execute("""create index ix_file_reconciliation_authoritative_uuid
+    on file_reconciliation(authoritative_uuid)""")
+    conn.execute("""create index ix_file_reconciliation_fedora_file_id
+    on file_reconciliation(fedora_file_id)""")
+
+def ensure_source_indexes(conn):
+    """
+    The incremental refresh looks up generic files by identifier and
+    uuid, and S3 keys by last_modified and deleted_at. merge_dbs.sql
+    creates these indexes, but databases merged before that change
+    won't have them. Older databases also have a full index on
+    deleted_at, which SQLite uses for "deleted_at is null" lookups,
+    so it's replaced with the partial one.
+    """
+    conn.execute("""create index if not exists ix_ingest_generic_files_identifier
+    on ingest_generic_files(identifier)""")
+    conn.execute("""create index if not exists ix_ingest_generic_files_uuid
+    on ingest_generic_files(uuid)""")
+    conn.execute("""create index if not exists ix_s3_last_modified
+    on s3_keys(last_modified)""")
+    conn.execute("drop index if exists ix_s3_deleted_at")
+    conn.execute("""create index if not exists ix_s3_deleted_keys
+    on s3_keys(deleted_at) where deleted_at is not null""")
+
+def table_exists(conn, table_name):
+    query = "SELECT name FROM sqlite_master WHERE type='table' AND name=?"
+    return conn.execute(query, (table_name,)).fetchone() is not None
+
+def current_watermarks(conn):
+    watermarks = {}
+    for source, query in WATERMARK_QUERIES:
+        watermarks[source] = conn.execute(query).fetchone()[0]
+    return watermarks
+
+def read_watermarks(conn):
+    conn.execute("""create table if not exists reconciliation_watermarks(
+    source varchar(80) primary key,
+    value numeric)""")
+    watermarks = {}
+    for row in conn.execute("select source, value from reconciliation_watermarks"):
+        watermarks[row[0]] = row[1]
+    if not watermarks:
+        return watermarks
+    # A null or missing watermark means the source table was empty
+    # (or not tracked) at the last refresh, so every row in it is new.
+    for source, query in WATERMARK_QUERIES:
+        if watermarks.get(source) is None:
+            watermarks[source] = 0 if source.endswith('.id') else ''
+    return watermarks
+
+def save_watermarks(conn, watermarks):
+    conn.executemany("""insert or replace into reconciliation_watermarks
+    (source, value) values (?,?)""", watermarks.items())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Refresh the file_reconciliation table in aptrust.db')
+    parser.add_argument('--rebuild', action='store_true',
+                        help="Rebuild the whole table")
+    args = parser.parse_args()
+    conn = sqlite3.connect('db/aptrust.db')
+    register_functions(conn)
+    refresh(conn, args.rebuild)
+    conn.close()
@@ -5,50 +5,171 @@ Lists all keys in the specified bucket, along with each key's metadata.
 Saves it all into a sqlite3 database.
 """
 
+import argparse
 import os
 import sqlite3
 import sys
-from boto.s3.connection import S3Connection
+import time
+from datetime import datetime
 
+from identifiers import bag_key
+from metrics import Metrics, add_metrics_arguments, metrics_from_args
 
-def list_bucket(bucket_name, conn):
+try:
+    from boto.s3.connection import S3Connection
+except ImportError:
+    # boto is only required when talking to the real S3. The
+    # benchmarks pass in a fake_s3.FakeS3Connection instead.
+    S3Connection = None
+
+
+def list_bucket(bucket_name, conn, incremental=False, s3=None, metrics=None):
+    """
+    Crawls the bucket and saves each key to the s3_keys table. By default,
+    keys that are already in the database are left alone. In incremental
+    mode, keys whose etag or last_modified changed are updated, and keys
+    that no longer appear in the bucket are marked as deleted.
+    Param s3 is an S3 connection. If it's None, we connect to AWS using
+    the credentials in the environment. Progress, the time spent listing
+    and saving, and the number of keys with each status are recorded in
+    metrics.
+    """
+    if metrics is None:
+        metrics = Metrics('s3_buckets_to_sql')
     create_db_if_necessary(conn)
-    s3 = S3Connection()
+    crawl_started_at = datetime.utcnow()
+    if s3 is None:
+        s3 = S3Connection()
     bucket = s3.get_bucket(bucket_name)
+    # The time between keys is the time spent waiting for the listing.
+    started = time.time()
     for key in bucket.list():
-        pk, saved = add_to_db(conn, bucket, key)
-        status = 'Inserted'
-        if saved == False:
-            status = 'Exists - Not Updated'
-        print("{0:08d}  {1}  {2}".format(pk, key.name, status))
+        metrics.add_time('list', time.time() - started)
+        with metrics.stage('save'):
+            if incremental:
+                pk, status = sync_to_db(conn, bucket, key, crawl_started_at)
+            else:
+                pk, saved = add_to_db(conn, bucket, key, crawl_started_at)
+                status = 'Inserted'
+                if saved == False:
+                    status = 'Exists - Not Updated'
+        metrics.count(status)
+        metrics.progress()
+        started = time.time()
+    with metrics.stage('commit'):
+        conn.commit()
+    if incremental:
+        with metrics.stage('mark_deleted'):
+            deleted = mark_deleted_keys(conn, bucket_name, crawl_started_at)
+        metrics.count('Deleted', deleted)
+        print("Marked {0} keys in {1} as deleted".format(deleted, bucket_name))
 
-def add_to_db(conn, bucket, key):
+def add_to_db(conn, bucket, key, crawl_started_at):
     pk = existing_record_id(conn, key)
     if pk:
-        return pk, False  # No need to process this again
+        # No need to process this again, but record that the crawl saw
+        # it, so a later incremental crawl doesn't mark it deleted.
+        conn.execute("update s3_keys set last_seen_at=? where id=?",
+                     (crawl_started_at, pk))
+        return pk, False
     statement = """insert into s3_keys
     (bucket, name, cache_control, content_type, etag,
-    last_modified, storage_class, size)
-    values (?,?,?,?,?,?,?,?)"""
+    last_modified, storage_class, size, last_seen_at)
+    values (?,?,?,?,?,?,?,?,?)"""
     c = conn.cursor()
     c.execute(statement, (key.bucket.name, key.name,
                           key.cache_control, key.content_type,
                           key.etag.replace('"', ''),
                           key.last_modified, key.storage_class,
-                          key.size))
+                          key.size, crawl_started_at))
     conn.commit()
     pk = c.lastrowid
+    save_metadata(conn, bucket, key, pk)
+    c.close()
+    return pk, True
+
+def sync_to_db(conn, bucket, key, crawl_started_at):
+    """
+    Incremental version of add_to_db. Returns the key's primary key
+    and a status string. Metadata is fetched from S3 only for keys that
+    are new or whose etag or last_modified changed since the last crawl.
+    Keys that haven't changed just get a new last_seen_at timestamp.
+    """
+    etag = key.etag.replace('"', '')
+    row = current_record(conn, key)
+    c = conn.cursor()
+    if row is None:
+        statement = """insert into s3_keys
+        (bucket, name, cache_control, content_type, etag,
+        last_modified, storage_class, size, last_seen_at)
+        values (?,?,?,?,?,?,?,?,?)"""
+        c.execute(statement, (key.bucket.name, key.name,
+                              key.cache_control, key.content_type,
+                              etag, key.last_modified, key.storage_class,
+                              key.size, crawl_started_at))
+        pk = c.lastrowid
+        status = 'Inserted'
+    elif row[1] == etag and row[2] == key.last_modified:
+        pk = row[0]
+        statement = "update s3_keys set last_seen_at=? where id=?"
+        c.execute(statement, (crawl_started_at, pk))
+        c.close()
+        return pk, 'Unchanged'
+    else:
+        pk = row[0]
+        statement = """update s3_keys set cache_control=?, content_type=?,
+        etag=?, last_modified=?, storage_class=?, size=?, last_seen_at=?
+        where id=?"""
+        c.execute(statement, (key.cache_control, key.content_type,
+                              etag, key.last_modified, key.storage_class,
+                              key.size, crawl_started_at, pk))
+        c.execute("delete from s3_meta where key_id=?", (pk,))
+        status = 'Updated'
+    c.close()
+    save_metadata(conn, bucket, key, pk)
+    return pk, status
+
+def save_metadata(conn, bucket, key, pk):
+    """
+    Fetches the key's user metadata from S3 (this is a HEAD request,
+    since bucket listings don't include metadata) and saves it to s3_meta.
+    Also sets the key's bag_key from its institution and bag metadata,
+    and its content type, which listings don't include either. (boto
+    gives listed keys a default of application/octet-stream.)
+    """
     full_key = bucket.get_key(key.name)
     for k,v in full_key.metadata.iteritems():
         statement = """insert into s3_meta (key_id, name, value)
         values (?,?,?)"""
         conn.execute(statement, (pk, k, v))
-        conn.commit()
+    conn.execute("update s3_keys set bag_key=?, content_type=? where id=?",
+                 (bag_key(full_key.metadata.get('institution'),
+                          full_key.metadata.get('bag')),
+                  full_key.content_type, pk))
+    conn.commit()
+
+def mark_deleted_keys(conn, bucket_name, crawl_started_at):
+    """
+    Marks keys that were not seen in the crawl that started at
+    crawl_started_at as deleted. Returns the number of keys marked.
+    """
+    statement = """update s3_keys set deleted_at=?
+    where bucket=? and deleted_at is null
+    and (last_seen_at is null or last_seen_at < ?)"""
+    c = conn.cursor()
+    c.execute(statement, (datetime.utcnow(), bucket_name, crawl_started_at))
+    count = c.rowcount
+    conn.commit()
     c.close()
-    return pk, True
+    return count
 
 def existing_record_id(conn, key):
-    exists = "select id from s3_keys where name=? and etag=? and bucket=?"
+    """
+    Returns the id of the live record for this key and etag, or None.
+    A key that was deleted and has reappeared gets a new record.
+    """
+    exists = """select id from s3_keys where name=? and etag=? and bucket=?
+    and deleted_at is null"""
     c = conn.cursor()
     c.execute(exists, (key.name, key.etag.replace('"', ''), key.bucket.name))
     row = c.fetchone()
@@ -56,6 +177,20 @@ def existing_record_id(conn, key):
         return row[0]
     return None
 
+def current_record(conn, key):
+    """
+    Returns the id, etag and last_modified of the live (not deleted)
+    record for this key, or None.
+    """
+    query = """select id, etag, last_modified from s3_keys
+    where name=? and bucket=? and deleted_at is null
+    order by id desc limit 1"""
+    c = conn.cursor()
+    c.execute(query, (key.name, key.bucket.name))
+    row = c.fetchone()
+    c.close()
+    return row
+
 
 def create_db_if_necessary(conn):
     query = """SELECT name FROM sqlite_master WHERE type='table'
@@ -70,7 +205,9 @@ def create_db_if_necessary(conn):
         bucket text, name text, cache_control text,
         content_type text,
         etag text, last_modified datetime,
-        storage_class text, size int)"""
+        storage_class text, size int,
+        last_seen_at datetime, deleted_at datetime,
+        bag_key text)"""
         conn.execute(statement)
         conn.commit()
 
@@ -84,12 +221,93 @@ def create_db_if_necessary(conn):
         statement = "create table s3_meta(key_id, name, value)"
         conn.execute(statement)
         conn.commit()
+    else:
+        add_crawl_columns_if_necessary(conn)
+
+    query = """SELECT name FROM sqlite_master WHERE type='index'
+    AND name='ix_s3_meta_key_id'"""
+    c.execute(query)
+    row = c.fetchone()
+    if not row or len(row) < 1:
+        # Incremental crawls replace the metadata of changed keys.
+        print("Creating index ix_s3_meta_key_id on s3_meta")
+        statement = "create index ix_s3_meta_key_id on s3_meta(key_id)"
+        conn.execute(statement)
+        conn.commit()
+
+    query = """SELECT name FROM sqlite_master WHERE type='index'
+    AND name='ix_s3_bucket_name'"""
+    c.execute(query)
+    row = c.fetchone()
+    if not row or len(row) < 1:
+        # The audits look up keys by bucket and UUID.
+        print("Creating index ix_s3_bucket_name on s3_keys")
+        statement = "create index ix_s3_bucket_name on s3_keys(bucket, name)"
+        conn.execute(statement)
+        conn.commit()
+
+    query = """SELECT name FROM sqlite_master WHERE type='index'
+    AND name='ix_s3_bag_key'"""
+    c.execute(query)
+    row = c.fetchone()
+    if not row or len(row) < 1:
+        # The audits look up all of a bag's keys at once.
+        print("Creating index ix_s3_bag_key on s3_keys")
+        statement = "create index ix_s3_bag_key on s3_keys(bag_key)"
+        conn.execute(statement)
+        conn.commit()
+    c.close()
+
+def add_crawl_columns_if_necessary(conn):
+    """
+    Databases created before incremental crawls were supported don't
+    have the last_seen_at and deleted_at columns, and older databases
+    don't have bag_key. Add them, and fill in bag_key from s3_meta.
+    """
+    c = conn.cursor()
+    c.execute("PRAGMA table_info(s3_keys)")
+    columns = [row[1] for row in c.fetchall()]
+    for column in ['last_seen_at', 'deleted_at']:
+        if column not in columns:
+            print("Adding column {0} to s3_keys".format(column))
+            statement = "alter table s3_keys add column {0} datetime".format(
+                column)
+            conn.execute(statement)
+            conn.commit()
+    if 'bag_key' not in columns:
+        print("Adding column bag_key to s3_keys")
+        conn.execute("alter table s3_keys add column bag_key text")
+        query = """select i.key_id, i.value, b.value from s3_meta i
+        inner join s3_meta b on b.key_id = i.key_id
+        where i.name = 'institution' and b.name = 'bag'"""
+        c.execute(query)
+        values = [(bag_key(row[1], row[2]), row[0]) for row in c.fetchall()]
+        conn.executemany("update s3_keys set bag_key=? where id=?", values)
+        conn.commit()
     c.close()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load S3 keys into SQLite')
+    parser.add_argument('--incremental', action='store_true',
+                        help="Update changed keys and mark deleted keys "
+                        "instead of skipping keys that are already loaded")
+    parser.add_argument('--listing',
+                        help="Crawl the keys in a listing written by "
+                        "generate_test_data.py instead of the real buckets")
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics = metrics_from_args('s3_buckets_to_sql', args)
+    s3 = None
+    if args.listing:
+        import fake_s3
+        s3 = fake_s3.FakeS3Connection()
+        fake_s3.load_listing(s3, args.listing)
     if not os.path.exists('db'):
         os.mkdir('db')
     conn = sqlite3.connect('db/aptrust_s3.db')
-    list_bucket('aptrust.preservation.storage', conn)
-    list_bucket('aptrust.preservation.oregon', conn)
+    list_bucket('aptrust.preservation.storage', conn, args.incremental,
+                s3=s3, metrics=metrics)
+    list_bucket('aptrust.preservation.oregon', conn, args.incremental,
+                s3=s3, metrics=metrics)
     conn.close()
+    metrics.finish()
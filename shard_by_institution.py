@@ -0,0 +1,285 @@
+#! /usr/bin/env python
+# shard_by_institution.py
+"""
+Splits db/aptrust.db into one SQLite database per institution, in
+db/shards/<institution identifier>.db. Each shard has the same tables
+and indexes as aptrust.db, but only the rows that belong to its
+institution, with the same ids. An audit of one institution can then
+run against its shard alone, with small indexes, and the audits of
+several institutions can run in parallel. See audit_shards.py.
+
+A row's institution comes from:
+
+- the institution_id of institutions, users, work_items and objects.
+- the bag key, or else the object identifier, of ingest_records.
+  Both start with the institution identifier (see get_object_identifier
+  in logs_to_sql.py).
+- the bag key of s3_keys, which the crawler sets from the key's
+  metadata. Keys in a receiving bucket without a bag key belong to the
+  bucket's institution. Other keys without one belong to the institution
+  whose ingest_generic_files or files have a uuid by the key's name.
+- the parent row, for every other table: files belong to their object,
+  checksums to their file, ingest_tar_results to their ingest record,
+  s3_meta to its key, and so on.
+
+Rows with no institution are left out, and counted. Derived tables,
+like the audit_001 tables and file_reconciliation, are not copied.
+Build them in each shard. Shard aptrust.db before compact_text.py
+compacts it, then compact each shard if you like.
+
+Usage:
+
+python shard_by_institution.py
+python shard_by_institution.py --institution test.edu --institution example.edu
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+from compact_text import compacted_columns
+from identifiers import institution_from_identifier
+from logs_to_sql import get_object_identifier
+from metrics import add_metrics_arguments, metrics_from_args
+
+DB_PATH = 'db/aptrust.db'
+SHARD_DIR = 'db/shards'
+
+RECEIVING_BUCKET_PREFIX = 'aptrust.receiving.'
+
+# Every loaded table, parents first. Each entry is the table, the table
+# whose shard map it's copied by, the column that holds that table's id,
+# and the queries that return (id, institution_id) for the table's rows.
+# The first query to place a row wins. Queries may use the shard maps
+# of the tables before them, in temp.shard_<table>, and the functions
+# institution_of(identifier) and object_identifier(bucket, key).
+SHARD_RULES = [
+    ('institutions', 'institutions', 'id', [
+        "select id, id as institution_id from institutions"]),
+    ('users', 'users', 'id', [
+        "select id, institution_id from users"]),
+    ('work_items', 'work_items', 'id', [
+        "select id, institution_id from work_items"]),
+    ('objects', 'objects', 'id', [
+        "select id, institution_id from objects"]),
+    ('files', 'files', 'id', [
+        """select f.id, m.institution_id from files f
+        cross join shard_objects m where m.id = f.object_id"""]),
+    ('checksums', 'checksums', 'id', [
+        """select c.id, m.institution_id from checksums c
+        cross join shard_files m where m.id = c.file_id"""]),
+    ('events', 'events', 'id', [
+        """select e.id, m.institution_id from events e
+        cross join shard_objects m where m.id = e.object_id""",
+        """select e.id, m.institution_id from events e
+        cross join shard_files m where m.id = e.file_id"""]),
+    ('ingest_records', 'ingest_records', 'id', [
+        """select r.id, p.institution_id from ingest_records r
+        cross join shard_prefixes p
+        where p.prefix = institution_of(coalesce(r.bag_key, r.object_identifier))"""]),
+    ('ingest_s3_files', 'ingest_s3_files', 'id', [
+        """select t.id, m.institution_id from ingest_s3_files t
+        cross join shard_ingest_records m where m.id = t.ingest_record_id"""]),
+    ('ingest_fetch_results', 'ingest_fetch_results', 'id', [
+        """select t.id, m.institution_id from ingest_fetch_results t
+        cross join shard_ingest_records m where m.id = t.ingest_record_id"""]),
+    ('ingest_tar_results', 'ingest_tar_results', 'id', [
+        """select t.id, m.institution_id from ingest_tar_results t
+        cross join shard_ingest_records m where m.id = t.ingest_record_id"""]),
+    ('ingest_unpacked_files', 'ingest_unpacked_files', 'id', [
+        """select t.id, m.institution_id from ingest_unpacked_files t
+        cross join shard_ingest_tar_results m where m.id = t.ingest_tar_result_id"""]),
+    ('ingest_generic_files', 'ingest_generic_files', 'id', [
+        """select t.id, m.institution_id from ingest_generic_files t
+        cross join shard_ingest_tar_results m where m.id = t.ingest_tar_result_id"""]),
+    ('ingest_bag_read_results', 'ingest_bag_read_results', 'id', [
+        """select t.id, m.institution_id from ingest_bag_read_results t
+        cross join shard_ingest_records m where m.id = t.ingest_record_id"""]),
+    ('ingest_bag_read_files', 'ingest_bag_read_files', 'id', [
+        """select t.id, m.institution_id from ingest_bag_read_files t
+        cross join shard_ingest_bag_read_results m
+        where m.id = t.ingest_bag_read_result_id"""]),
+    ('ingest_checksum_errors', 'ingest_checksum_errors', 'id', [
+        """select t.id, m.institution_id from ingest_checksum_errors t
+        cross join shard_ingest_bag_read_results m
+        where m.id = t.ingest_bag_read_result_id"""]),
+    ('ingest_tags', 'ingest_tags', 'id', [
+        """select t.id, m.institution_id from ingest_tags t
+        cross join shard_ingest_bag_read_results m
+        where m.id = t.ingest_bag_read_result_id"""]),
+    ('ingest_fedora_results', 'ingest_fedora_results', 'id', [
+        """select t.id, m.institution_id from ingest_fedora_results t
+        cross join shard_ingest_records m where m.id = t.ingest_record_id"""]),
+    ('ingest_fedora_generic_files', 'ingest_fedora_generic_files', 'id', [
+        """select t.id, m.institution_id from ingest_fedora_generic_files t
+        cross join shard_ingest_fedora_results m
+        where m.id = t.ingest_fedora_result_id"""]),
+    ('ingest_fedora_metadata', 'ingest_fedora_metadata', 'id', [
+        """select t.id, m.institution_id from ingest_fedora_metadata t
+        cross join shard_ingest_fedora_results m
+        where m.id = t.ingest_fedora_result_id"""]),
+    ('s3_keys', 's3_keys', 'id', [
+        """select k.id, p.institution_id from s3_keys k
+        cross join shard_prefixes p
+        where k.bag_key is not null and p.prefix = institution_of(k.bag_key)""",
+        """select k.id, p.institution_id from s3_keys k
+        cross join shard_prefixes p
+        where k.bag_key is null and k.bucket like '{0}%'
+        and p.prefix = institution_of(object_identifier(k.bucket, k.name))""".format(
+            RECEIVING_BUCKET_PREFIX),
+        """select k.id, m.institution_id from shard_ingest_generic_files m
+        cross join ingest_generic_files g
+        cross join s3_keys k
+        where g.id = m.id and k.name in (g.uuid, g.storage_uuid)
+        and k.bag_key is null""",
+        """select k.id, m.institution_id from shard_files m
+        cross join files f
+        cross join s3_keys k
+        where f.id = m.id and k.name = f.uri_uuid and k.bag_key is null"""]),
+    ('event_counts', 'objects', 'object_id', []),
+    ('s3_meta', 's3_keys', 'key_id', []),
+]
+
+
+def shard_path(identifier, shard_dir=SHARD_DIR):
+    """
+    Returns the path of an institution's shard.
+    """
+    return os.path.join(shard_dir, identifier.lower() + '.db')
+
+def institutions(conn):
+    """
+    Returns (id, identifier) for each institution in aptrust.db.
+    """
+    query = "select id, lower(identifier) from institutions order by id"
+    return [(row[0], row[1]) for row in conn.execute(query)]
+
+def build_shard_maps(conn, metrics):
+    """
+    Fills a temp table shard_<table>(id, institution_id) for each table
+    in SHARD_RULES, so each shard can be copied out with an index
+    lookup per row. The temp tables live in conn's temp database, so
+    aptrust.db isn't changed.
+    """
+    conn.create_function('institution_of', 1, institution_from_identifier)
+    conn.create_function('object_identifier', 2, get_object_identifier)
+    conn.execute("drop table if exists temp.shard_prefixes")
+    conn.execute("""create temp table shard_prefixes(
+    prefix varchar(80) primary key,
+    institution_id int)""")
+    conn.execute("""insert or ignore into temp.shard_prefixes
+    select lower(identifier), id from institutions""")
+    for table, map_table, _, queries in SHARD_RULES:
+        if map_table != table:
+            continue
+        start = time.time()
+        conn.execute("drop table if exists temp.shard_{0}".format(table))
+        conn.execute("""create temp table shard_{0}(
+        id integer primary key,
+        institution_id int)""".format(table))
+        for query in queries:
+            conn.execute("""insert or ignore into temp.shard_{0}
+            select * from ({1}) where institution_id is not null""".format(
+                table, query))
+        conn.execute("""create index temp.ix_shard_{0}_institution_id
+        on shard_{0}(institution_id)""".format(table))
+        placed = conn.execute(
+            "select count(*) from temp.shard_{0}".format(table)).fetchone()[0]
+        total = conn.execute(
+            "select count(*) from {0}".format(table)).fetchone()[0]
+        metrics.add_time('map', time.time() - start)
+        if placed < total:
+            print("{0} of {1} rows in {2} don't belong to any institution. "
+                  "They won't be in any shard.".format(total - placed, total,
+                                                      table))
+
+def schema(conn):
+    """
+    Returns the create table and create index statements for the
+    tables in SHARD_RULES, as they are in aptrust.db.
+    """
+    names = [rule[0] for rule in SHARD_RULES]
+    tables = dict(conn.execute("""select name, sql from sqlite_master
+    where type='table'"""))
+    indexes = [row[0] for row in conn.execute("""select sql from sqlite_master
+    where type='index' and sql is not null and tbl_name in ({0})
+    order by tbl_name, name""".format(",".join("?" * len(names))), names)]
+    return [tables[name] for name in names], indexes
+
+def build_shard(conn, institution_id, path, metrics):
+    """
+    Writes one institution's rows to a new database at path. The shard
+    is built under a temporary name and renamed when it's complete, so
+    an audit never opens a half-built shard.
+    """
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    create_tables, create_indexes = schema(conn)
+    shard_conn = sqlite3.connect(tmp_path)
+    for sql in create_tables:
+        shard_conn.execute(sql)
+    shard_conn.commit()
+    shard_conn.close()
+    conn.execute("attach database ? as shard", (tmp_path,))
+    try:
+        for table, map_table, column, _ in SHARD_RULES:
+            with metrics.stage('copy'):
+                c = conn.execute("""insert into shard.{0}
+                select t.* from temp.shard_{1} m
+                cross join main.{0} t
+                where m.institution_id = ? and t.{2} = m.id""".format(
+                    table, map_table, column), (institution_id,))
+            metrics.progress(items=c.rowcount)
+        conn.commit()
+    finally:
+        conn.execute("detach database shard")
+    # Like merge_dbs.sql, create the indexes after the inserts.
+    shard_conn = sqlite3.connect(tmp_path)
+    with metrics.stage('index'):
+        for sql in create_indexes:
+            shard_conn.execute(sql)
+        shard_conn.commit()
+    shard_conn.close()
+    os.rename(tmp_path, path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Split db/aptrust.db into one database per institution')
+    parser.add_argument('--institution', action='append',
+                        help="Identifier of an institution to build a shard "
+                        "for, e.g. test.edu. Repeat for more than one. "
+                        "Defaults to all institutions.")
+    parser.add_argument('--shard-dir', default=SHARD_DIR,
+                        help="Directory to write the shards to")
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics = metrics_from_args('shard_by_institution', args)
+
+    conn = sqlite3.connect(DB_PATH)
+    if compacted_columns(conn):
+        print("{0} has tables compacted by compact_text.py. Run "
+              "compact_text.py --expand first, and compact the shards "
+              "instead.".format(DB_PATH))
+        sys.exit(1)
+    selected = institutions(conn)
+    if args.institution:
+        wanted = set(identifier.lower() for identifier in args.institution)
+        unknown = wanted - set(identifier for _, identifier in selected)
+        if unknown:
+            print("No such institution: {0}".format(", ".join(sorted(unknown))))
+            sys.exit(1)
+        selected = [i for i in selected if i[1] in wanted]
+    if not os.path.exists(args.shard_dir):
+        os.makedirs(args.shard_dir)
+    print("Mapping rows to institutions")
+    build_shard_maps(conn, metrics)
+    for institution_id, identifier in selected:
+        start = time.time()
+        path = shard_path(identifier, args.shard_dir)
+        build_shard(conn, institution_id, path, metrics)
+        print("Wrote {0} in {1:.2f}s".format(path, time.time() - start))
+    conn.close()
+    metrics.finish()
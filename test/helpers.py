@@ -0,0 +1,70 @@
+# helpers.py
+"""
+Shared setup for the tests. Importing this puts the repo directory on
+sys.path, so the tests can import the scripts as modules.
+
+The fixtures are small synthetic databases built the way
+check_query_plans.py builds its own: the loaders' schema code, then
+merge_dbs.sql, then (optionally) build_audit_001_tables.sql.
+"""
+import os
+import shutil
+import subprocess
+import sys
+import sqlite3
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+
+def quietly(function, *args, **kwargs):
+    """
+    Calls function with stdout sent to /dev/null, for the scripts'
+    "Creating table ..." messages.
+    """
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return function(*args, **kwargs)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def build_fixture(bags=40, files_per_bag=10, audit_tables=True):
+    """
+    Builds work_dir/db/aptrust.db in a new temp directory and returns
+    work_dir. The caller removes it with remove_fixture.
+    """
+    # The loaders are Python 2 only, so tests that run under Python 3
+    # (the DuckDB ones) can import this module without them.
+    import check_query_plans
+    work_dir = tempfile.mkdtemp()
+    quietly(check_query_plans.build_fixture, work_dir, bags, files_per_bag, 1)
+    if audit_tables:
+        conn = sqlite3.connect(os.path.join(work_dir, 'db', 'aptrust.db'))
+        run_sql_script(conn, 'build_audit_001_tables.sql')
+        conn.close()
+    return work_dir
+
+def remove_fixture(work_dir):
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+def run_sql_script(conn, name):
+    """
+    Runs one of the repo's .sql scripts on conn.
+    """
+    with open(os.path.join(REPO_DIR, name)) as f:
+        conn.executescript(f.read())
+
+def run_script(work_dir, name, *args):
+    """
+    Runs one of the repo's Python scripts in work_dir with this
+    interpreter. Returns (exit status, stdout, stderr).
+    """
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(REPO_DIR, name)] + list(args),
+        cwd=work_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    return process.returncode, out, err
@@ -0,0 +1,74 @@
+import json
+import os
+import sqlite3
+import unittest
+
+import helpers
+
+
+class AuditOutputTest(unittest.TestCase):
+    """
+    Runs audit_001.py against a small fixture with each output mode.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.work_dir = helpers.build_fixture(bags=40, files_per_bag=10)
+        conn = sqlite3.connect(os.path.join(cls.work_dir, 'db', 'aptrust.db'))
+        cls.bag_names = sorted(row[0] for row in conn.execute(
+            "select key from audit_001_objects"))
+        conn.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        helpers.remove_fixture(cls.work_dir)
+
+    def run_audit(self, *args):
+        status, out, err = helpers.run_script(self.work_dir, 'audit_001.py',
+                                              '--progress-interval', '0',
+                                              *args)
+        self.assertEqual(status, 0, err)
+        return out.decode('utf-8')
+
+    def test_json_for_one_bag(self):
+        out = self.run_audit('--output', 'json', self.bag_names[0])
+        summary = json.loads(out)
+        self.assertEqual(summary['bag_name'], self.bag_names[0])
+        self.assertEqual(len(summary['files']), 10)
+
+    def test_json_for_all_bags(self):
+        out = self.run_audit('--output', 'json')
+        decoder = json.JSONDecoder()
+        names = []
+        position = 0
+        while out[position:].strip():
+            while out[position].isspace():
+                position += 1
+            summary, position = decoder.raw_decode(out, position)
+            names.append(summary['bag_name'])
+        self.assertEqual(sorted(names), self.bag_names)
+
+    def test_sql(self):
+        self.run_audit('--output', 'sql')
+        conn = sqlite3.connect(os.path.join(self.work_dir, 'db',
+                                            'audit001_summary.db'))
+        bags = conn.execute("select count(*) from bags").fetchone()[0]
+        conn.close()
+        self.assertEqual(bags, len(self.bag_names))
+
+    def test_engines_give_bags_the_same_ids(self):
+        bags = []
+        for engine in ['python', 'sql']:
+            self.run_audit('--output', 'sql', '--engine', engine)
+            conn = sqlite3.connect(os.path.join(self.work_dir, 'db',
+                                                'audit001_summary.db'))
+            bags.append(conn.execute(
+                "select id, name, identifier from bags order by id").fetchall())
+            conn.close()
+        self.assertEqual(bags[0], bags[1])
+
+    def test_cross_check(self):
+        self.run_audit('--cross-check')
+
+
+if __name__ == '__main__':
+    unittest.main()
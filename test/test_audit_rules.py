@@ -0,0 +1,149 @@
+import os
+import sqlite3
+import unittest
+
+import helpers
+import audit_rules
+import reconcile_files
+from metrics import Metrics
+
+MD5 = 'a' * 32
+SHA256 = 'b' * 64
+
+
+def reconciliation_row(**values):
+    """
+    Returns a file_reconciliation row, as a dict, for a file that every
+    system agrees on, with values changed.
+    """
+    row = {'generic_file_id': 1, 'identifier': 'test.edu/bag/data/a.txt',
+           'uuid': 'uuid-1', 'storage_uuid': 'uuid-1',
+           'storage_url': 'https://s3.amazonaws.com/bucket/uuid-1',
+           'fedora_uuid': 'uuid-1',
+           'fedora_uri': 'https://s3.amazonaws.com/bucket/uuid-1',
+           'in_fedora': 1, 'in_s3': 1, 'in_glacier': 1,
+           'size': 10, 'fedora_size': 10, 's3_size': 10, 'glacier_size': 10,
+           'md5': MD5, 'fedora_md5': MD5, 'sha256': SHA256,
+           'fedora_sha256': SHA256}
+    row.update(values)
+    return row
+
+
+class RulesTest(unittest.TestCase):
+
+    def problems(self, **values):
+        row = reconciliation_row(**values)
+        return [name for name, function in audit_rules.RULES if function(row)]
+
+    def test_file_that_passes(self):
+        self.assertEqual(self.problems(), [])
+
+    def test_missing(self):
+        self.assertEqual(self.problems(in_fedora=0), ['not_in_fedora'])
+        self.assertEqual(self.problems(in_s3=0), ['not_in_s3'])
+        self.assertEqual(self.problems(in_glacier=0), ['not_in_glacier'])
+
+    def test_uuid_mismatches(self):
+        self.assertEqual(self.problems(storage_uuid='uuid-2'),
+                         ['storage_url_mismatch'])
+        self.assertEqual(self.problems(fedora_uuid='uuid-2'),
+                         ['fedora_uri_mismatch'])
+        # No storage URL or Fedora record is not a mismatch.
+        self.assertEqual(self.problems(storage_uuid=None, fedora_uuid=None),
+                         [])
+
+    def test_checksum_mismatches(self):
+        self.assertEqual(self.problems(fedora_md5='c' * 32), ['md5_mismatch'])
+        self.assertEqual(self.problems(fedora_sha256='c' * 64),
+                         ['sha256_mismatch'])
+        self.assertEqual(self.problems(fedora_md5=None, fedora_sha256=None),
+                         [])
+
+    def test_size_mismatch(self):
+        row = reconciliation_row(s3_size=11, glacier_size=None)
+        self.assertEqual(audit_rules.size_mismatch(row),
+                         "Ingest size 10 does not match s3 size 11")
+        row = reconciliation_row(fedora_size=9, glacier_size=12)
+        self.assertEqual(audit_rules.size_mismatch(row),
+                         "Ingest size 10 does not match fedora size 9, "
+                         "glacier size 12")
+
+    def test_select_rules(self):
+        self.assertEqual(len(audit_rules.select_rules(None)), 8)
+        selected = audit_rules.select_rules('not_in_s3,md5_mismatch')
+        self.assertEqual([name for name, function in selected],
+                         ['not_in_s3', 'md5_mismatch'])
+        self.assertRaises(RuntimeError, audit_rules.select_rules, 'nope')
+
+
+class RunRulesTest(unittest.TestCase):
+    """
+    Runs every rule over file_reconciliation on the fixture, whose
+    failed bags have files missing from Fedora and from Glacier.
+    """
+
+    def setUp(self):
+        self.work_dir = helpers.build_fixture(bags=40, files_per_bag=10,
+                                              audit_tables=False)
+        self.conn = sqlite3.connect(os.path.join(self.work_dir, 'db',
+                                                 'aptrust.db'))
+        self.conn.row_factory = sqlite3.Row
+        helpers.quietly(reconcile_files.refresh, self.conn)
+
+    def tearDown(self):
+        self.conn.close()
+        helpers.remove_fixture(self.work_dir)
+
+    def count(self, query, params=()):
+        return self.conn.execute(query, params).fetchone()[0]
+
+    def test_run_rules(self):
+        metrics = Metrics('audit_rules', stream=open(os.devnull, 'w'))
+        run_id = helpers.quietly(audit_rules.run_rules, self.conn,
+                                 audit_rules.RULES, metrics)
+        files = self.count("select count(*) from file_reconciliation")
+        self.assertEqual(metrics.items, files)
+
+        run = self.conn.execute("select * from audit_runs where id = ?",
+                                (run_id,)).fetchone()
+        self.assertEqual(run['rules'].split(','),
+                         [name for name, function in audit_rules.RULES])
+        self.assertEqual(run['rows_scanned'], files)
+        self.assertTrue(run['finished_at'] >= run['started_at'])
+        self.assertEqual(run['finding_count'], self.count(
+            "select count(*) from findings where run_id = ?", (run_id,)))
+
+        found = dict((row[0], row[1]) for row in self.conn.execute(
+            """select rule, count(*) from findings where run_id = ?
+            group by rule""", (run_id,)))
+        expected = {
+            'not_in_fedora': self.count("""select count(*)
+            from file_reconciliation where not in_fedora"""),
+            'not_in_glacier': self.count("""select count(*)
+            from file_reconciliation where not in_glacier"""),
+        }
+        self.assertTrue(expected['not_in_fedora'] > 0)
+        self.assertTrue(expected['not_in_glacier'] > 0)
+        self.assertEqual(found, expected)
+
+        # Each finding names the file it's about.
+        missing = self.conn.execute("""select f.generic_file_id,
+        f.identifier from findings f where f.run_id = ?
+        and f.rule = 'not_in_fedora' and not exists (
+          select 1 from file_reconciliation r
+          where r.generic_file_id = f.generic_file_id
+          and r.identifier = f.identifier and not r.in_fedora)""",
+                                    (run_id,)).fetchall()
+        self.assertEqual(missing, [])
+
+    def test_selected_rules(self):
+        rules = audit_rules.select_rules('not_in_s3,not_in_glacier')
+        run_id = helpers.quietly(audit_rules.run_rules, self.conn, rules)
+        self.assertEqual(self.count("""select count(distinct rule)
+        from findings where run_id = ?""", (run_id,)), 1)
+        self.assertEqual(self.count("""select rules from audit_runs
+        where id = ?""", (run_id,)), 'not_in_s3,not_in_glacier')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import sqlite3
+import time
+import unittest
+
+import helpers
+
+
+class BuildAuditTablesTest(unittest.TestCase):
+    """
+    Runs build_audit_001_tables.sql on a fixture big enough that a
+    lookup that reads every S3 key per file takes seconds, not
+    milliseconds. Every fourth bag failed, and in each failed bag,
+    every fifth file (j % 5 == 2) has no Glacier copy.
+    """
+    BAGS = 400
+    FILES_PER_BAG = 20
+
+    @classmethod
+    def setUpClass(cls):
+        cls.work_dir = helpers.build_fixture(bags=cls.BAGS,
+                                             files_per_bag=cls.FILES_PER_BAG,
+                                             audit_tables=False)
+        cls.conn = sqlite3.connect(os.path.join(cls.work_dir, 'db',
+                                                'aptrust.db'))
+        start = time.time()
+        helpers.run_sql_script(cls.conn, 'build_audit_001_tables.sql')
+        cls.seconds = time.time() - start
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.conn.close()
+        helpers.remove_fixture(cls.work_dir)
+
+    def count(self, query):
+        return self.conn.execute(query).fetchone()[0]
+
+    def test_tables(self):
+        failed_bags = self.BAGS // 4
+        self.assertEqual(self.count("select count(*) from audit_001_objects"),
+                         failed_bags)
+        self.assertEqual(self.count("select count(*) from audit_001_files"),
+                         failed_bags * self.FILES_PER_BAG)
+        self.assertEqual(self.count("""select count(*) from audit_001_files
+        where s3_key is null"""), 0)
+        self.assertEqual(self.count("""select count(*) from audit_001_files
+        where glacier_key is null"""), failed_bags * self.FILES_PER_BAG // 5)
+
+    def test_build_is_fast(self):
+        # About 0.2s here. Looking keys up by deleted_at took 35s.
+        self.assertLess(self.seconds, 10)
+
+    def test_file_keys_are_looked_up_by_bucket_and_name(self):
+        with open(os.path.join(helpers.REPO_DIR,
+                               'build_audit_001_tables.sql')) as f:
+            script = f.read()
+        # The script drops audit_001_file_keys when it's done, so
+        # explain the select that fills it.
+        start = script.index('insert into audit_001_file_keys')
+        start = script.index('select', start)
+        select = script[start:script.index(';', start)]
+        plan = [row[3] for row in self.conn.execute(
+            "explain query plan " + select)]
+        self.assertIn('SEARCH k USING INDEX ix_s3_bucket_name '
+                      '(bucket=? AND name=?)', plan)
+
+
+if __name__ == '__main__':
+    unittest.main()
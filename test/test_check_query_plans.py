@@ -0,0 +1,69 @@
+import os
+import sqlite3
+import unittest
+
+import helpers
+import check_query_plans
+from check_query_plans import find_violations, low_selectivity_search
+
+
+class FindViolationsTest(unittest.TestCase):
+
+    def test_scan_of_large_table(self):
+        self.assertEqual(len(find_violations(
+            "select * from files f", ['SCAN f'], ())), 1)
+        self.assertEqual(find_violations(
+            "select * from files f", ['SCAN f'], ['files']), [])
+        self.assertEqual(find_violations(
+            "select * from institutions i", ['SCAN i'], ()), [])
+
+    def test_automatic_index(self):
+        plan = ['SCAN o', 'SEARCH w USING AUTOMATIC COVERING INDEX (bag_key=?)']
+        self.assertEqual(len(find_violations(
+            "select * from audit_001_objects o join work_items w", plan,
+            ['audit_001_objects'])), 1)
+
+    def test_low_selectivity_search(self):
+        sql = "select * from x n cross join s3_keys k"
+        plan = ['SCAN n',
+                'SEARCH k USING INDEX ix_s3_deleted_at (deleted_at=?)']
+        problems = find_violations(sql, plan, ())
+        self.assertEqual(len(problems), 1)
+        self.assertTrue(problems[0].startswith('Low-selectivity index'))
+        plan[1] = 'SEARCH k USING INDEX ix_s3_bucket_name (bucket=? AND name=?)'
+        self.assertEqual(find_violations(sql, plan, ()), [])
+
+    def test_low_selectivity_constraints(self):
+        self.assertTrue(low_selectivity_search('deleted_at=?'))
+        self.assertTrue(low_selectivity_search('last_modified=?'))
+        self.assertTrue(low_selectivity_search('state=? AND deleted_at=?'))
+        # Ranges after a watermark are what those indexes are for.
+        self.assertFalse(low_selectivity_search('deleted_at>?'))
+        self.assertFalse(low_selectivity_search('last_modified>?'))
+        self.assertFalse(low_selectivity_search('bucket=? AND name=?'))
+        self.assertFalse(low_selectivity_search('last_modified=? AND bucket=?'))
+
+
+class FixturePlansTest(unittest.TestCase):
+    """
+    Runs every check the script runs, on a small fixture, and expects
+    no problems.
+    """
+    def test_no_violations(self):
+        work_dir = helpers.build_fixture(bags=80, files_per_bag=10,
+                                         audit_tables=False)
+        try:
+            conn = sqlite3.connect(os.path.join(work_dir, 'db', 'aptrust.db'))
+            checker = check_query_plans.PlanChecker(conn)
+            check_query_plans.check_audit_001(checker, helpers.REPO_DIR)
+            helpers.quietly(check_query_plans.check_reconciliation, checker)
+            check_query_plans.check_compare_checksums(checker)
+            conn.close()
+            self.assertEqual(checker.violations(), [])
+            self.assertNotIn('ix_s3_deleted_at', str(checker.results))
+        finally:
+            helpers.remove_fixture(work_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
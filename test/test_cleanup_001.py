@@ -0,0 +1,273 @@
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import helpers
+import audit_001
+import benchmark_cleanup
+import cleanup_001
+from metrics import Metrics
+
+
+def drain_queue(path, worker_id, results):
+    """
+    Claims rows from the queue in path, three at a time, until there
+    are none left, and puts their ids on results. Runs in its own
+    process.
+    """
+    conn = sqlite3.connect(path, timeout=60)
+    queue = cleanup_001.WorkQueue(conn, worker_id)
+    ids = []
+    while True:
+        batch = queue.claim('add', 3)
+        if not batch:
+            break
+        ids.extend(pk for pk, key in batch)
+    conn.close()
+    results.put(ids)
+
+
+class WorkQueueTest(unittest.TestCase):
+    """
+    Two queues, each with its own connection to one summary db, the way
+    two cleanup_001 processes share the work.
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='test_cleanup_001_')
+        self.path = os.path.join(self.work_dir, 'audit001_summary.db')
+        conn = self.connect()
+        helpers.quietly(audit_001.create_db, conn)
+        helpers.quietly(cleanup_001.add_queue_columns_if_necessary, conn)
+        conn.executemany("""insert into aws_files(bag_id, action, storage,
+        file_path, identifier, key) values (1, 'add', 'glacier', ?, ?, ?)""",
+                         [("data/file_{0}".format(i),
+                           "test.edu/bag/data/file_{0}".format(i),
+                           "key-{0}".format(i)) for i in range(20)])
+        conn.commit()
+        conn.close()
+        self.conns = []
+
+    def tearDown(self):
+        for conn in self.conns:
+            conn.close()
+        shutil.rmtree(self.work_dir)
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def queue(self, worker_id, **kwargs):
+        conn = self.connect()
+        self.conns.append(conn)
+        return cleanup_001.WorkQueue(conn, worker_id, **kwargs)
+
+    def owners(self):
+        conn = self.connect()
+        rows = conn.execute("""select lease_owner, count(*) from aws_files
+        group by lease_owner""").fetchall()
+        conn.close()
+        return dict(rows)
+
+    def test_no_double_claim(self):
+        first = self.queue('first')
+        second = self.queue('second')
+        a = first.claim('add', 12)
+        b = second.claim('add', 12)
+        self.assertEqual(len(a), 12)
+        self.assertEqual(len(b), 8)
+        self.assertEqual(set(a) & set(b), set())
+        self.assertEqual(first.claim('add', 12), [])
+        self.assertEqual(self.owners(), {'first': 12, 'second': 8})
+
+    def test_no_double_claim_at_once(self):
+        claimed = {}
+        def drain(worker_id):
+            # SQLite connections belong to the thread that opened them.
+            conn = self.connect()
+            queue = cleanup_001.WorkQueue(conn, worker_id)
+            rows = []
+            while True:
+                batch = queue.claim('add', 3)
+                if not batch:
+                    break
+                rows.extend(batch)
+            conn.close()
+            claimed[worker_id] = rows
+        threads = [threading.Thread(target=drain,
+                                    args=("worker-{0}".format(i),))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        rows = [row for batch in claimed.values() for row in batch]
+        self.assertEqual(len(claimed), 4)
+        self.assertEqual(len(rows), 20)
+        self.assertEqual(len(set(rows)), 20)
+
+    def test_no_double_claim_across_processes(self):
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(
+            target=drain_queue, args=(self.path, "process-{0}".format(i),
+                                      results)) for i in range(4)]
+        for process in processes:
+            process.start()
+        ids = []
+        for process in processes:
+            ids.extend(results.get(timeout=60))
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+        self.assertEqual(sorted(ids), list(range(1, 21)))
+
+    def test_lapsed_lease_is_reclaimed(self):
+        first = self.queue('first', lease_seconds=1)
+        second = self.queue('second', lease_seconds=1)
+        rows = first.claim('add', 20)
+        self.assertEqual(second.claim('add', 20), [])
+        time.sleep(1.1)
+        self.assertEqual(second.claim('add', 20), rows)
+        self.assertEqual(self.owners(), {'second': 20})
+
+    def test_renew_extends_the_lease(self):
+        first = self.queue('first', lease_seconds=1)
+        second = self.queue('second', lease_seconds=1)
+        first.claim('add', 20)
+        time.sleep(0.6)
+        first.renew()
+        time.sleep(0.6)
+        # The first lease would have lapsed by now without the renewal.
+        self.assertEqual(second.claim('add', 20), [])
+        time.sleep(0.6)
+        self.assertEqual(len(second.claim('add', 20)), 20)
+
+    def test_max_attempts(self):
+        first = self.queue('first', lease_seconds=0, max_attempts=2)
+        second = self.queue('second', lease_seconds=0, max_attempts=2)
+        self.assertEqual(len(first.claim('add', 20)), 20)
+        self.assertEqual(len(second.claim('add', 20)), 20)
+        self.assertEqual(first.claim('add', 20), [])
+        self.assertEqual(first.pending_count('add'), 0)
+        self.assertEqual(first.abandoned_count('add'), 20)
+
+    def test_retire(self):
+        first = self.queue('first', lease_seconds=1)
+        second = self.queue('second')
+        rows = first.claim('add', 4)
+        first.retire([('2017-01-01 00:00:00', rows[0][0])],
+                     [(IOError('timed out'), rows[1][0])])
+        # The failed row waits out a lease before anyone claims it
+        # again. Rows 3 and 4 are still held.
+        self.assertEqual(len(second.claim('add', 20)), 16)
+        time.sleep(1.1)
+        reclaimed = second.claim('add', 20)
+        self.assertEqual(reclaimed, rows[1:])
+        self.assertEqual(first.pending_count('add'), 19)
+        error = first.conn.execute("""select last_error from aws_files
+        where id = ?""", (rows[1][0],)).fetchone()[0]
+        self.assertEqual(error, 'timed out')
+
+
+class CleanupTest(unittest.TestCase):
+    """
+    Runs the copies and deletes for 2400 keys against the fake S3, with
+    three quarters of the keys in the crawl db.
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='test_cleanup_001_')
+        self.s3 = benchmark_cleanup.build_fixture(self.work_dir, 2400, 0, 0,
+                                                  0.75)
+        self.conn = benchmark_cleanup.connect(self.work_dir)
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.work_dir)
+
+    def test_crawled_key_info(self):
+        va_keys = self.s3.buckets[cleanup_001.VA_BUCKET_NAME].keys
+        info = cleanup_001.crawled_key_info(self.conn, sorted(va_keys))
+        self.assertEqual(len(info), 2400 * 3 // 4)
+        for key, (content_type, metadata) in info.items():
+            self.assertEqual(content_type, va_keys[key].content_type)
+            self.assertEqual(metadata, va_keys[key].metadata)
+
+    def test_crawled_key_info_without_crawl(self):
+        conn = sqlite3.connect(':memory:')
+        self.assertEqual(cleanup_001.crawled_key_info(conn, ['a', 'b']), {})
+        conn.close()
+
+    def test_copy_and_delete(self):
+        va_bucket = self.s3.get_bucket(cleanup_001.VA_BUCKET_NAME,
+                                       validate=False)
+        or_bucket = self.s3.get_bucket(cleanup_001.OR_BUCKET_NAME,
+                                       validate=False)
+        metrics = Metrics('cleanup_001', stream=open(os.devnull, 'w'))
+        queue = cleanup_001.WorkQueue(self.conn, 'test')
+        pool = cleanup_001.ActionPool(8, metrics=metrics)
+        stderr = sys.stderr
+        sys.stderr = open(os.devnull, 'w')
+        try:
+            failed = cleanup_001.copy_missing_files_to_glacier(
+                queue, va_bucket, or_bucket, pool)
+            failed += cleanup_001.delete_duplicate_files(queue, va_bucket,
+                                                         pool)
+        finally:
+            sys.stderr.close()
+            sys.stderr = stderr
+        self.assertEqual(failed, 0)
+        self.assertEqual(benchmark_cleanup.verify(self.s3, self.conn, 0), [])
+        # Only the copies of keys missing from the crawl ask S3.
+        not_crawled = self.conn.execute("""select count(*) from aws_files a
+        where a.action = 'add' and not exists (select 1 from aptrust.s3_keys k
+          where k.name = a.key)""").fetchone()[0]
+        self.assertEqual(not_crawled, 300)
+        self.assertEqual(metrics.counters['head fallback'], not_crawled)
+
+
+class CopyRetryTest(unittest.TestCase):
+    """
+    Copies 400 keys that are all in the crawl db, while a quarter of
+    S3 requests fail and are retried.
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='test_cleanup_001_')
+        self.s3 = benchmark_cleanup.build_fixture(self.work_dir, 800, 0, 0.25,
+                                                  1.0)
+        self.conn = benchmark_cleanup.connect(self.work_dir)
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.work_dir)
+
+    def test_retries_keep_crawled_key_info(self):
+        va_bucket = self.s3.get_bucket(cleanup_001.VA_BUCKET_NAME,
+                                       validate=False)
+        or_bucket = self.s3.get_bucket(cleanup_001.OR_BUCKET_NAME,
+                                       validate=False)
+        metrics = Metrics('cleanup_001', stream=open(os.devnull, 'w'))
+        queue = cleanup_001.WorkQueue(self.conn, 'test')
+        pool = cleanup_001.ActionPool(8, retries=10, metrics=metrics,
+                                      retry_base_delay=0.001)
+        stderr = sys.stderr
+        sys.stderr = open(os.devnull, 'w')
+        try:
+            failed = cleanup_001.copy_missing_files_to_glacier(
+                queue, va_bucket, or_bucket, pool)
+        finally:
+            sys.stderr.close()
+            sys.stderr = stderr
+        self.assertEqual(failed, 0)
+        self.assertTrue(metrics.counters['retries'] > 0)
+        self.assertEqual(metrics.counters.get('head fallback', 0), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+import unittest
+
+import helpers
+import compact_text
+
+
+class SqlarTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for data in [b'', b'x', b'Fluctus error ' * 100, os.urandom(200)]:
+            body = compact_text.sqlar_compress(data)
+            self.assertEqual(
+                bytes(compact_text.sqlar_uncompress(body, len(data))), data)
+
+    def test_only_smaller_is_compressed(self):
+        data = b'Fluctus error ' * 100
+        self.assertTrue(len(compact_text.sqlar_compress(data)) < len(data))
+        data = os.urandom(200)
+        self.assertEqual(compact_text.sqlar_compress(data), data)
+
+    def test_text_hash(self):
+        self.assertEqual(compact_text.text_hash(None), None)
+        self.assertEqual(compact_text.text_hash(u'abc'),
+                         'a9993e364706816aba3e25717850c26c9cd0d89d')
+        self.assertEqual(len(compact_text.text_hash(u'café')), 40)
+
+
+class CompactTest(unittest.TestCase):
+    """
+    Compacts and expands the test fixture, with repetitive event text
+    added, and checks that every table reads back the same.
+    """
+
+    def setUp(self):
+        self.work_dir = helpers.build_fixture(bags=40, files_per_bag=10,
+                                              audit_tables=False)
+        self.db_path = os.path.join(self.work_dir, 'db', 'aptrust.db')
+        conn = sqlite3.connect(self.db_path)
+        texts = [None, u'Fluctus returned 502 Bad Gateway. ' * 20,
+                 u'Checksum verified', u'Fichier déjà ingéré']
+        rows = conn.execute("select id from events").fetchall()
+        conn.executemany("""update events set detail=?,
+        outcome_information=? where id=?""",
+                         [(texts[pk % 4], texts[pk % 3], pk) for pk, in rows])
+        conn.commit()
+        self.original = self.contents(conn)
+        conn.close()
+
+    def tearDown(self):
+        helpers.remove_fixture(self.work_dir)
+
+    def contents(self, conn):
+        tables = {}
+        for table, columns in compact_text.COMPACT_COLUMNS:
+            original = ['id'] + columns
+            tables[table] = conn.execute("select {0} from {1} order by id".format(
+                ", ".join(original), table)).fetchall()
+        return tables
+
+    def run_compact(self, *args):
+        status, out, err = helpers.run_script(
+            self.work_dir, 'compact_text.py', '--db', self.db_path, *args)
+        self.assertEqual(status, 0, err)
+
+    def test_compress_and_expand(self):
+        self.run_compact('--compress')
+        conn = sqlite3.connect(self.db_path)
+        compact_text.register_functions(conn)
+        self.assertEqual(sorted(compact_text.compacted_columns(conn)),
+                         sorted(t for t, c in compact_text.COMPACT_COLUMNS))
+        # Each distinct value is stored once: three event texts and the
+        # fixture's one ingest error.
+        self.assertEqual(conn.execute(
+            "select count(*) from text_store").fetchone()[0], 4)
+        self.assertEqual(conn.execute("""select count(*) from text_store
+        where length(body) < size""").fetchone()[0], 1)
+        self.assertEqual(self.contents(conn), self.original)
+        conn.close()
+
+        self.run_compact('--expand')
+        conn = sqlite3.connect(self.db_path)
+        self.assertEqual(compact_text.compacted_columns(conn), {})
+        self.assertEqual(conn.execute("""select count(*) from sqlite_master
+        where type = 'view'""").fetchone()[0], 0)
+        self.assertEqual(self.contents(conn), self.original)
+        conn.close()
+
+    def test_unused_texts_are_deleted(self):
+        self.run_compact()
+        conn = sqlite3.connect(self.db_path)
+        # Only these events use the long Fluctus text. The other
+        # compacted rows still include null texts.
+        conn.execute("""delete from events_compact
+        where id % 4 = 1 or id % 3 = 1""")
+        conn.commit()
+        conn.close()
+        self.run_compact()
+        conn = sqlite3.connect(self.db_path)
+        self.assertEqual(conn.execute(
+            "select count(*) from text_store").fetchone()[0], 3)
+        self.assertEqual(conn.execute("""select count(*) from text_store
+        where body like 'Fluctus returned%'""").fetchone()[0], 0)
+        conn.close()
+
+    def test_uncompressed_views_need_no_functions(self):
+        self.run_compact()
+        conn = sqlite3.connect(self.db_path)
+        self.assertEqual(self.contents(conn), self.original)
+        conn.close()
+
+    def test_audit_of_compacted_db(self):
+        summary_path = os.path.join(self.work_dir, 'db', 'audit001_summary.db')
+        query = """select b.name, a.action, a.storage, a.key
+        from aws_files a inner join bags b on b.id = a.bag_id
+        order by 1, 2, 3, 4"""
+        actions = []
+        for compact in [False, True]:
+            if compact:
+                self.run_compact('--compress')
+                os.remove(summary_path)
+            conn = sqlite3.connect(self.db_path)
+            compact_text.register_functions(conn)
+            helpers.run_sql_script(conn, 'build_audit_001_tables.sql')
+            conn.close()
+            status, out, err = helpers.run_script(self.work_dir,
+                                                  'audit_001.py')
+            self.assertEqual(status, 0, err)
+            conn = sqlite3.connect(summary_path)
+            actions.append(conn.execute(query).fetchall())
+            conn.close()
+        self.assertTrue(actions[0])
+        self.assertEqual(actions[1], actions[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+import os
+import sqlite3
+import unittest
+
+import helpers
+import compare_checksums
+from compare_checksums import compare, disagreement, merge_sources, uuid_groups
+
+UUID = 'c2ce6f44-7ed4-d57b-1e2f-eb89414c343c'
+MD5 = 'a' * 32
+SHA256 = 'b' * 64
+
+
+def ingest_rows(size=10, md5=MD5, sha256=SHA256):
+    return [(UUID, 1, 'test.edu/bag/data/a.txt', size, md5, sha256)]
+
+def fedora_rows(size=10, md5=MD5, sha256=SHA256, state='A'):
+    rows = []
+    for algorithm, digest in [('md5', md5), ('sha256', sha256)]:
+        if digest:
+            rows.append((UUID, 7, 'test.edu/bag/data/a.txt', size, state,
+                         algorithm, digest, '2016-01-01T00:00:00Z'))
+    return rows or [(UUID, 7, 'test.edu/bag/data/a.txt', size, state,
+                     None, None, None)]
+
+def s3_rows(size=10, etag=MD5, md5=MD5, sha256=SHA256):
+    return [(UUID, 3, size, etag, 'md5', md5),
+            (UUID, 3, size, etag, 'sha256', sha256)]
+
+
+class MergeSourcesTest(unittest.TestCase):
+
+    def groups(self, name, uuids):
+        return name, uuid_groups(name, iter([(uuid, i)
+                                             for i, uuid in enumerate(uuids)]))
+
+    def test_merge(self):
+        merged = list(merge_sources([self.groups('a', ['1', '1', '3']),
+                                     self.groups('b', ['2', '3', '4']),
+                                     self.groups('c', [])]))
+        self.assertEqual([uuid for uuid, matched in merged],
+                         ['1', '2', '3', '4'])
+        self.assertEqual(merged[0][1], {'a': [('1', 0), ('1', 1)]})
+        self.assertEqual(sorted(merged[2][1]), ['a', 'b'])
+        self.assertEqual(merged[3][1], {'b': [('4', 2)]})
+
+    def test_unsorted_stream(self):
+        name, groups = self.groups('a', ['1', '3', '2'])
+        self.assertRaises(compare_checksums.UnsortedStream, list, groups)
+
+
+class DisagreementTest(unittest.TestCase):
+
+    def test_agreement(self):
+        self.assertEqual(disagreement([('a', 'ABC'), ('b', 'abc'),
+                                       ('c', None)]), None)
+        self.assertEqual(disagreement([('a', None), ('b', None)]), None)
+
+    def test_disagreement(self):
+        self.assertEqual(disagreement([('a', 10), ('b', None), ('c', 11)]),
+                         "a 10, c 11")
+
+
+class CompareTest(unittest.TestCase):
+
+    def rules(self, **matched):
+        return [problem[0] for problem in compare(UUID, matched)]
+
+    def test_all_agree(self):
+        self.assertEqual(self.rules(ingest=ingest_rows(), fedora=fedora_rows(),
+                                    s3=s3_rows()), [])
+
+    def test_multipart_etag_is_not_an_md5(self):
+        self.assertEqual(self.rules(ingest=ingest_rows(), fedora=fedora_rows(),
+                                    s3=s3_rows(etag='abc-2')), [])
+
+    def test_mismatches(self):
+        self.assertEqual(self.rules(ingest=ingest_rows(),
+                                    fedora=fedora_rows(size=11),
+                                    s3=s3_rows(sha256='c' * 64)),
+                         ['size_mismatch', 'sha256_mismatch'])
+        self.assertEqual(self.rules(ingest=ingest_rows(), fedora=fedora_rows(),
+                                    s3=s3_rows(etag='d' * 32)),
+                         ['md5_mismatch'])
+
+    def test_missing_digests(self):
+        self.assertEqual(self.rules(ingest=ingest_rows(md5=None),
+                                    fedora=fedora_rows(md5=None, sha256=None),
+                                    s3=s3_rows()),
+                         ['missing_md5', 'missing_sha256'])
+
+    def test_missing_sources(self):
+        self.assertEqual(self.rules(ingest=ingest_rows(), fedora=fedora_rows()),
+                         ['missing_s3'])
+        self.assertEqual(self.rules(fedora=fedora_rows(state='D')), [])
+        problems = compare(UUID, {'ingest': ingest_rows(), 's3': s3_rows()})
+        self.assertEqual([(rule, generic_file_id) for rule, generic_file_id,
+                          identifier, detail in problems],
+                         [('missing_fedora', 1)])
+
+
+class CompareChecksumsTest(unittest.TestCase):
+    """
+    Runs compare_checksums on the fixture before and after damaging
+    a few files, and checks that it reports exactly the damage.
+    """
+
+    def setUp(self):
+        self.work_dir = helpers.build_fixture(bags=40, files_per_bag=10,
+                                              audit_tables=False)
+        self.conn = sqlite3.connect(os.path.join(self.work_dir, 'db',
+                                                 'aptrust.db'))
+
+    def tearDown(self):
+        self.conn.close()
+        helpers.remove_fixture(self.work_dir)
+
+    def findings(self):
+        run_id = helpers.quietly(compare_checksums.compare_checksums,
+                                 self.conn)
+        return set(self.conn.execute("""select rule, detail from findings
+        where run_id = ?""", (run_id,)).fetchall())
+
+    def test_injected_damage(self):
+        before = self.findings()
+        # The fixture's failed bags have files that never reached Fedora.
+        self.assertEqual(set(rule for rule, detail in before),
+                         set(['missing_fedora']))
+        files = self.conn.execute("""select id, uri_uuid from files
+        where state = 'A' order by id limit 5""").fetchall()
+        self.conn.execute("update files set size = size + 1 where id = ?",
+                          (files[0][0],))
+        self.conn.execute("""update s3_meta set value = ? where name = 'sha256'
+        and key_id in (select id from s3_keys where name = ?)""",
+                          ('0' * 64, files[1][1]))
+        self.conn.execute("""delete from checksums where algorithm = 'md5'
+        and file_id = ?""", (files[2][0],))
+        self.conn.execute("""update s3_keys set deleted_at = '2017-01-01'
+        where bucket = ? and name = ?""",
+                          (compare_checksums.S3_BUCKET, files[3][1]))
+        # Digests that only differ in case agree.
+        self.conn.execute("""update checksums set digest = upper(digest)
+        where file_id = ?""", (files[4][0],))
+        self.conn.commit()
+
+        found = sorted((rule, detail.split(':')[0].split()[1])
+                       for rule, detail in self.findings() - before)
+        self.assertEqual(found, sorted([
+            ('size_mismatch', files[0][1]),
+            ('sha256_mismatch', files[1][1]),
+            ('missing_md5', files[2][1]),
+            ('missing_s3', files[3][1]),
+        ]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import helpers
+import duckdb_audit
+
+
+class DuckdbTypeTest(unittest.TestCase):
+
+    def test_integer_affinity_is_bigint(self):
+        for declared in ['int', 'integer', 'unsigned big int', 'INT']:
+            self.assertEqual(duckdb_audit.duckdb_type(declared), 'BIGINT')
+
+    def test_everything_else_is_varchar(self):
+        for declared in ['bool', 'boolean', 'datetime', 'varchar(40)',
+                         'text', 'real', None, '']:
+            self.assertEqual(duckdb_audit.duckdb_type(declared), 'VARCHAR')
+
+
+class CreatedTablesTest(unittest.TestCase):
+
+    def test_dropped_working_tables_are_left_out(self):
+        statements = [
+            "create table a (x int)",
+            "create table work (x int)",
+            "insert into a select x from work",
+            "drop table work",
+        ]
+        self.assertEqual(duckdb_audit.created_tables(statements), ['a'])
+
+
+@unittest.skipIf(duckdb_audit.duckdb is None, "needs duckdb (Python 3)")
+class ExportTableTest(unittest.TestCase):
+    """
+    Exports a table shaped like the loaders' ingest_generic_files,
+    where bool columns can hold timestamps, as in
+    test/data/apt_record_sample.json.
+    """
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_bool_column_with_timestamps(self):
+        conn = sqlite3.connect(':memory:')
+        conn.execute("""create table ingest_generic_files(id integer
+        primary key, size int, md5_verified bool, needs_save bool,
+        stored_at datetime)""")
+        rows = [(1, 10, '2015-10-01T06:44:20.400881056Z', 1,
+                 '2015-10-01T06:44:21Z'),
+                (2, None, None, 0, None)]
+        conn.executemany("insert into ingest_generic_files values (?,?,?,?,?)",
+                         rows)
+        duck = duckdb_audit.duckdb.connect()
+        count = duckdb_audit.export_table(duck, conn, 'ingest_generic_files',
+                                          self.work_dir)
+        self.assertEqual(count, 2)
+        exported = duck.execute("""select id, size, md5_verified, needs_save,
+        stored_at from ingest_generic_files order by id""").fetchall()
+        self.assertEqual(exported, [
+            (1, 10, '2015-10-01T06:44:20.400881056Z', '1',
+             '2015-10-01T06:44:21Z'),
+            (2, None, None, '0', None)])
+        self.assertEqual(duck.execute("""select count(*) from
+        ingest_generic_files where needs_save = 1""").fetchone()[0], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
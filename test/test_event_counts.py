@@ -0,0 +1,121 @@
+import os
+import sqlite3
+import unittest
+
+import helpers
+import fedora_to_sql
+
+EVENT_TYPES = ['identifier_assignment', 'ingest', 'fixity_check',
+               'fixity_generation', 'access_assignment']
+
+GROUP_BY_QUERY = """select coalesce(file_id, 0), coalesce(object_id, 0),
+coalesce(type, ''), count(*) from events
+group by 1, 2, 3 order by 1, 2, 3"""
+
+COUNTS_QUERY = """select file_id, object_id, type, event_count
+from event_counts order by 1, 2, 3"""
+
+
+def event(number, event_type):
+    return {'identifier': "event-{0}".format(number), 'type': event_type,
+            'date_time': '2016-01-01T00:00:00Z', 'detail': None,
+            'outcome': 'Success', 'outcome_detail': None, 'object': None,
+            'agent': None, 'outcome_information': None}
+
+
+class EventCountsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        helpers.quietly(fedora_to_sql.initialize_db, self.conn)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_count_event(self):
+        helpers.quietly(fedora_to_sql.create_event_counts_if_necessary,
+                        self.conn)
+        for i in range(3):
+            fedora_to_sql.count_event(self.conn, 1, 10, 'fixity_check')
+        fedora_to_sql.count_event(self.conn, 1, None, 'ingest')
+        fedora_to_sql.count_event(self.conn, 1, 0, 'ingest')
+        fedora_to_sql.count_event(self.conn, 2, 20, None)
+        self.assertEqual(self.conn.execute(COUNTS_QUERY).fetchall(), [
+            (0, 1, 'ingest', 2),
+            (10, 1, 'fixity_check', 3),
+            (20, 2, '', 1),
+        ])
+
+    def test_backfill_then_save_event(self):
+        # Events loaded before event_counts existed.
+        for i in range(200):
+            file_id = i % 7 or None
+            self.conn.execute("""insert into events(object_id, file_id,
+            identifier, type) values (?,?,?,?)""",
+                              (i % 3 + 1, file_id, "old-{0}".format(i),
+                               EVENT_TYPES[i % 5]))
+        helpers.quietly(fedora_to_sql.create_event_counts_if_necessary,
+                        self.conn)
+        self.assertEqual(self.conn.execute(COUNTS_QUERY).fetchall(),
+                         self.conn.execute(GROUP_BY_QUERY).fetchall())
+        # Events loaded after, including ones that are already there.
+        for i in range(300):
+            fedora_to_sql.save_event(self.conn, event(i % 250,
+                                                      EVENT_TYPES[i % 4]),
+                                     i % 4 + 1, i % 5 or None)
+        self.assertEqual(self.conn.execute(COUNTS_QUERY).fetchall(),
+                         self.conn.execute(GROUP_BY_QUERY).fetchall())
+        # A second call leaves the table alone.
+        helpers.quietly(fedora_to_sql.create_event_counts_if_necessary,
+                        self.conn)
+        self.assertEqual(self.conn.execute(COUNTS_QUERY).fetchall(),
+                         self.conn.execute(GROUP_BY_QUERY).fetchall())
+
+
+class AuditEventCountsTest(unittest.TestCase):
+    """
+    Checks the event counts build_audit_001_tables.sql reads from
+    event_counts against counts of the events themselves.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.work_dir = helpers.build_fixture(bags=40, files_per_bag=10)
+        cls.conn = sqlite3.connect(os.path.join(cls.work_dir, 'db',
+                                                'aptrust.db'))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.conn.close()
+        helpers.remove_fixture(cls.work_dir)
+
+    def event_counts(self, where):
+        return ", ".join(
+            "(select count(*) from events e where {0} and e.type = '{1}')".format(
+                where, event_type) for event_type in EVENT_TYPES)
+
+    def test_object_counts(self):
+        query = """select object_id, {0} from audit_001_objects
+        order by object_id""".format(", ".join(
+            t + "_count" for t in EVENT_TYPES))
+        expected = """select o.object_id, {0} from audit_001_objects o
+        order by o.object_id""".format(self.event_counts(
+            "e.object_id = o.object_id and e.file_id is null"))
+        rows = self.conn.execute(query).fetchall()
+        self.assertTrue(any(sum(row[1:]) for row in rows))
+        self.assertEqual(rows, self.conn.execute(expected).fetchall())
+
+    def test_file_counts(self):
+        query = """select fedora_file_id, {0} from audit_001_files
+        order by fedora_file_id, rowid""".format(", ".join(
+            t + "_count" for t in EVENT_TYPES))
+        expected = """select f.fedora_file_id, {0} from audit_001_files f
+        order by f.fedora_file_id, f.rowid""".format(self.event_counts(
+            "e.file_id = f.fedora_file_id"))
+        rows = self.conn.execute(query).fetchall()
+        self.assertTrue(any(sum(row[1:]) for row in rows))
+        self.assertEqual(rows, self.conn.execute(expected).fetchall())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+import helpers
+import benchmark_fixity
+import fixity_check
+
+
+class StuckBackend(fixity_check.LocalBackend):
+    """
+    Holds the read of the first file until every other file has been
+    opened, or ten seconds pass.
+    """
+
+    def __init__(self, root, uuids):
+        fixity_check.LocalBackend.__init__(self, root)
+        self.stuck = uuids[0]
+        self.others = len(uuids) - 1
+        self.lock = threading.Lock()
+        self.others_opened = threading.Event()
+        self.released = None
+
+    def open(self, uuid):
+        if uuid == self.stuck:
+            self.released = self.others_opened.wait(10)
+        else:
+            with self.lock:
+                self.others -= 1
+                if self.others == 0:
+                    self.others_opened.set()
+        return fixity_check.LocalBackend.open(self, uuid)
+
+
+class S3BackendTest(unittest.TestCase):
+
+    def test_needs_boto(self):
+        s3_connection = fixity_check.S3Connection
+        fixity_check.S3Connection = None
+        try:
+            with self.assertRaises(SystemExit) as raised:
+                fixity_check.S3Backend(fixity_check.VA_BUCKET_NAME)
+        finally:
+            fixity_check.S3Connection = s3_connection
+        self.assertIn('boto is required', str(raised.exception.code))
+
+
+class FixityCheckTest(unittest.TestCase):
+    """
+    Checks 1200 small files, more than two batches, of which every
+    100th is missing and every 50th has been changed.
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='test_fixity_check_')
+        self.conn, self.expected = helpers.quietly(
+            benchmark_fixity.build_fixture, self.work_dir, 1200, 64)
+        self.backend = fixity_check.LocalBackend(
+            os.path.join(self.work_dir, 'objects'))
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.work_dir)
+
+    def test_files_to_check_reads_in_batches(self):
+        rows = fixity_check.files_to_check(self.conn, batch_size=7)
+        self.assertFalse(isinstance(rows, list))
+        ids = [row[0] for row in rows]
+        self.assertEqual(ids, list(range(1, 1201)))
+
+    def test_files_to_check_limit(self):
+        for limit in [1, 7, 14, 500, 1199]:
+            rows = list(fixity_check.files_to_check(self.conn, limit=limit,
+                                                    batch_size=7))
+            self.assertEqual(len(rows), limit)
+            total, total_bytes = fixity_check.files_total(self.conn,
+                                                          limit=limit)
+            self.assertEqual((total, total_bytes), (limit, limit * 64))
+
+    def test_files_total(self):
+        self.assertEqual(fixity_check.files_total(self.conn), (1200, 1200 * 64))
+
+    def check(self, backend):
+        rows = fixity_check.files_to_check(self.conn)
+        # check reports each missing or changed file on stderr.
+        stderr = sys.stderr
+        sys.stderr = open(os.devnull, 'w')
+        try:
+            return helpers.quietly(fixity_check.check, self.conn, backend,
+                                   rows, 4)
+        finally:
+            sys.stderr.close()
+            sys.stderr = stderr
+
+    def test_slow_object_doesnt_hold_up_the_rest(self):
+        uuids = [row[2] for row in fixity_check.files_to_check(self.conn)]
+        backend = StuckBackend(os.path.join(self.work_dir, 'objects'), uuids)
+        run = self.check(backend)
+        self.assertTrue(backend.released)
+        self.assertEqual(run['files'], 1200)
+
+    def test_check(self):
+        run = self.check(self.backend)
+        self.assertEqual(run['files'], 1200)
+        self.assertEqual(run['bytes_read'],
+                         (1200 - self.expected['missing']) * 64)
+        self.assertEqual({'ok': run['ok'], 'mismatch': run['mismatched'],
+                          'missing': run['missing']}, self.expected)
+        saved = self.conn.execute("""select count(*) from fixity_results
+        where run_id = ?""", (run['id'],)).fetchone()[0]
+        self.assertEqual(saved, 1200)
+
+
+if __name__ == '__main__':
+    unittest.main()
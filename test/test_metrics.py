@@ -0,0 +1,47 @@
+import argparse
+import sys
+import unittest
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import helpers
+import metrics
+
+
+class TraceMemoryTest(unittest.TestCase):
+    """
+    Checks that --trace-memory isn't silently ignored on a Python that
+    has no tracemalloc.
+    """
+
+    def setUp(self):
+        self.tracemalloc = metrics.tracemalloc
+        metrics.tracemalloc = None
+        self.stderr = sys.stderr
+        sys.stderr = StringIO()
+
+    def tearDown(self):
+        metrics.tracemalloc = self.tracemalloc
+        sys.stderr = self.stderr
+
+    def test_flag_is_rejected(self):
+        parser = argparse.ArgumentParser()
+        metrics.add_metrics_arguments(parser)
+        args = parser.parse_args(['--trace-memory'])
+        self.assertRaises(SystemExit, metrics.metrics_from_args, 'test', args)
+        args = parser.parse_args([])
+        self.assertFalse(metrics.metrics_from_args('test', args).trace_memory)
+
+    def test_warning_goes_to_stderr(self):
+        stream = StringIO()
+        m = metrics.Metrics('test', trace_memory=True, stream=stream)
+        self.assertFalse(m.trace_memory)
+        self.assertEqual(stream.getvalue(), '')
+        self.assertTrue('tracemalloc is not available' in
+                        sys.stderr.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
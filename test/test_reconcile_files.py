@@ -0,0 +1,126 @@
+import os
+import sqlite3
+import unittest
+
+import helpers
+import reconcile_files
+
+LATER = '2016-06-01 00:00:00'
+
+FEDORA = "identifier in (select identifier from files)"
+
+IN_S3 = """uuid in (select name from s3_keys where bucket = '{0}'
+and deleted_at is null)""".format(reconcile_files.S3_BUCKET)
+
+
+class RefreshTest(unittest.TestCase):
+    """
+    Builds file_reconciliation on the fixture, changes every source
+    table, and checks that the incremental refresh gives the same table
+    as a rebuild, having recalculated only the affected files.
+    """
+
+    def setUp(self):
+        self.work_dir = helpers.build_fixture(bags=40, files_per_bag=10,
+                                              audit_tables=False)
+        self.conn = sqlite3.connect(os.path.join(self.work_dir, 'db',
+                                                 'aptrust.db'))
+        helpers.quietly(reconcile_files.refresh, self.conn)
+
+    def tearDown(self):
+        self.conn.close()
+        helpers.remove_fixture(self.work_dir)
+
+    def table(self):
+        columns = [row[1] for row in self.conn.execute(
+            "pragma table_info(file_reconciliation)")
+                   if row[1] != 'refreshed_at']
+        return self.conn.execute("""select {0} from file_reconciliation
+        order by generic_file_id""".format(", ".join(columns))).fetchall()
+
+    def generic_file(self, where, affected):
+        """
+        Returns (id, identifier, uuid) of the first generic file that
+        matches where and isn't in affected yet.
+        """
+        for row in self.conn.execute("""select id, identifier, uuid
+        from ingest_generic_files where {0} order by id""".format(where)):
+            if row[0] not in affected:
+                return row
+
+    def change_sources(self):
+        """
+        Makes one change of each kind. Returns the ids of the generic
+        files they affect.
+        """
+        c = self.conn
+        affected = set()
+        # A new generic file.
+        c.execute("""insert into ingest_generic_files(ingest_tar_result_id,
+        file_path, size, md5, sha256, uuid, identifier, storage_url,
+        storage_uuid) select ingest_tar_result_id, 'data/new.txt', 5, md5,
+        sha256, 'new-uuid', identifier || '.new', storage_url, 'new-uuid'
+        from ingest_generic_files where id = 1""")
+        affected.add(c.execute(
+            "select max(id) from ingest_generic_files").fetchone()[0])
+        # A Fedora file for a generic file Fedora didn't have.
+        gf_id, identifier, uuid = self.generic_file(
+            "identifier not in (select identifier from files)", affected)
+        c.execute("""insert into files(object_id, pid, uri, size, identifier,
+        state, uri_uuid) values (1, 'file:new', ?, 10, ?, 'A', ?)""",
+                  ('https://s3.amazonaws.com/x/' + uuid, identifier, uuid))
+        affected.add(gf_id)
+        # A newer checksum that doesn't match the ingest one.
+        gf_id, identifier, uuid = self.generic_file(FEDORA, affected)
+        file_id = c.execute("select id from files where identifier = ?",
+                            (identifier,)).fetchone()[0]
+        c.execute("""insert into checksums(file_id, algorithm, digest,
+        date_time) values (?, 'md5', ?, ?)""", (file_id, '0' * 32, LATER))
+        affected.add(gf_id)
+        # A Glacier key for a file that didn't have one.
+        gf_id, identifier, uuid = self.generic_file(
+            """uuid not in (select name from s3_keys where bucket = '{0}')
+            and uuid in (select name from s3_keys)""".format(
+                reconcile_files.GLACIER_BUCKET), affected)
+        c.execute("""insert into s3_keys(bucket, name, etag, last_modified,
+        size, last_seen_at) values (?, ?, 'etag', ?, 10, ?)""",
+                  (reconcile_files.GLACIER_BUCKET, uuid, LATER, LATER))
+        affected.add(gf_id)
+        # A key the incremental crawl found changed.
+        gf_id, identifier, uuid = self.generic_file(IN_S3, affected)
+        c.execute("""update s3_keys set size = size + 1, last_modified = ?
+        where name = ? and bucket = ?""",
+                  (LATER, uuid, reconcile_files.S3_BUCKET))
+        affected.add(gf_id)
+        # A key the incremental crawl marked deleted.
+        gf_id, identifier, uuid = self.generic_file(IN_S3, affected)
+        c.execute("""update s3_keys set deleted_at = ?
+        where name = ? and bucket = ?""",
+                  (LATER, uuid, reconcile_files.S3_BUCKET))
+        affected.add(gf_id)
+        c.commit()
+        return affected
+
+    def test_incremental_matches_rebuild(self):
+        before = self.table()
+        affected = self.change_sources()
+        self.assertEqual(len(affected), 6)
+        count = helpers.quietly(reconcile_files.refresh, self.conn)
+        incremental = self.table()
+        self.assertEqual(count, len(affected))
+        self.assertNotEqual(incremental, before)
+        changed = set(row[0] for row in set(incremental) - set(before))
+        self.assertEqual(changed, affected)
+
+        helpers.quietly(reconcile_files.refresh, self.conn, rebuild=True)
+        self.assertEqual(incremental, self.table())
+
+    def test_refresh_without_changes(self):
+        before = self.table()
+        self.assertEqual(helpers.quietly(reconcile_files.refresh, self.conn),
+                         0)
+        self.assertEqual(self.table(), before)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import sqlite3
+import unittest
+from datetime import datetime
+
+import helpers
+import fake_s3
+import s3_buckets_to_sql
+from metrics import Metrics
+
+BUCKET_NAME = 'aptrust.preservation.storage'
+
+
+class ListBucketTest(unittest.TestCase):
+    """
+    Crawls a small fake bucket, changes it, and crawls it again, the
+    way the full and incremental crawls run one after the other.
+    """
+
+    def setUp(self):
+        self.s3 = fake_s3.FakeS3Connection()
+        self.bucket = self.s3.create_bucket(BUCKET_NAME)
+        for i in range(10):
+            self.add_key("key-{0}".format(i))
+        self.conn = sqlite3.connect(':memory:')
+
+    def tearDown(self):
+        self.conn.close()
+
+    def add_key(self, name):
+        self.bucket.add_key(name, 10, 'text/plain',
+                            {'institution': 'test.edu', 'bag': 'bag',
+                             'md5': 'a' * 32},
+                            last_modified='2016-01-01T00:00:00.000Z')
+
+    def crawl(self, incremental=False):
+        metrics = Metrics('s3_buckets_to_sql', stream=open(os.devnull, 'w'))
+        helpers.quietly(s3_buckets_to_sql.list_bucket, BUCKET_NAME,
+                        self.conn, incremental, s3=self.s3, metrics=metrics)
+
+    def live_keys(self):
+        return [name for name, in self.conn.execute("""select name
+        from s3_keys where deleted_at is null order by name""")]
+
+    def test_full_crawl_records_last_seen(self):
+        self.crawl()
+        second_crawl = datetime.utcnow()
+        self.crawl()
+        self.assertEqual(self.conn.execute(
+            "select count(*) from s3_keys").fetchone()[0], 10)
+        # Keys the second crawl found already saved are still live to
+        # an incremental crawl that started after the first.
+        self.assertEqual(s3_buckets_to_sql.mark_deleted_keys(
+            self.conn, BUCKET_NAME, second_crawl), 0)
+
+    def test_deleted_key_reappears(self):
+        self.crawl()
+        self.bucket.delete_key('key-3')
+        self.crawl(incremental=True)
+        self.assertFalse('key-3' in self.live_keys())
+
+        self.add_key('key-3')
+        self.crawl()
+        self.assertEqual(self.live_keys(),
+                         ["key-{0}".format(i) for i in range(10)])
+        self.assertEqual(self.conn.execute("""select count(*) from s3_keys
+        where name = 'key-3'""").fetchone()[0], 2)
+        self.crawl(incremental=True)
+        self.assertEqual(len(self.live_keys()), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
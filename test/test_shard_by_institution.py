@@ -0,0 +1,139 @@
+import os
+import shutil
+import sqlite3
+import unittest
+
+import helpers
+import identifiers
+import shard_by_institution
+
+
+class InstitutionFromIdentifierTest(unittest.TestCase):
+
+    def test_object_identifier(self):
+        self.assertEqual(identifiers.institution_from_identifier(
+            'virginia.edu/virginia.edu.uva-lib_2278801'), 'virginia.edu')
+
+    def test_bag_key(self):
+        key = identifiers.bag_key('Virginia.edu',
+                                  'virginia.edu.uva-lib_2278801.tar')
+        self.assertEqual(key, 'virginia.edu/virginia.edu.uva-lib_2278801')
+        self.assertEqual(identifiers.institution_from_identifier(key),
+                         'virginia.edu')
+
+    def test_file_identifier(self):
+        self.assertEqual(identifiers.institution_from_identifier(
+            'Test.EDU/bag/data/a/b.txt'), 'test.edu')
+
+    def test_no_institution(self):
+        for identifier in [None, '', 'virginia.edu']:
+            self.assertEqual(
+                identifiers.institution_from_identifier(identifier), None)
+
+
+class ShardTest(unittest.TestCase):
+    """
+    Shards the test fixture, then checks that every row went to exactly
+    one shard, and that auditing the shards finds the same actions as
+    auditing aptrust.db.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.work_dir = helpers.build_fixture(bags=80, files_per_bag=10)
+        cls.db_dir = os.path.join(cls.work_dir, 'db')
+        cls.shared_tar_name = cls.collide_tar_names(
+            os.path.join(cls.db_dir, 'aptrust.db'))
+        status, out, err = helpers.run_script(cls.work_dir,
+                                              'shard_by_institution.py')
+        if status != 0:
+            raise AssertionError(err)
+        cls.conn = sqlite3.connect(os.path.join(cls.db_dir, 'aptrust.db'))
+        cls.shards = {}
+        for institution_id, identifier in shard_by_institution.institutions(
+                cls.conn):
+            cls.shards[identifier] = (institution_id, sqlite3.connect(
+                shard_by_institution.shard_path(
+                    identifier, os.path.join(cls.db_dir, 'shards'))))
+
+    @classmethod
+    def collide_tar_names(cls, db_path):
+        """
+        Gives a failed bag of one institution the tar name of a failed
+        bag of another, as two depositors can, so the shard summaries
+        have a bag name in common. Returns the name.
+        """
+        conn = sqlite3.connect(db_path)
+        rows = conn.execute("""select id, name, institution_id
+        from work_items where stage = 'Record' and status = 'Failed'
+        order by id""").fetchall()
+        first = rows[0]
+        other = [row for row in rows if row[2] != first[2]][0]
+        conn.execute("update work_items set name = ? where id = ?",
+                     (first[1], other[0]))
+        conn.commit()
+        helpers.run_sql_script(conn, 'build_audit_001_tables.sql')
+        conn.close()
+        return first[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.conn.close()
+        for institution_id, shard_conn in cls.shards.values():
+            shard_conn.close()
+        helpers.remove_fixture(cls.work_dir)
+
+    def test_every_institution_has_a_shard(self):
+        self.assertEqual(sorted(self.shards),
+                         ['example.edu', 'sample.org', 'test.edu'])
+
+    def test_each_row_is_in_one_shard(self):
+        for table, _, _, _ in shard_by_institution.SHARD_RULES:
+            query = "select * from {0} order by rowid".format(table)
+            rows = []
+            for institution_id, shard_conn in self.shards.values():
+                rows.extend(shard_conn.execute(query).fetchall())
+            self.assertEqual(sorted(rows),
+                             sorted(self.conn.execute(query).fetchall()),
+                             table)
+
+    def test_rows_follow_their_institution(self):
+        for identifier, (institution_id, shard_conn) in self.shards.items():
+            self.assertEqual(shard_conn.execute(
+                "select distinct institution_id from objects").fetchall(),
+                             [(institution_id,)])
+            # Every file's object, and every checksum's file, came along.
+            self.assertEqual(shard_conn.execute("""select count(*) from files f
+            where not exists (select 1 from objects o
+              where o.id = f.object_id)""").fetchone()[0], 0)
+            self.assertEqual(shard_conn.execute("""select count(*)
+            from checksums c where not exists (select 1 from files f
+              where f.id = c.file_id)""").fetchone()[0], 0)
+            for bag_key, in shard_conn.execute(
+                    "select bag_key from s3_keys where bag_key is not null"):
+                self.assertEqual(
+                    identifiers.institution_from_identifier(bag_key),
+                    identifier)
+
+    def test_audit_shards_matches_audit_001(self):
+        summary_path = os.path.join(self.db_dir, 'audit001_summary.db')
+        query = """select b.name, a.action, a.storage, a.key
+        from aws_files a inner join bags b on b.id = a.bag_id
+        order by 1, 2, 3, 4"""
+        actions = {}
+        for script in ['audit_001.py', 'audit_shards.py']:
+            if os.path.exists(summary_path):
+                os.remove(summary_path)
+            status, out, err = helpers.run_script(self.work_dir, script)
+            self.assertEqual(status, 0, err)
+            conn = sqlite3.connect(summary_path)
+            actions[script] = conn.execute(query).fetchall()
+            conn.close()
+        self.assertTrue(actions['audit_001.py'])
+        self.assertTrue(self.shared_tar_name in
+                        [row[0] for row in actions['audit_001.py']])
+        self.assertEqual(actions['audit_shards.py'], actions['audit_001.py'])
+
+
+if __name__ == '__main__':
+    unittest.main()